@@ -0,0 +1,106 @@
+'''Benchmark of the codecs of utils.compress_buf and utils.decompress_buf.
+
+The compression ratio and the compression and decompression speeds of each
+available codec (zstd and lz4 need the zstandard and lz4 packages) are
+measured on the given files, e.g. the fort.10, fort.6 and crpoint_*.bin of a
+finished job. Without files, simulated fort.10 and fort.6 text and binary
+checkpoint data are used. With zstd, a dictionary trained on the text files
+is measured as well.
+
+usage: python benchmarks/bench_codecs.py [file ...]
+'''
+import os
+import sys
+import time
+import random
+import struct
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1].absolute()))
+from pysixdesk.lib import utils
+
+
+def simulated_files(path):
+    names = []
+    name = os.path.join(path, 'fort.10')
+    with open(name, 'w') as f_out:
+        for _ in range(30):
+            line = ['%.15E' % random.random() for _ in range(60)]
+            f_out.write(' '.join(line) + '\n')
+    names.append(name)
+    name = os.path.join(path, 'fort.6')
+    with open(name, 'w') as f_out:
+        for turn in range(20000):
+            f_out.write('  Turn %8d  Particle %3d  x = %.15E  y = %.15E\n'
+                        % (turn, turn % 64, random.gauss(0, 1E-3),
+                           random.gauss(0, 1E-3)))
+    names.append(name)
+    name = os.path.join(path, 'crpoint_sec.bin')
+    with open(name, 'wb') as f_out:
+        for _ in range(200000):
+            f_out.write(struct.pack('d', random.gauss(0, 1E-3)))
+    names.append(name)
+    return names
+
+
+def codecs(texts):
+    for name in ['gzip', 'zstd', 'lz4']:
+        try:
+            yield name, utils.codecs[name]()
+        except ImportError:
+            print(f'{name} is not available!')
+            continue
+        if name == 'zstd' and texts:
+            with tempfile.TemporaryDirectory() as tmp:
+                dict_file = os.path.join(tmp, 'zstd.dict')
+                # the samples are split to have enough for the training
+                samples = []
+                for text in texts:
+                    with open(text, 'rb') as f_in:
+                        lines = f_in.readlines()
+                    for i in range(0, len(lines), 10):
+                        sample = os.path.join(tmp, 'sample_%d' % len(samples))
+                        with open(sample, 'wb') as f_out:
+                            f_out.writelines(lines[i:i + 10])
+                        samples.append(sample)
+                try:
+                    utils.train_zstd_dictionary(samples, out=dict_file)
+                except Exception as e:
+                    print(f'zstd dictionary training failed: {e}')
+                    continue
+                yield 'zstd+dict', utils.ZstdCodec(dictionary=dict_file)
+
+
+def measure(codec, data, repeat=3):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        zbuf = codec.compress(data)
+    comp = (time.perf_counter() - start) / repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        codec.decompress(zbuf)
+    decomp = (time.perf_counter() - start) / repeat
+    return len(zbuf), comp, decomp
+
+
+def run(names):
+    texts = [i for i in names if not i.endswith('.bin')]
+    for label, codec in codecs(texts):
+        for name in names:
+            with open(name, 'rb') as f_in:
+                data = f_in.read()
+            size, comp, decomp = measure(codec, data)
+            mb = len(data) / 1E6
+            print(f'{label:>9} {os.path.basename(name):>16}: '
+                  f'ratio {len(data) / size:5.2f}, '
+                  f'compress {mb / comp:7.1f} MB/s, '
+                  f'decompress {mb / decomp:7.1f} MB/s')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run(sys.argv[1:])
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            run(simulated_files(tmp))
@@ -0,0 +1,85 @@
+'''Benchmark of the sqlite pragma profiles of SQLDatabaseAdaptor.
+
+For every profile a study is created in a temporary workspace, its database
+is switched to the profile and the time of Study.update_db and of the
+collection of simulated sixtrack results (Study.collect_result) is measured.
+The cluster is replaced by a stub, so no batch system is needed.
+
+usage: python benchmarks/bench_db_profiles.py [seeds] [tasks]
+'''
+import os
+import sys
+import gzip
+import time
+import logging
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1].absolute()))
+from pysixdesk import WorkSpace
+from pysixdesk.lib.dbadaptor import SQLDatabaseAdaptor
+
+
+class StubCluster(object):
+    '''A cluster without running jobs'''
+
+    def check_running(self, studypath):
+        return []
+
+    def download_from_spool(self, studypath):
+        pass
+
+    def remove(self, studypath, job_status):
+        pass
+
+
+def fake_results(st, tasks):
+    '''Mark some sixtrack work units as submitted and write their fort.10'''
+    wus = st.db.select('sixtrack_wu', ['wu_id'], limit=tasks)
+    mtime = int(time.time() * 1E7)
+    task_ids = st._allocate_tasks('sixtrack_task', ['wu_id'], wus, mtime)
+    st.db.updatem('sixtrack_wu',
+                  {'task_id': task_ids, 'status': ['submitted'] * len(wus),
+                   'unique_id': ['0.0'] * len(wus)},
+                  {'wu_id': [i[0] for i in wus]})
+    line = ' '.join(['1.0'] * 60) + '\n'
+    for task_id in task_ids:
+        job_path = os.path.join(st.paths['sixtrack_out'], str(task_id))
+        os.makedirs(job_path)
+        with gzip.open(os.path.join(job_path, 'fort.10.gz'), 'wt') as f_out:
+            f_out.write(line * 30)
+    return len(task_ids)
+
+
+def run(seeds, tasks):
+    logging.disable(logging.INFO)
+    for profile in SQLDatabaseAdaptor.profiles:
+        with tempfile.TemporaryDirectory() as tmp:
+            ws = WorkSpace(os.path.join(tmp, 'ws'))
+            ws.init_study('st')
+            st = ws.load_study('st')
+            st.switch_db_profile(profile)
+            st.submission = StubCluster()
+            st.madx_params['SEEDRAN'] = list(range(1, seeds + 1))
+            amp = list(range(0, 41))
+            st.sixtrack_params['amp'] = list(zip(amp, amp[1:]))
+            st.sixtrack_params['kang'] = list(range(1, 11))
+            start = time.perf_counter()
+            st.update_db()
+            t_update = time.perf_counter() - start
+            num = fake_results(st, tasks)
+            start = time.perf_counter()
+            st.collect_result(1)
+            t_collect = time.perf_counter() - start
+            rows = st.db.select('sixtrack_wu', ['count(*)'])[0][0]
+            done = st.db.select('sixtrack_wu', ['count(*)'],
+                                "status='complete'")[0][0]
+            st.db.close()
+            print(f'{profile:>16}: update_db {rows} rows in {t_update:.3f} s,'
+                  f' collect_result {done}/{num} tasks in {t_collect:.3f} s')
+
+
+if __name__ == '__main__':
+    seeds = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    tasks = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    run(seeds, tasks)
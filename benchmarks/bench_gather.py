@@ -0,0 +1,54 @@
+'''Benchmark of the serial and the parallel gathering of sixtrack results.
+
+A study is filled with simulated fort.10 results (see bench_db_profiles.py)
+and Study.collect_result is timed with one process and with the given
+number of worker processes, then a repeated collection without new results
+is timed.
+
+usage: python benchmarks/bench_gather.py [tasks] [workers]
+'''
+import os
+import sys
+import time
+import logging
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1].absolute()))
+from pysixdesk import WorkSpace
+from bench_db_profiles import StubCluster, fake_results
+
+
+def run(tasks, workers):
+    logging.disable(logging.INFO)
+    for num in sorted(set([1, workers])):
+        with tempfile.TemporaryDirectory() as tmp:
+            ws = WorkSpace(os.path.join(tmp, 'ws'))
+            ws.init_study('st')
+            st = ws.load_study('st')
+            st.submission = StubCluster()
+            st.gather_workers = num
+            amp = list(range(0, tasks // 20 + 2))
+            st.sixtrack_params['amp'] = list(zip(amp, amp[1:]))
+            st.sixtrack_params['kang'] = list(range(1, 6))
+            st.update_db()
+            total = fake_results(st, tasks)
+            start = time.perf_counter()
+            st.collect_result(1)
+            elapsed = time.perf_counter() - start
+            done = st.db.select('sixtrack_wu', ['count(*)'],
+                                "status='complete'")[0][0]
+            # a repeated poll without new results
+            start = time.perf_counter()
+            st.collect_result(1)
+            repeat = time.perf_counter() - start
+            st.db.close()
+            print(f'{num:>3} processes: {done}/{total} tasks in '
+                  f'{elapsed:.3f} s ({done / elapsed:,.0f} tasks/s), '
+                  f'repeated poll in {repeat * 1E3:.1f} ms')
+
+
+if __name__ == '__main__':
+    tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    run(tasks, workers)
@@ -0,0 +1,91 @@
+'''Benchmark of the secondary indexes of the work unit tables.
+
+A sqlite database with the sixtrack_wu schema of dbtable.Table is filled
+with the given number of rows, once without and once with the secondary
+indexes. The queries issued by Study.info, gather.gather_results and
+TrackingJob.__init__ are timed on both.
+
+usage: python benchmarks/bench_indexes.py [rows]
+'''
+import os
+import sys
+import copy
+import time
+import random
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1].absolute()))
+from pysixdesk.lib.pysixdb import SixDB
+from pysixdesk.lib.dbtable import Table
+
+
+def build(db_name, rows, indexed):
+    tables = {}
+    table_keys = {}
+    Table(tables, table_keys, 'sql')
+    keys = copy.deepcopy(table_keys)
+    if not indexed:
+        for val in keys.values():
+            val.pop('index', None)
+    db = SixDB({'db_type': 'sql', 'db_name': db_name}, create=True)
+    for name in ['preprocess_wu', 'sixtrack_wu']:
+        db.create_table(name, tables[name], keys[name])
+    pre_num = 1000
+    db.insertm('preprocess_wu', {'wu_id': range(1, pre_num + 1),
+                                 'status': ['complete'] * pre_num})
+    status = ['complete', 'submitted', 'incomplete', None]
+    mtime = int(time.time() * 1E7)
+    db.insertm('sixtrack_wu', {
+        'wu_id': range(1, rows + 1),
+        'last_turn': [100] * rows,
+        'preprocess_id': [i % pre_num + 1 for i in range(rows)],
+        'batch_name': ['batch_%d' % (i // 10000) for i in range(rows)],
+        'unique_id': ['%d.0' % i for i in range(rows)],
+        'status': [status[i % 4] for i in range(rows)],
+        'task_id': range(1, rows + 1),
+        'mtime': [mtime] * rows})
+    return db
+
+
+def timeit(fun, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fun()
+    return (time.perf_counter() - start) / repeat
+
+
+def run(rows):
+    lookups = random.sample(range(1, rows + 1), 1000)
+    with tempfile.TemporaryDirectory() as tmp:
+        for indexed in [False, True]:
+            db_name = os.path.join(tmp, 'indexed_%s.db' % indexed)
+            db = build(db_name, rows, indexed)
+
+            def info():
+                db.select('sixtrack_wu', ['status', 'count(*)'],
+                          groupby=['status'])
+
+            def gather():
+                db.select('sixtrack_wu', ['task_id', 'unique_id'],
+                          "status='submitted'")
+                for task_id in lookups:
+                    db.select('sixtrack_wu', ['status'],
+                              'task_id=%s' % task_id)
+
+            def tracking_job():
+                task_id = random.choice(lookups)
+                out = db.select('sixtrack_wu', ['preprocess_id', 'wu_id'],
+                                'task_id=%s' % task_id)
+                db.select('preprocess_wu', ['task_id'], 'wu_id=%s' % out[0][0])
+
+            label = 'indexed' if indexed else 'no index'
+            print(f'{label:>9}: info {timeit(info, 5) * 1E3:.1f} ms, '
+                  f'gather_results lookups {timeit(gather) * 1E3:.1f} ms, '
+                  f'TrackingJob.__init__ '
+                  f'{timeit(tracking_job, 100) * 1E3:.3f} ms')
+            db.close()
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,81 @@
+'''Benchmark of resultparser.parse_file on fort.10 files.
+
+The files are parsed and written into a sqlite six_results table with a
+gather.ResultBatch, once with the line by line parser (the
+default) and once with the numpy parser (Study.parse_arrays).
+
+usage: python benchmarks/bench_resultparser.py [files] [lines]
+'''
+import os
+import sys
+import gzip
+import time
+import logging
+import random
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1].absolute()))
+from pysixdesk.lib import resultparser
+from pysixdesk.lib.gather import ResultBatch
+from pysixdesk.lib.pysixdb import SixDB
+from pysixdesk.lib.dbtable import Table
+
+
+def write_files(path, files, lines, types):
+    names = []
+    for i in range(files):
+        name = os.path.join(path, 'fort.10_%d.gz' % i)
+        with gzip.open(name, 'wt') as f_out:
+            for _ in range(lines):
+                line = ['%.15E' % (random.randint(0, 100000) if 'int' in typ
+                                   else random.random()) for typ in types]
+                f_out.write(' '.join(line) + '\n')
+        names.append(name)
+    return names
+
+
+def run(files, lines, batch=200):
+    logging.disable(logging.INFO)
+    tables = {}
+    table_keys = {}
+    Table(tables, table_keys, 'sql')
+    with tempfile.TemporaryDirectory() as tmp:
+        types = list(tables['six_results'].values())[2:-1]
+        names = write_files(tmp, files, lines, types)
+        results = {}
+        for label, arrays in [('per-line', False), ('numpy', True)]:
+            if arrays and resultparser.np is None:
+                print('numpy is not installed!')
+                break
+            db = SixDB({'db_type': 'sql',
+                        'db_name': os.path.join(tmp, label + '.db')},
+                       create=True)
+            for name in ['six_results', 'sixtrack_task', 'sixtrack_wu']:
+                db.create_table(name, tables[name])
+            results_batch = ResultBatch(db, 'sixtrack', batch)
+            start = time.perf_counter()
+            for task_id, name in enumerate(names):
+                task_table = {'status': 'Success'}
+                result_table = OrderedDict(tables['six_results'])
+                resultparser.parse_file(name, task_table, result_table,
+                                        'six_results', arrays)
+                results_batch.add(str(task_id), tmp, task_table,
+                                  {'six_results': result_table})
+                if results_batch.full():
+                    results_batch.flush()
+            results_batch.flush()
+            elapsed = time.perf_counter() - start
+            db.close()
+            results[label] = elapsed
+            print(f'{label:>9}: {files} files in {elapsed:.3f} s '
+                  f'({files * lines / elapsed:,.0f} rows/s)')
+    if len(results) == 2:
+        print(f'speed-up: {results["per-line"] / results["numpy"]:.1f}x')
+
+
+if __name__ == '__main__':
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    lines = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    run(files, lines)
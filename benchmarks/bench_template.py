@@ -0,0 +1,60 @@
+'''Benchmark of the rendering of a fort.3 template.
+
+A fort.3 with the given number of placeholders is rendered for many
+parameter sets, once with a re.sub per placeholder and line (the former
+utils.replace) and once with the compiled utils.Template.
+
+usage: python benchmarks/bench_template.py [renders] [placeholders]
+'''
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1].absolute()))
+from pysixdesk.lib import utils
+
+
+def template_text(placeholders):
+    lines = ['GEOME-STRENGTH', 'TRAC']
+    for i in range(placeholders):
+        lines.append('PARAM%d  %%param%d  0.0  1.0' % (i, i))
+    lines += ['NEXT'] * 200 + ['ENDE']
+    return '\n'.join(lines) + '\n'
+
+
+def per_line(text, patterns, values):
+    out = []
+    for line in text.splitlines(True):
+        for pat, val in zip(patterns, values):
+            line = re.sub(pat, str(val), line)
+        out.append(line)
+    return ''.join(out)
+
+
+def run(renders, placeholders):
+    text = template_text(placeholders)
+    patterns = ['%%param%d' % i for i in range(placeholders)]
+    params = [[j * 1E-3 + i for i in range(placeholders)]
+              for j in range(renders)]
+    start = time.perf_counter()
+    for values in params:
+        old = per_line(text, patterns, values)
+    per_line_time = time.perf_counter() - start
+    start = time.perf_counter()
+    template = utils.Template(text, patterns)
+    for values in params:
+        new = template.render(values)
+    compiled_time = time.perf_counter() - start
+    # with more than 10 placeholders %param1 is a prefix of %param10, which
+    # the former replacement gets wrong
+    print(f'same output as the former replacement: {old == new}')
+    print(f' re.sub per line: {renders} renders in {per_line_time:.3f} s')
+    print(f'compiled template: {renders} renders in {compiled_time:.3f} s')
+    print(f'speed-up: {per_line_time / compiled_time:.1f}x')
+
+
+if __name__ == '__main__':
+    renders = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    placeholders = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    run(renders, placeholders)
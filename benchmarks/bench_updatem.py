@@ -0,0 +1,70 @@
+'''Benchmark of DatabaseAdaptor.updatem on a sqlite database.
+
+The per-row update path used before the bulk implementation is reproduced
+here to compare the throughput (rows per second) of both approaches.
+
+usage: python benchmarks/bench_updatem.py [rows]
+'''
+import os
+import sys
+import time
+import tempfile
+from contextlib import closing
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1].absolute()))
+from pysixdesk.lib import dbadaptor
+
+
+def legacy_updatem(conn, table_name, values, where):
+    '''The former row by row implementation of updatem'''
+    sql = 'UPDATE %s SET %s where %s'
+    keys = list(values.keys())
+    vals = [values[key] for key in keys]
+    keys_where = list(where.keys())
+    vals_where = [where[key] for key in keys_where]
+    for val, val_where in zip(zip(*vals), zip(*vals_where)):
+        sets = ','.join(['%s=?' % key for key in keys])
+        sets_where = ['='.join(map(str, it)) for it in zip(keys_where,
+                                                           val_where)]
+        sets_where = ' and '.join(sets_where)
+        sql_cmd = sql % (table_name, sets, sets_where)
+        with closing(conn.cursor()) as c:
+            c.execute(sql_cmd, val)
+    conn.commit()
+
+
+def prepare(adaptor, db_name, rows):
+    conn = adaptor.new_connection(db_name)
+    columns = {'wu_id': 'INTEGER', 'last_turn': 'int', 'task_id': 'int',
+               'mtime': 'bigint'}
+    keys = {'primary': ['wu_id', 'last_turn']}
+    adaptor.create_table(conn, 'sixtrack_wu', columns, keys, recreate=True)
+    adaptor.insertm(conn, 'sixtrack_wu', {'wu_id': range(1, rows + 1),
+                                          'last_turn': [100] * rows})
+    return conn
+
+
+def run(rows):
+    adaptor = dbadaptor.SQLDatabaseAdaptor()
+    values = {'task_id': list(range(1, rows + 1)),
+              'mtime': [int(time.time() * 1E7)] * rows}
+    where = {'wu_id': list(range(1, rows + 1)), 'last_turn': [100] * rows}
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for name, fun in [('per-row', legacy_updatem),
+                          ('executemany', adaptor.updatem)]:
+            db_name = os.path.join(tmp, name + '.db')
+            conn = prepare(adaptor, db_name, rows)
+            start = time.perf_counter()
+            fun(conn, 'sixtrack_wu', values, where)
+            elapsed = time.perf_counter() - start
+            conn.close()
+            results[name] = elapsed
+            print(f'{name:>12}: {rows} rows in {elapsed:.3f} s '
+                  f'({rows / elapsed:,.0f} rows/s)')
+    print(f'speed-up: {results["per-row"] / results["executemany"]:.1f}x')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
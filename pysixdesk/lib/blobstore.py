@@ -0,0 +1,191 @@
+import os
+import io
+import hashlib
+import logging
+import tempfile
+from abc import ABC, abstractmethod
+
+'''Content-addressed storage of the large binary data (compressed input and
+output files). The database only keeps a reference to the content: the
+prefix REF_PREFIX followed by the SHA-256 hex digest of the data.'''
+
+logger = logging.getLogger(__name__)
+
+REF_PREFIX = b'pysixdesk-blob:sha256:'
+
+# the blob store used by utils.compress_buf and utils.decompress_buf
+_active_store = None
+
+
+def is_ref(buf):
+    '''Check if the given buffer is a reference to a stored blob'''
+    return isinstance(buf, (bytes, bytearray, memoryview)) and\
+        bytes(buf[:len(REF_PREFIX)]) == REF_PREFIX
+
+
+def make_ref(key):
+    '''Build the reference stored in the database for a key'''
+    return REF_PREFIX + key.encode()
+
+
+def ref_key(buf):
+    '''Extract the key from a reference'''
+    return bytes(buf[len(REF_PREFIX):]).decode()
+
+
+class BlobStore(ABC):
+    '''The interface of the blob backends. The key of a blob is the SHA-256
+    hex digest of its content, so identical data is stored only once.'''
+
+    def __init__(self, min_size=0):
+        '''Constructor
+        Args:
+            min_size (int): The data smaller than this size (bytes) is kept
+            inline in the database
+        '''
+        self.min_size = int(min_size)
+
+    @staticmethod
+    def key(data):
+        return hashlib.sha256(data).hexdigest()
+
+    @abstractmethod
+    def put(self, data):
+        '''Store the data and return its key'''
+        pass
+
+    @abstractmethod
+    def get(self, key):
+        '''Return the data of the given key'''
+        pass
+
+    @abstractmethod
+    def exists(self, key):
+        pass
+
+    def open(self, key):
+        '''Return a binary file object to read the data of the given key'''
+        return io.BytesIO(self.get(key))
+
+    def size(self, key):
+        '''The size (bytes) of a stored blob'''
+        return len(self.get(key))
+
+
+class LocalBlobStore(BlobStore):
+    '''Blobs stored as files in a directory, split in sub-directories named
+    after the first characters of the key. To be used by the jobs, the
+    directory has to be on a file system shared with the worker nodes.'''
+
+    def __init__(self, root, fanout=2, min_size=0):
+        '''Constructor
+        Args:
+            root (str): The root directory of the store
+            fanout (int): The number of nested sub-directories, named after
+            two characters of the key each
+            min_size (int): See BlobStore
+        '''
+        super().__init__(min_size)
+        self.root = os.path.abspath(root)
+        self.fanout = int(fanout)
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        '''The file path of a key'''
+        parts = [key[2 * i:2 * i + 2] for i in range(self.fanout)]
+        return os.path.join(self.root, *parts, key)
+
+    def put(self, data):
+        key = self.key(data)
+        path = self.path(key)
+        if os.path.exists(path):
+            return key
+        dirname = os.path.dirname(path)
+        os.makedirs(dirname, exist_ok=True)
+        # write a temporary file and rename it, so a blob is never partial
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as f_out:
+                f_out.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return key
+
+    def get(self, key):
+        with self.open(key) as f_in:
+            return f_in.read()
+
+    def open(self, key):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            content = "The blob %s isn't found in %s!" % (key, self.root)
+            raise FileNotFoundError(content)
+        return open(path, 'rb')
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+
+# the available backends, selected by the 'type' option of the configuration
+backends = {'local': LocalBlobStore}
+
+
+def create_blob_store(config):
+    '''Create a blob store from its configuration, e.g.
+    {'type': 'local', 'root': '/path/to/blobs', 'min_size': 1024}'''
+    config = dict(config)
+    backend = config.pop('type', 'local')
+    if backend not in backends:
+        content = "Unknown blob store %s! Must be one of %s." % (
+            backend, ', '.join(backends.keys()))
+        raise ValueError(content)
+    return backends[backend](**config)
+
+
+def set_blob_store(store):
+    '''Set the blob store used to put and get the compressed data, a
+    BlobStore, a configuration dict or None to store the data inline'''
+    global _active_store
+    if store is not None and not isinstance(store, BlobStore):
+        store = create_blob_store(store)
+    _active_store = store
+
+
+def get_blob_store():
+    return _active_store
+
+
+def put(buf):
+    '''Store the buffer in the active blob store and return the reference,
+    the buffer is returned as it is without store or if it is small'''
+    store = _active_store
+    if store is None or len(buf) < store.min_size:
+        return buf
+    return make_ref(store.put(buf))
+
+
+def _check_store(buf):
+    if _active_store is None:
+        content = "A blob store is needed to read the blob %s!" % ref_key(buf)
+        raise RuntimeError(content)
+
+
+def get(buf):
+    '''Return the data of a reference, other buffers are returned as they
+    are'''
+    if not is_ref(buf):
+        return buf
+    _check_store(buf)
+    return _active_store.get(ref_key(buf))
+
+
+def open_ref(buf):
+    '''Return a binary file object to read the data of a reference'''
+    _check_store(buf)
+    return _active_store.open(ref_key(buf))
@@ -1,6 +1,8 @@
 import sqlite3
 import pymysql
 import logging
+import itertools
+from collections import OrderedDict
 from collections.abc import Iterable
 from contextlib import closing
 from abc import ABC, abstractmethod
@@ -8,6 +10,12 @@ from abc import ABC, abstractmethod
 
 class DatabaseAdaptor(ABC):
 
+    # default number of rows sent to the database with one executemany call
+    chunksize = 10000
+    # number of values bound in one query, below the limit of old sqlite
+    # versions (999)
+    paramsize = 900
+
     def __init__(self):
         self._logger = logging.getLogger(__name__)
 
@@ -19,6 +27,28 @@ class DatabaseAdaptor(ABC):
     def setting(self, conn, settings):
         pass
 
+    @abstractmethod
+    def fetch_indexes(self, conn, table_name):
+        pass
+
+    @abstractmethod
+    def fetch_columns(self, conn, table_name):
+        pass
+
+    @abstractmethod
+    def migrate(self, conn, settings):
+        pass
+
+    def ping(self, conn):
+        '''Check if the connection is still alive'''
+        try:
+            with closing(conn.cursor()) as c:
+                c.execute('SELECT 1')
+                c.fetchall()
+            return True
+        except Exception:
+            return False
+
     def create_table(self, conn, name, columns, keys, recreate):
         '''Create a new table'''
         c = conn.cursor()
@@ -52,6 +82,64 @@ class DatabaseAdaptor(ABC):
         c.execute(sql_cmd)
         c.close()
         conn.commit()
+        if 'index' in keys.keys() and keys['index']:
+            self.create_indexes(conn, name, keys['index'], columns)
+
+    def create_indexes(self, conn, table_name, indexes, columns=None):
+        '''Create the secondary indexes of a table which don't exist yet
+        @conn A connection of database
+        @table_name(str) The table name
+        @indexes(list) The lists of indexed columns, e.g. [['status'],
+        ['wu_id', 'last_turn']]
+        @columns(dict) The column types of the table
+        @return(list) The names of the new indexes
+        '''
+        exist = self.fetch_indexes(conn, table_name)
+        news = []
+        with closing(conn.cursor()) as c:
+            for cols in indexes:
+                idx_name = self.index_name(table_name, cols)
+                if idx_name in exist:
+                    continue
+                fill = ','.join([self.index_column(i.replace('.', '_'),
+                                                   columns) for i in cols])
+                sql = 'CREATE INDEX %s ON %s (%s)' % (idx_name, table_name,
+                                                      fill)
+                c.execute(sql)
+                news.append(idx_name)
+        conn.commit()
+        return news
+
+    def add_columns(self, conn, table_name, columns):
+        '''Add the columns which don't exist yet to a table
+        @conn A connection of database
+        @table_name(str) The table name
+        @columns(dict) The column types of the table
+        @return(list) The names of the new columns
+        '''
+        exist = self.fetch_columns(conn, table_name)
+        news = []
+        with closing(conn.cursor()) as c:
+            for col, col_type in columns.items():
+                col = col.replace('.', '_')
+                if col in exist:
+                    continue
+                sql = 'ALTER TABLE %s ADD COLUMN %s %s' % (table_name, col,
+                                                           col_type)
+                c.execute(sql)
+                news.append(col)
+        conn.commit()
+        return news
+
+    @staticmethod
+    def index_name(table_name, columns):
+        '''The name of the index on the given columns of a table'''
+        cols = [i.replace('.', '_') for i in columns]
+        return 'idx_%s_%s' % (table_name, '_'.join(cols))
+
+    def index_column(self, column, columns=None):
+        '''The column expression used in the index definition'''
+        return column
 
     def drop_table(self, conn, table_name):
         '''Drop an exist table'''
@@ -96,6 +184,9 @@ class DatabaseAdaptor(ABC):
         cols = ','.join(keys)
         ques = ','.join((ph,) * len(keys))
         sql_cmd = sql % (table_name, cols, ques)
+        # the drivers take python values, the typed (numpy) columns are
+        # converted in one go
+        vals = [i.tolist() if hasattr(i, 'tolist') else i for i in vals]
         vals = list(zip(*vals))
         with closing(conn.cursor()) as c:
             c.executemany(sql_cmd, vals)
@@ -113,6 +204,66 @@ class DatabaseAdaptor(ABC):
         '''
         if len(cols) == 0:
             return []
+        sql = self.select_sql(table_name, cols, where, orderby, **kwargs)
+        with closing(conn.cursor()) as c:
+            c.execute(sql)
+            data = c.fetchall()
+        return data
+
+    def select_batches(self, conn, table_name, cols='*', where=None,
+                       orderby=None, batch_size=None, description=None,
+                       **kwargs):
+        '''Select values with conditions and generate them batch by batch
+        with fetchmany, so only one batch is held in memory
+        @batch_size(int) The number of rows per batch
+        @description(list) If given, the names of the selected columns are
+        appended to it when the query is executed
+        The other arguments are the same as select()
+        '''
+        if len(cols) == 0:
+            return
+        if batch_size is None:
+            batch_size = self.chunksize
+        sql = self.select_sql(table_name, cols, where, orderby, **kwargs)
+        with closing(self.stream_cursor(conn)) as c:
+            c.execute(sql)
+            if description is not None:
+                description.extend([i[0] for i in c.description])
+            while True:
+                data = c.fetchmany(batch_size)
+                if not data:
+                    break
+                yield data
+
+    def selectm(self, conn, table_name, cols, column, values, ph, **kwargs):
+        '''Select the rows whose column has one of the given values, the
+        values are bound as parameters in chunks
+        @column(str) The column name
+        @values(list) The values of the column
+        @ph The placeholder for the selected database, e.g. ?, %s
+        The other arguments are the same as select()
+        '''
+        if len(cols) == 0:
+            return []
+        values = list(values)
+        data = []
+        with closing(conn.cursor()) as c:
+            for i in range(0, len(values), self.paramsize):
+                chunk = values[i:i + self.paramsize]
+                where = '%s in (%s)' % (column.replace('.', '_'),
+                                        ','.join((ph,) * len(chunk)))
+                sql = self.select_sql(table_name, cols, where, **kwargs)
+                c.execute(sql, chunk)
+                data.extend(c.fetchall())
+        return data
+
+    def stream_cursor(self, conn):
+        '''The cursor used to stream the results of a query'''
+        return conn.cursor()
+
+    def select_sql(self, table_name, cols='*', where=None, orderby=None,
+                   **kwargs):
+        '''Build the select statement, see select() for the arguments'''
         if (isinstance(cols, Iterable) and not isinstance(cols, str)):
             cols = [i.replace('.', '_') for i in cols]
             cols = ','.join(cols)
@@ -127,10 +278,7 @@ class DatabaseAdaptor(ABC):
             sql += ' ORDER BY %s' % (','.join(orderby))
         if 'limit' in kwargs.keys() and kwargs['limit']:
             sql += ' limit %s' % kwargs['limit']
-        with closing(conn.cursor()) as c:
-            c.execute(sql)
-            data = c.fetchall()
-        return data
+        return sql
 
     def update(self, conn, table_name, values, where, ph):
         '''Update data in a table
@@ -157,7 +305,8 @@ class DatabaseAdaptor(ABC):
             c.execute(sql_cmd, vals)
         conn.commit()
 
-    def updatem(self, conn, table_name, values, where, ph):
+    def updatem(self, conn, table_name, values, where, ph, chunksize=None,
+                progress=None):
         '''Update multi data in a table
         @conn A connection of database
         @table_name(str) The table name
@@ -165,28 +314,38 @@ class DatabaseAdaptor(ABC):
         @where(dict) Selection conditions for updating values
         with one-to-one mapping
         @ph The placeholder for the selected database, e.g. ?, %s
+        @chunksize(int) The number of rows sent with each executemany call,
+        all the chunks are committed in one transaction
+        @progress(callable) Called with the number of rows of each chunk once
+        the chunk is executed
         '''
 
         if len(values) == 0:
             return
-        sql = 'UPDATE %s SET %s where %s'
-        keys = values.keys()
-        keys = [i.replace('.', '_') for i in keys]
+        if chunksize is None:
+            chunksize = self.chunksize
+        sql = 'UPDATE %s SET %s WHERE %s'
+        keys = list(values.keys())
         vals = [values[key] for key in keys]
-        valsn = zip(*vals)
-        keys_where = where.keys()
-        keys_where = [i.replace('.', '_') for i in keys_where]
+        keys = [i.replace('.', '_') for i in keys]
+        keys_where = list(where.keys())
         vals_where = [where[key] for key in keys_where]
-        vals_wheren = zip(*vals_where)
-        for val, val_where in zip(valsn, vals_wheren):
-            ques = (ph,) * len(keys)
-            sets = ['='.join(it) for it in zip(keys, ques)]
-            sets = ','.join(sets)
-            sets_where = ['='.join(map(str,it)) for it in zip(keys_where, val_where)]
-            sets_where = ' and '.join(sets_where)
-            sql_cmd = sql % (table_name, sets, sets_where)
+        keys_where = [i.replace('.', '_') for i in keys_where]
+        sets = ','.join(['%s=%s' % (key, ph) for key in keys])
+        sets_where = ' and '.join(['%s=%s' % (key, ph) for key in keys_where])
+        sql_cmd = sql % (table_name, sets, sets_where)
+        rows = zip(*(vals + vals_where))
+        try:
             with closing(conn.cursor()) as c:
-                c.execute(sql_cmd, val)
+                chunk = list(itertools.islice(rows, chunksize))
+                while chunk:
+                    c.executemany(sql_cmd, chunk)
+                    if progress is not None:
+                        progress(len(chunk))
+                    chunk = list(itertools.islice(rows, chunksize))
+        except Exception:
+            conn.rollback()
+            raise
         conn.commit()
 
     def delete(self, conn, table_name, where):
@@ -200,9 +359,54 @@ class DatabaseAdaptor(ABC):
             c.execute(sql)
         conn.commit()
 
+    def deletem(self, conn, table_name, where, ph):
+        '''Remove multiple rows once
+        @conn A connection of database
+        @table_name(str) The table name
+        @where(dict) The column names with the values of the removed rows,
+        with one-to-one mapping
+        @ph The placeholder for the selected database, e.g. ?, %s
+        '''
+        if len(where) == 0:
+            return
+        keys = list(where.keys())
+        vals = [where[key] for key in keys]
+        keys = [i.replace('.', '_') for i in keys]
+        sets_where = ' and '.join(['%s=%s' % (key, ph) for key in keys])
+        sql_cmd = 'DELETE FROM %s WHERE %s' % (table_name, sets_where)
+        with closing(conn.cursor()) as c:
+            c.executemany(sql_cmd, list(zip(*vals)))
+        conn.commit()
+
 
 class SQLDatabaseAdaptor(DatabaseAdaptor):
 
+    # Named pragma profiles accepted by setting() and migrate().
+    # 'concurrent-read' uses a write-ahead log, which requires a local file
+    # system (not AFS/NFS) to share memory between the connections.
+    profiles = {
+        'safe': OrderedDict([
+            ('foreign_keys', 'on'),
+            ('journal_mode', 'delete'),
+            ('synchronous', 'full'),
+            ('auto_vacuum', 'full'),
+            ('temp_store', 'memory')]),
+        'bulk-load': OrderedDict([
+            ('foreign_keys', 'on'),
+            ('journal_mode', 'memory'),
+            ('synchronous', 'off'),
+            ('auto_vacuum', 'none'),
+            ('temp_store', 'memory'),
+            ('cache_size', -200000)]),
+        'concurrent-read': OrderedDict([
+            ('foreign_keys', 'on'),
+            ('journal_mode', 'wal'),
+            ('synchronous', 'normal'),
+            ('auto_vacuum', 'incremental'),
+            ('temp_store', 'memory'),
+            ('cache_size', -200000)]),
+    }
+
     def __init__(self):
         super().__init__()
 
@@ -214,13 +418,55 @@ class SQLDatabaseAdaptor(DatabaseAdaptor):
         return conn
 
     def setting(self, conn, settings):
-        '''Execute the settings of the database via pragma command'''
+        '''Execute the settings of the database via pragma command
+        @settings(dict or str) The pragma values or the name of a profile
+        '''
+        settings = self.get_profile(settings)
         with closing(conn.cursor()) as c:
             for key, value in settings.items():
                 sql = 'PRAGMA %s=%s' % (key, str(value))
                 c.execute(sql)
         conn.commit()
 
+    def get_profile(self, settings):
+        '''Return the pragma values of the given profile name, a dict of
+        settings is returned as it is'''
+        if not isinstance(settings, str):
+            return settings
+        if settings not in self.profiles:
+            content = "Unknown database profile %s! Must be one of %s." % (
+                settings, ', '.join(self.profiles.keys()))
+            raise ValueError(content)
+        return self.profiles[settings]
+
+    def migrate(self, conn, settings):
+        '''Switch an existing database to the given settings or profile.
+        Unlike setting(), the persistent properties are converted as well:
+        the journal mode is stored in the file and a change of auto_vacuum
+        from or to 'none' only takes effect after rebuilding the file.
+        '''
+        settings = self.get_profile(settings)
+        modes = ['none', 'full', 'incremental']
+        with closing(conn.cursor()) as c:
+            c.execute('PRAGMA auto_vacuum')
+            old_vacuum = modes[c.fetchone()[0]]
+        conn.commit()
+        self.setting(conn, settings)
+        new_vacuum = str(settings.get('auto_vacuum', old_vacuum)).lower()
+        if new_vacuum != old_vacuum and 'none' in [old_vacuum, new_vacuum]:
+            self._logger.info("Rebuilding the database for auto_vacuum=%s..."
+                              % new_vacuum)
+            with closing(conn.cursor()) as c:
+                c.execute('VACUUM')
+        if 'journal_mode' in settings:
+            with closing(conn.cursor()) as c:
+                c.execute('PRAGMA journal_mode')
+                mode = c.fetchone()[0]
+            if mode.lower() != str(settings['journal_mode']).lower():
+                content = "Failed to switch the journal mode to %s!" % (
+                    settings['journal_mode'])
+                self._logger.warning(content)
+
     def create_table(self, conn, name, columns, keys, recreate):
         '''Create a new table'''
         if 'autoincrement' in keys.keys():
@@ -240,6 +486,21 @@ class SQLDatabaseAdaptor(DatabaseAdaptor):
             out = c.fetchall()
         return list(out)
 
+    def fetch_indexes(self, conn, table_name):
+        '''Fetch the index names of a table'''
+        with closing(conn.cursor()) as c:
+            c.execute("SELECT name FROM sqlite_master WHERE type='index' and "
+                      "tbl_name=?", (table_name,))
+            out = c.fetchall()
+        return [i[0] for i in out]
+
+    def fetch_columns(self, conn, table_name):
+        '''Fetch the column names of a table'''
+        with closing(conn.cursor()) as c:
+            c.execute("PRAGMA table_info(%s)" % table_name)
+            out = c.fetchall()
+        return [i[1] for i in out]
+
     def insert(self, conn, table_name, values):
         '''Insert a row of values'''
         super(SQLDatabaseAdaptor, self).insert(conn, table_name, values, '?')
@@ -253,14 +514,27 @@ class SQLDatabaseAdaptor(DatabaseAdaptor):
         super(SQLDatabaseAdaptor, self).update(conn, table_name, values, where,
                                                '?')
 
-    def updatem(self, conn, table_name, values, where):
+    def updatem(self, conn, table_name, values, where, chunksize=None,
+                progress=None):
         '''update values'''
         super(SQLDatabaseAdaptor, self).updatem(conn, table_name, values, where,
-                                               '?')
+                                                '?', chunksize, progress)
+
+    def deletem(self, conn, table_name, where):
+        '''Remove multi rows'''
+        super(SQLDatabaseAdaptor, self).deletem(conn, table_name, where, '?')
+
+    def selectm(self, conn, table_name, cols, column, values, **kwargs):
+        '''Select the rows with the given values of a column'''
+        return super(SQLDatabaseAdaptor, self).selectm(
+            conn, table_name, cols, column, values, '?', **kwargs)
 
 
 class MySQLDatabaseAdaptor(DatabaseAdaptor):
 
+    # the prefix length of the indexes on text columns
+    index_prefix = 255
+
     def __init__(self):
         super().__init__()
 
@@ -300,6 +574,18 @@ class MySQLDatabaseAdaptor(DatabaseAdaptor):
     def setting(self, conn, settings):
         pass
 
+    def migrate(self, conn, settings):
+        pass
+
+    def ping(self, conn):
+        '''Check if the connection is still alive, reconnect if the server
+        has closed it'''
+        try:
+            conn.ping(reconnect=True)
+            return True
+        except Exception:
+            return False
+
     def create_user(self, conn, username, passwd, host='%'):
         '''Create a new user'''
         if self.check_user(conn, username):
@@ -368,6 +654,34 @@ class MySQLDatabaseAdaptor(DatabaseAdaptor):
             a = list(c)
         return a
 
+    def fetch_indexes(self, conn, table_name):
+        '''Fetch the index names of a table'''
+        with conn.cursor() as c:
+            c.execute("show index from %s" % table_name)
+            a = [i[2] for i in c]
+        return a
+
+    def fetch_columns(self, conn, table_name):
+        '''Fetch the column names of a table'''
+        with conn.cursor() as c:
+            c.execute("show columns from %s" % table_name)
+            a = [i[0] for i in c]
+        return a
+
+    def stream_cursor(self, conn):
+        '''An unbuffered cursor, the rows are read from the server on demand.
+        No other query can be executed on the connection before all the rows
+        are read or the cursor is closed.'''
+        return conn.cursor(pymysql.cursors.SSCursor)
+
+    def index_column(self, column, columns=None):
+        '''Text and blob columns can only be indexed with a prefix length'''
+        if columns is not None and column in columns.keys():
+            col_type = columns[column].lower()
+            if 'text' in col_type or 'blob' in col_type:
+                return '%s(%d)' % (column, self.index_prefix)
+        return column
+
     def insert(self, conn, table_name, values):
         '''Insert a row of values'''
         super(MySQLDatabaseAdaptor, self).insert(conn, table_name, values,
@@ -383,7 +697,19 @@ class MySQLDatabaseAdaptor(DatabaseAdaptor):
         super(MySQLDatabaseAdaptor, self).update(conn, table_name, values,
                                                  where, '%s')
 
-    def updatem(self, conn, table_name, values, where):
+    def updatem(self, conn, table_name, values, where, chunksize=None,
+                progress=None):
         '''update values'''
         super(MySQLDatabaseAdaptor, self).updatem(conn, table_name, values,
-                                                 where, '%s')
+                                                  where, '%s', chunksize,
+                                                  progress)
+
+    def deletem(self, conn, table_name, where):
+        '''Remove multi rows'''
+        super(MySQLDatabaseAdaptor, self).deletem(conn, table_name, where,
+                                                  '%s')
+
+    def selectm(self, conn, table_name, cols, column, values, **kwargs):
+        '''Select the rows with the given values of a column'''
+        return super(MySQLDatabaseAdaptor, self).selectm(
+            conn, table_name, cols, column, values, '%s', **kwargs)
@@ -17,6 +17,8 @@ class Table(object):
         self.tables['templates'] = OrderedDict()
         self.tables['env'] = OrderedDict()
         self.tables['boinc_vars'] = OrderedDict()
+        self.init_param_index_table()
+        self.init_gather_state_table()
         self.init_preprocess_tables()
         self.init_sixtrack_tables()
 
@@ -53,6 +55,27 @@ class Table(object):
         else:
             raise TypeError("Unsupported input type!")
 
+    def init_param_index_table(self):
+        '''The values of each parameter which are already materialised in
+        the work unit tables, stored as json strings'''
+        self.tables['param_index'] = OrderedDict([
+            ('table_name', 'text'),
+            ('param', 'text'),
+            ('value', 'text'),
+            ('mtime', 'bigint')])
+        self.table_keys['param_index'] = {}
+
+    def init_gather_state_table(self):
+        '''The result directories seen by the last collection of each job
+        type and their modification marks'''
+        self.tables['gather_state'] = OrderedDict([
+            ('jobtype', 'text'),
+            ('name', 'text'),
+            ('mtime', 'bigint')])
+        self.table_keys['gather_state'] = {
+            'index': [['jobtype', 'name']],
+        }
+
     def init_preprocess_tables(self):
         self.tables['preprocess_wu'] = OrderedDict([
             ('wu_id', 'INTEGER'),
@@ -66,6 +89,7 @@ class Table(object):
             'primary': ['wu_id'],
             'autoincrement': ['wu_id'],
             'foreign': {},
+            'index': [['status'], ['task_id'], ['batch_name'], ['unique_id']],
         }
         self.tables['preprocess_task'] = OrderedDict([
             ('task_id', 'INTEGER'),
@@ -75,12 +99,27 @@ class Table(object):
             ('job_stdout', 'MEDIUMBLOB'),
             ('job_stderr', 'blob'),
             ('job_stdlog', 'blob'),
+            ('wall_time', 'float'),
+            ('cpu_time', 'float'),
+            ('max_rss', 'bigint'),
+            ('madx_key', 'text'),
             ('status', 'text'),
             ('mtime', 'bigint')])
         self.table_keys['preprocess_task'] = {
             'primary': ['task_id'],
             'autoincrement': ['task_id'],
             'foreign': {'preprocess_wu': [['wu_id'], ['wu_id']]},
+            'index': [['wu_id'], ['status']],
+        }
+        # the madx outputs of the successful preprocess tasks by the key of
+        # their inputs (see utils.madx_cache_key), the output columns are
+        # added by the study
+        self.tables['madx_cache'] = OrderedDict([
+            ('cache_key', 'text'),
+            ('madx_stdout', 'blob'),
+            ('mtime', 'bigint')])
+        self.table_keys['madx_cache'] = {
+            'index': [['cache_key']],
         }
 
     def init_sixtrack_tables(self):
@@ -99,6 +138,8 @@ class Table(object):
         self.table_keys['sixtrack_wu'] = {
             'primary': ['wu_id', 'last_turn'],
             'foreign': {'preprocess_wu': [['preprocess_id'], ['wu_id']]},
+            'index': [['status'], ['task_id'], ['preprocess_id'],
+                      ['batch_name'], ['unique_id'], ['mtime']],
         }
         self.tables['sixtrack_task'] = OrderedDict([
             ('task_id', 'INTEGER'),
@@ -115,6 +156,9 @@ class Table(object):
             ('crpoint_pri_bin', 'MEDIUMBLOB'),
             ('crpoint_sec_bin', 'MEDIUMBLOB'),
             ('singletrackfile_dat', 'MEDIUMBLOB'),
+            ('wall_time', 'float'),
+            ('cpu_time', 'float'),
+            ('max_rss', 'bigint'),
             ('status', 'text'),
             ('mtime', 'bigint')])
         self.table_keys['sixtrack_task'] = {
@@ -122,6 +166,7 @@ class Table(object):
             'autoincrement': ['task_id'],
             'foreign': {'sixtrack_wu': [['wu_id', 'last_turn'],
                                         ['wu_id', 'last_turn']]},
+            'index': [['wu_id', 'last_turn'], ['status']],
         }
         self.tables['six_results'] = OrderedDict([
             ('task_id', 'int'),
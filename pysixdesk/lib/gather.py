@@ -3,15 +3,24 @@ import re
 import os
 import time
 import gzip
-import copy
 import shutil
 import getpass
 import zipfile
 import logging
+from collections import OrderedDict
+from concurrent.futures import (ProcessPoolExecutor, FIRST_COMPLETED,
+                                as_completed, wait)
 
+from . import utils
+from . import blobstore
 from .pysixdb import SixDB
 from .resultparser import parse_results
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 logger = logging.getLogger(__name__)
 
 
@@ -49,13 +58,27 @@ def gather_results(jobtype, cf, cluster):
         return
     set_sec = cf['db_setting']
     db_info = cf['db_info']
-    db = SixDB(db_info, settings=set_sec, create=False)
+    db = SixDB(db_info, settings=set_sec, create=False,
+               pool=info_sec.get('db_pool'))
     file_list = info_sec['outs']
+    studypath = os.path.dirname(type_path)
+    boinc = ('boinc' in cf['info'].keys()) and cf['info']['boinc']
+    incremental = info_sec.get('incremental', False) and not boinc
+    if incremental:
+        # the results of the spooled jobs only show up after the transfer
+        cluster.download_from_spool(studypath)
+        item_groups, marks = scan_new_dirs(db, jobtype, type_path)
+        if not item_groups:
+            content = f"No new {jobtype} results since the last collection!"
+            logger.info(content)
+            db.close()
+            return
+    else:
+        item_groups = os.listdir(type_path)
     where = "status='submitted'"
     job_ids = db.select(f'{jobtype}_wu', ['task_id', 'unique_id'], where)
     job_ids = [(str(i), str(j)) for i, j in job_ids]
     job_index = dict(job_ids)
-    studypath = os.path.dirname(type_path)
     unfin = cluster.check_running(studypath)#clusterId.processId
     jbin = dict(job_index)
     running_jobs = [taid for taid, unid in jbin.items() if unid in unfin]
@@ -64,9 +87,11 @@ def gather_results(jobtype, cf, cluster):
         content = f"{len(running_jobs)} {jobtype} tasks aren't completed yet!"
         logger.warning(content)
     valid_task_ids = list(job_index.keys())
-    cluster.download_from_spool(studypath)
+    if not incremental:
+        # else already done before the scan
+        cluster.download_from_spool(studypath)
 
-    if ('boinc' in cf['info'].keys()) and cf['info']['boinc']:
+    if boinc:
         content = "Downloading results from boinc spool!"
         logger.info(content)
         task_ids = download_from_boinc(info_sec)
@@ -78,59 +103,344 @@ def gather_results(jobtype, cf, cluster):
             logger.warning(content)
         valid_task_ids = task_ids
 
-    parent_cf = {}
-    for sec in cf:
-        parent_cf[sec] = cf[sec]
-    coll_action = False
-    for item_group in os.listdir(type_path):
+    # the schemas of the result tables, filled by the parser for each task
+    tables = OrderedDict([(i, cf[i]) for i in file_list.values() if i in cf])
+    tasks = []
+    job_paths = []
+    # the directories with tasks which aren't collected now, e.g. running
+    skipped = set()
+    for item_group in item_groups:
         item_list = item_group.split('-')
         job_path = os.path.join(type_path, item_group)
+        job_paths.append(job_path)
         for item in item_list:
-            if item not in valid_task_ids:
-                continue
-            result_cf = copy.deepcopy(parent_cf)
-            job_table = {}
-            task_table = {}
-            task_table['status'] = 'Success'
-            if os.path.isdir(job_path) and os.listdir(job_path):
-                # parse the results
-                parse_results(jobtype, item, job_path, file_list, task_table,
-                              result_cf)
-                coll_action = True
-                where = 'task_id=%s' % item
-                db.update(f'{jobtype}_task', task_table, where)
-                for sec, vals in result_cf.items():
-                    vals['task_id'] = [item]*len(vals['mtime'])
-                    db.insertm(sec, vals)
-                if task_table['status'] == 'Success':
-                    job_table['status'] = 'complete'
-                    job_table['mtime'] = int(time.time() * 1E7)
-                    where = "task_id=%s" % item
-                    db.update(f'{jobtype}_wu', job_table, where)
-                    content = f"{jobtype} task {item} has completed normally!"
-                    logger.info(content)
-                else:
-                    where = "task_id=%s" % item
-                    job_table['status'] = 'incomplete'
-                    db.update(f'{jobtype}_wu', job_table, where)
+            if item in valid_task_ids:
+                tasks.append((item, job_path))
             else:
-                where = 'task_id=%s' % item
-                task_table['status'] = 'Failed'
-                db.update(f'{jobtype}_task', task_table, where)
-                content = "This is a failed job!"
-                logger.warning(content)
+                skipped.add(item_group)
+
+    workers = int(info_sec.get('workers', 1) or 1)
+    arrays = info_sec.get('parse_arrays', False)
+    if workers > 1 and len(tasks) > 1:
+        outcomes = harvest_parallel(jobtype, tasks, file_list, tables,
+                                    workers, info_sec.get('max_pending'),
+                                    cf.get('blob_store'), cf.get('codec'),
+                                    arrays)
+    else:
+        outcomes = (harvest(jobtype, item, job_path, file_list, tables,
+                            arrays) for item, job_path in tasks)
+    # the results are written by this process only, in batches
+    batch = ResultBatch(db, jobtype, info_sec.get('batch_size'))
+
+    def clean(done):
+        for item, job_path in done:
             item_path = os.path.join(job_path, 'results', item)
             if os.path.exists(item_path):
                 shutil.rmtree(item_path)
+
+    for outcome in outcomes:
+        batch.add(*outcome)
+        if batch.full():
+            clean(batch.flush())
+    clean(batch.flush())
+    for job_path in job_paths:
         res_path = os.path.join(job_path, 'results')
         if os.path.isdir(res_path) and (not os.listdir(res_path)):
             shutil.rmtree(job_path)
-    if coll_action:
+    if incremental:
+        save_scan_marks(db, jobtype, type_path, marks, skipped)
+    if batch.collected:
         # remove the completed condor jobs (when using spool option)
         cluster.remove(studypath, 4)
     db.close()
 
 
+def dir_mark(path):
+    '''The modification mark of a result directory: the latest mtime (ns) of
+    the directory, of its results sub-directory and of the task directories
+    in it, any new output file changes one of them'''
+    mark = os.stat(path).st_mtime_ns
+    res_path = os.path.join(path, 'results')
+    if os.path.isdir(res_path):
+        mark = max(mark, os.stat(res_path).st_mtime_ns)
+        with os.scandir(res_path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    mark = max(mark, entry.stat().st_mtime_ns)
+    return mark
+
+
+def load_scan_marks(db, jobtype):
+    '''The marks of the result directories recorded by the last collection
+    of the job type'''
+    rows = db.select('gather_state', ['jobtype', 'name', 'mtime'])
+    return dict((name, mark) for typ, name, mark in rows if typ == jobtype)
+
+
+def scan_new_dirs(db, jobtype, type_path):
+    '''Find the result directories which are new or modified since the last
+    collection, according to the gather_state table
+    Returns:
+        tuple: (the names of the new directories, the marks of all the
+        directories)
+    '''
+    known = load_scan_marks(db, jobtype)
+    marks = {}
+    with os.scandir(type_path) as it:
+        for entry in it:
+            if entry.is_dir():
+                marks[entry.name] = dir_mark(entry.path)
+    news = [i for i, mark in marks.items() if known.get(i) != mark]
+    content = f"{len(news)} of {len(marks)} {jobtype} result directories "\
+        "are new or modified."
+    logger.info(content)
+    return news, marks
+
+
+def save_scan_marks(db, jobtype, type_path, marks, skipped=()):
+    '''Record the marks of the result directories seen by scan_new_dirs after
+    a collection, so the results written since the scan are found by the
+    next one. The directories with skipped tasks (still running or not
+    submitted yet) and the removed directories are dropped from the
+    gather_state table, they are scanned again by the next collection.'''
+    known = load_scan_marks(db, jobtype)
+    news = {}
+    for name, mark in marks.items():
+        if name in skipped:
+            continue
+        if os.path.isdir(os.path.join(type_path, name)):
+            news[name] = mark
+    olds = [i for i in known if i not in news]
+    if olds:
+        db.removem('gather_state', {'jobtype': [jobtype] * len(olds),
+                                    'name': olds})
+    changed = [i for i, mark in news.items() if i in known and
+               known[i] != mark]
+    if changed:
+        db.updatem('gather_state', {'mtime': [news[i] for i in changed]},
+                   {'jobtype': [jobtype] * len(changed), 'name': changed})
+    news = {i: mark for i, mark in news.items() if i not in known}
+    if news:
+        db.insertm('gather_state', {'jobtype': [jobtype] * len(news),
+                                    'name': list(news.keys()),
+                                    'mtime': list(news.values())})
+
+
+def harvest(jobtype, item, job_path, file_list, tables, arrays=False):
+    '''Parse and compress the results of a task, it runs in a worker process
+    in the parallel mode
+    Args:
+        tables (dict): The column types of the result tables
+        arrays (bool): Parse the numeric result files into typed numpy
+        columns (see resultparser.parse_array)
+    Returns:
+        tuple: (item, job_path, task_table, result_cf), result_cf is None if
+        the job produced no output
+    '''
+    task_table = {}
+    task_table['status'] = 'Success'
+    if os.path.isdir(job_path) and os.listdir(job_path):
+        result_cf = OrderedDict([(i, OrderedDict(j)) for i, j in
+                                 tables.items()])
+        parse_results(jobtype, item, job_path, file_list, task_table,
+                      result_cf, arrays)
+        return item, job_path, task_table, result_cf
+    task_table['status'] = 'Failed'
+    return item, job_path, task_table, None
+
+
+def init_worker(blob_store=None, codec=None):
+    '''Set the blob store and the codec in a worker process, they aren't
+    inherited if the process is spawned instead of forked'''
+    blobstore.set_blob_store(blob_store)
+    utils.set_codec(codec)
+
+
+def harvest_parallel(jobtype, tasks, file_list, tables, workers,
+                     max_pending=None, blob_store=None, codec=None,
+                     arrays=False):
+    '''Harvest the tasks in a pool of worker processes and generate the
+    outcomes as they complete. At most max_pending tasks (default twice the
+    number of workers) are queued, so the parsed results waiting for the
+    writer stay bounded. The workers store the compressed files with the
+    given blob_store and codec configurations (see init_worker).'''
+    if max_pending is None:
+        max_pending = 2 * workers
+    max_pending = max(int(max_pending), 1)
+    content = f"Harvesting {len(tasks)} {jobtype} tasks with {workers} "\
+        "processes..."
+    logger.info(content)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(blob_store, codec)) as executor:
+        pending = set()
+        for item, job_path in tasks:
+            pending.add(executor.submit(harvest, jobtype, item, job_path,
+                                        file_list, tables, arrays))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
+
+
+class ColumnBuffer(object):
+    '''A column of a result table filled by many tasks. The typed parts
+    (numpy arrays, see resultparser.parse_array) are copied into a
+    preallocated array of their type, which is reused after each flush. It
+    falls back to a list once a part isn't typed, e.g. the strings of the
+    line by line parser.'''
+
+    def __init__(self, tasks=1):
+        '''Constructor
+        Args:
+            tasks (int): The expected number of tasks per flush, the array
+            is preallocated for as many parts as the first one
+        '''
+        self.tasks = max(int(tasks), 1)
+        self.array = None
+        self.size = 0
+        self.values = None
+
+    def extend(self, part):
+        '''Append the values of a task'''
+        typed = np is not None and isinstance(part, np.ndarray)
+        if typed and self.values is None and (
+                self.array is None or self.array.dtype == part.dtype):
+            end = self.size + len(part)
+            if self.array is None:
+                self.array = np.empty(max(end * self.tasks, 1),
+                                      dtype=part.dtype)
+            elif end > len(self.array):
+                array = np.empty(max(end, 2 * len(self.array)),
+                                 dtype=self.array.dtype)
+                array[:self.size] = self.array[:self.size]
+                self.array = array
+            self.array[self.size:end] = part
+            self.size = end
+            return
+        if self.values is None:
+            self.values = self.array[:self.size].tolist() if\
+                self.array is not None else []
+            self.array = None
+        self.values.extend(part.tolist() if typed else part)
+
+    def column(self):
+        '''The values appended since the last clear, an array view if they
+        are all typed'''
+        if self.values is not None:
+            return self.values
+        if self.array is None:
+            return []
+        return self.array[:self.size]
+
+    def __len__(self):
+        return self.size if self.values is None else len(self.values)
+
+    def clear(self):
+        '''Drop the values, the array is kept for the next flush'''
+        self.size = 0
+        self.values = None
+
+
+class ResultBatch(object):
+    '''Accumulate the outcomes of many tasks and write them with one
+    statement per table: the result rows are appended to the column buffers
+    of each result table (see ColumnBuffer), the task and work unit updates
+    are grouped by the updated columns.'''
+
+    def __init__(self, db, jobtype, size=None):
+        '''Constructor
+        Args:
+            db (SixDB): The database to write into
+            jobtype (str): 'preprocess' or 'sixtrack'
+            size (int): The number of tasks per flush
+        '''
+        self.db = db
+        self.jobtype = jobtype
+        self.size = int(size) if size else 200
+        self.collected = False
+        # the column buffers of the result tables, kept between the flushes
+        self.results = OrderedDict()
+        self._reset()
+
+    def _reset(self):
+        self.tasks = []
+        for table in self.results.values():
+            for buf in table.values():
+                buf.clear()
+        self.task_updates = OrderedDict()
+        self.complete = []
+        self.incomplete = []
+
+    def add(self, item, job_path, task_table, result_cf):
+        '''Add the outcome of a task'''
+        self.tasks.append((item, job_path))
+        cols = tuple(task_table.keys())
+        updates = self.task_updates.setdefault(cols, ([], []))
+        updates[0].append([task_table[i] for i in cols])
+        updates[1].append(item)
+        if result_cf is None:
+            content = "This is a failed job!"
+            logger.warning(content)
+            return
+        self.collected = True
+        for sec, vals in result_cf.items():
+            table = self.results.setdefault(sec, OrderedDict())
+            rows = len(vals['mtime'])
+            if np is not None and isinstance(vals['mtime'], np.ndarray):
+                vals['task_id'] = np.full(rows, int(item), dtype=np.int64)
+            else:
+                vals['task_id'] = [item]*rows
+            for key, val in vals.items():
+                if key not in table:
+                    table[key] = ColumnBuffer(self.size)
+                table[key].extend(val)
+        if task_table['status'] == 'Success':
+            self.complete.append(item)
+        else:
+            self.incomplete.append(item)
+
+    def full(self):
+        return len(self.tasks) >= self.size
+
+    def flush(self):
+        '''Write the accumulated outcomes in one transaction
+        Returns:
+            list: The (item, job_path) of the written tasks
+        '''
+        jobtype = self.jobtype
+        with self.db.transaction():
+            for cols, (rows, items) in self.task_updates.items():
+                values = OrderedDict(zip(cols, zip(*rows)))
+                self.db.updatem(f'{jobtype}_task', values,
+                                {'task_id': items})
+            for sec, table in self.results.items():
+                if not len(table['mtime']):
+                    continue
+                vals = OrderedDict((key, buf.column()) for key, buf in
+                                   table.items())
+                self.db.insertm(sec, vals)
+            if self.complete:
+                mtime = int(time.time() * 1E7)
+                num = len(self.complete)
+                self.db.updatem(f'{jobtype}_wu',
+                                {'status': ['complete'] * num,
+                                 'mtime': [mtime] * num},
+                                {'task_id': self.complete})
+            if self.incomplete:
+                num = len(self.incomplete)
+                self.db.updatem(f'{jobtype}_wu',
+                                {'status': ['incomplete'] * num},
+                                {'task_id': self.incomplete})
+        for item in self.complete:
+            content = f"{jobtype} task {item} has completed normally!"
+            logger.info(content)
+        done = self.tasks
+        self._reset()
+        return done
+
+
 def download_from_boinc(info_sec):
     '''Download results from boinc'''
     task_ids = []
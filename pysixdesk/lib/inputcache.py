@@ -0,0 +1,228 @@
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from . import utils
+from . import blobstore
+
+'''Node-local cache of the decompressed input files of the jobs. A file is
+stored once under the key of its compressed content (see InputCache.key) and
+is linked into the folders of the jobs. An index records the key of the
+immutable database buffers, e.g. the outputs of a preprocess task, so a job
+finding them in the cache fetches nothing from the database.'''
+
+logger = logging.getLogger(__name__)
+
+# the environment variable setting the directory of the cache on a node
+CACHE_DIR_ENV = 'PYSIXDESK_CACHE_DIR'
+# the file marking a cache whose files are symbolic-linked by the jobs
+SYMLINKED = 'symlinked'
+
+
+def _atomic_write(path, data):
+    '''Write a file through a temporary file, so it's never partial'''
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as f_out:
+            f_out.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class InputCache(object):
+    '''The decompressed files are in <root>/data and the index in
+    <root>/index. The least recently used files are evicted when the cache
+    exceeds max_size. Several jobs can share the cache, the files are written
+    atomically and a file hard-linked by a job isn't evicted. Nothing is
+    evicted once a job had to use a symbolic link (the cache is on another
+    file system), the files in use can't be told apart then.'''
+
+    def __init__(self, root, max_size=None, namespace=None):
+        '''Constructor
+        Args:
+            root (str): The directory of the cache, the environment variables
+            are expanded, e.g. $_CONDOR_SCRATCH_DIR/cache
+            max_size (int): The maximum size (bytes) of the cached files, no
+            limit if None
+            namespace (str): The identifier of the study, which scopes the
+            index, no index is used without it
+        '''
+        self.root = os.path.abspath(os.path.expandvars(str(root)))
+        if max_size in (None, '', 'None'):
+            self.max_size = None
+        else:
+            self.max_size = int(float(max_size))
+        self.namespace = namespace or None
+        # the size of the cached files, counted from the first put on
+        self._total = None
+        os.makedirs(os.path.join(self.root, 'data'), exist_ok=True)
+        os.makedirs(os.path.join(self.root, 'index'), exist_ok=True)
+
+    @staticmethod
+    def key(buf):
+        '''The key of a compressed buffer, the key of the blob for a blob
+        reference'''
+        if blobstore.is_ref(buf):
+            return blobstore.ref_key(buf)
+        return hashlib.sha256(buf).hexdigest()
+
+    def path(self, key):
+        '''The path of the decompressed file of a key'''
+        return os.path.join(self.root, 'data', key[:2], key)
+
+    def _index_path(self, name):
+        digest = hashlib.sha256(f'{self.namespace}/{name}'.encode())
+        return os.path.join(self.root, 'index', digest.hexdigest())
+
+    def lookup(self, name):
+        '''Return the key recorded for the name if its file is cached'''
+        if self.namespace is None:
+            return None
+        try:
+            with open(self._index_path(name), 'r') as f_in:
+                key = f_in.read().strip()
+        except FileNotFoundError:
+            return None
+        if not os.path.isfile(self.path(key)):
+            return None
+        return key
+
+    def record(self, name, key):
+        '''Record the key of an immutable buffer of the database, e.g.
+        name='preprocess_task/12/fort.2' '''
+        if self.namespace is not None:
+            _atomic_write(self._index_path(name), key.encode())
+
+    def put(self, buf):
+        '''Decompress the buffer into the cache, unless it's already there,
+        and return its key'''
+        key = self.key(buf)
+        path = self.path(key)
+        if os.path.isfile(path):
+            return key
+        dirname = os.path.dirname(path)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp_')
+        os.close(fd)
+        try:
+            utils.decompress_buf(buf, tmp, des='file')
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if self.max_size is not None:
+            # the cache is only walked when it's full
+            if self._total is None:
+                self._total = self.size()
+            else:
+                self._total += os.path.getsize(path)
+            if self._total > self.max_size:
+                self.evict(keep=key)
+        return key
+
+    def materialize(self, key, dest, link=True):
+        '''Create the file dest with the content of a key, as a hard link or
+        as a symbolic link if the cache is on another file system. The file
+        is copied if link is False, e.g. if the job overwrites it.
+        Raises:
+            FileNotFoundError: If the file of the key isn't cached (anymore).
+        '''
+        src = self.path(key)
+        # the modification time orders the eviction
+        os.utime(src)
+        if os.path.lexists(dest):
+            os.remove(dest)
+        if not link:
+            shutil.copyfile(src, dest)
+            return
+        try:
+            os.link(src, dest)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            # the links don't count, stop the eviction
+            _atomic_write(os.path.join(self.root, SYMLINKED), b'')
+            os.symlink(src, dest)
+
+    def fetch(self, buf, dest, link=True, attempts=3):
+        '''Put the buffer into the cache and materialize it as dest, again if
+        another job evicted its file in between
+        Returns:
+            str: The key of the buffer
+        '''
+        for attempt in range(attempts):
+            key = self.put(buf)
+            try:
+                self.materialize(key, dest, link)
+                return key
+            except FileNotFoundError:
+                if attempt == attempts - 1:
+                    raise
+
+    def size(self):
+        '''The total size (bytes) of the cached files'''
+        return sum(i[1] for i in self._entries())
+
+    def _entries(self):
+        entries = []
+        for dirpath, _, names in os.walk(os.path.join(self.root, 'data')):
+            for name in names:
+                if name.startswith('.tmp_'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, stat.st_nlink,
+                                path))
+        return entries
+
+    def evict(self, keep=None):
+        '''Remove the least recently used files until the cache fits in
+        max_size. The file of the key keep and the files hard-linked by the
+        jobs are kept.'''
+        if self.max_size is None:
+            return
+        entries = self._entries()
+        total = sum(i[1] for i in entries)
+        self._total = total
+        if os.path.exists(os.path.join(self.root, SYMLINKED)):
+            content = "The input cache is linked with symbolic links, "\
+                "its files aren't evicted."
+            logger.debug(content)
+            return
+        keep = None if keep is None else self.path(keep)
+        for _, size, nlink, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if nlink > 1 or path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self._total = total
+            logger.debug("Evicted %s from the input cache." % path)
+
+
+def create_input_cache(config=None):
+    '''Create the cache from its configuration, e.g. {'path': '/tmp/cache',
+    'max_size': 2E9, 'namespace': '/path/to/study'}. The environment
+    variable PYSIXDESK_CACHE_DIR sets the path on a node. None is returned
+    without path.'''
+    config = dict(config or {})
+    path = config.pop('path', None)
+    path = os.environ.get(CACHE_DIR_ENV) or path
+    if not path:
+        return None
+    return InputCache(path, **config)
@@ -0,0 +1,114 @@
+import json
+import itertools
+from collections import OrderedDict
+from collections.abc import Iterable
+
+'''Incremental handling of the parameter space of the work unit tables'''
+
+
+def normalize(value):
+    '''Convert a parameter value to the form stored in the database,
+    iterable values (e.g. amplitude pairs) are stored as strings'''
+    if isinstance(value, Iterable) and not isinstance(value, str):
+        return str(value)
+    return value
+
+
+def dump_value(value):
+    '''Serialize a parameter value for the parameter index'''
+    return json.dumps(value)
+
+
+def load_value(value):
+    '''Restore a parameter value from the parameter index'''
+    return json.loads(value)
+
+
+class ParameterSpace(object):
+    '''The parameter space of a work unit table.
+    It keeps the requested values of every parameter and the values which
+    are already materialised in the database, and generates lazily the
+    cells of the product which are not in the database yet.'''
+
+    def __init__(self, requested, recorded=None):
+        '''Constructor.
+        @requested(dict) The requested values of each parameter (a single
+        value or an iterable of values)
+        @recorded(dict) The values of each parameter which are already
+        materialised in the database
+        '''
+        if recorded is None:
+            recorded = {}
+        self.keys = list(requested.keys())
+        self.recorded = OrderedDict()
+        self.values = OrderedDict()
+        for key in self.keys:
+            old = set(recorded.get(key, ()))
+            val = requested[key]
+            if not isinstance(val, Iterable) or isinstance(val, str):
+                val = [val]
+            # requested values first, then the recorded ones, no duplicates
+            values = OrderedDict.fromkeys(normalize(i) for i in val)
+            values.update(OrderedDict.fromkeys(recorded.get(key, ())))
+            self.recorded[key] = old
+            self.values[key] = list(values)
+
+    def new_values(self):
+        '''Return the values of each parameter which aren't recorded yet'''
+        news = OrderedDict()
+        for key in self.keys:
+            old = self.recorded[key]
+            news[key] = [i for i in self.values[key] if i not in old]
+        return news
+
+    def has_changes(self):
+        '''Check if there is any requested value which isn't recorded yet'''
+        return any(self.new_values().values())
+
+    def count_new(self):
+        '''Count the new cells of the cartesian product'''
+        total = 0
+        news = self.new_values()
+        for i, key in enumerate(self.keys):
+            size = len(news[key])
+            for k in self.keys[:i]:
+                size *= len(self.recorded[k])
+            for k in self.keys[i + 1:]:
+                size *= len(self.values[k])
+            total += size
+        return total
+
+    def new_cells(self, product=None):
+        '''Generate the new cells of the parameter space.
+        @product(callable) A custom product of the parameter values, which
+        gets an ordered dict of values and returns the iterable of cells.
+        If None, the cartesian product is used and only the new cells are
+        generated: a cell is new if at least one of its values is new, so the
+        new cells are split by the first parameter having a new value.
+        Otherwise the cells of the custom product are streamed and the same
+        rule is checked value by value, the cells (ordered as the keys) made
+        of recorded values only are already in the database.
+        '''
+        if product is not None:
+            return self._new_custom_cells(product)
+        return self._new_cartesian_cells()
+
+    def _new_custom_cells(self, product):
+        olds = [self.recorded[k] for k in self.keys]
+        for cell in product(self.values):
+            if not all(i in old for i, old in zip(cell, olds)):
+                yield cell
+
+    def _recorded_values(self, key):
+        old = self.recorded[key]
+        return [i for i in self.values[key] if i in old]
+
+    def _new_cartesian_cells(self):
+        news = self.new_values()
+        for i, key in enumerate(self.keys):
+            if not news[key]:
+                continue
+            axes = [self._recorded_values(k) for k in self.keys[:i]]
+            axes.append(news[key])
+            axes.extend(self.values[k] for k in self.keys[i + 1:])
+            yield from itertools.product(*axes)
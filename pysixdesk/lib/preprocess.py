@@ -5,17 +5,26 @@ import json
 import shutil
 import configparser
 import argparse
+import multiprocessing
 
 from pathlib import Path
 from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
 from pysixdesk.lib import utils
+from pysixdesk.lib import blobstore
 from pysixdesk.lib.dbtable import Table
 from pysixdesk.lib import generate_fort2
 from pysixdesk.lib.pysixdb import SixDB
 from pysixdesk.lib.resultparser import parse_results
 
 
+# the one turn sixtrack jobs and their fort.3 settings
+ONETURN_JOBS = [('first_oneturn', {'dp1': '.0', 'dp2': '.0', 'ition': '0'}),
+                ('second_oneturn', {'ition': '0'}),
+                ('beta_oneturn', {'dp1': '.0', 'dp2': '.0'})]
+
+
 class PreprocessJob:
     def __init__(self, task_id, input_info):
         '''Class to handle the execution of the preprocessing job.
@@ -32,11 +41,17 @@ class PreprocessJob:
         self._dest_path.mkdir(parents=True, exist_ok=True)
 
         self.task_id = task_id
+        # the resource usage of madx and sixtrack, see utils.run_process
+        self.job_stats = {}
         # read database config
         cf = configparser.ConfigParser()
         cf.optionxform = str
         cf.read(input_info)
         self.cf = cf
+        if cf.has_section('blob_store'):
+            blobstore.set_blob_store(dict(cf['blob_store']))
+        if cf.has_section('codec'):
+            utils.set_codec(dict(cf['codec']))
         self.db = SixDB(cf['db_info'].items())
         db_type = cf['db_info']['db_type']
         self.db_type = db_type.lower()
@@ -51,6 +66,10 @@ class PreprocessJob:
 
         self.madx_cfg = cf['madx']
         self.mask_cfg = dict(zip(mask_keys, outputs[0]))
+        # look for the madx outputs in the madx cache of the study
+        self.madx_cache = self.madx_cfg.getboolean('cache', fallback=False)
+        # the madx cache key of the successful madx run
+        self.madx_key = None
         self._decomp_templates()
 
         output_files = self.madx_cfg["output_files"]
@@ -199,19 +218,29 @@ class PreprocessJob:
 
         Args:
             output_file (str): File in which to write sixtrack's stdout.
+
+        Raises:
+            TimeoutError: If sixtrack exceeds the wall or the cpu timeout.
         """
-        # actually run
-        six_output = os.popen(self.six_cfg["sixtrack_exe"])
+        # actually run, the stdout is streamed to a file
+        stdout = 'sixtrack_stdout'
         self._logger.info('Sixtrack is running...')
-        # write stdout to file
-        outputlines = six_output.readlines()
-        self._logger.info('Sixtrack is done!')
-        # output_name = Path.cwd().parent / (job_name + '.output')
-
-        if outputlines and output_file is not None:
-            with open(output_file, 'w') as six_out:
-                six_out.writelines(outputlines)
-        elif output_file != 'fort.6':
+        stats = utils.run_process(self.six_cfg["sixtrack_exe"], stdout,
+                                  wall_timeout=self.six_cfg.get('wall_timeout'),
+                                  cpu_timeout=self.six_cfg.get('cpu_timeout'))
+        utils.add_process_stats(self.job_stats, stats)
+        if stats['timeout'] is not None:
+            content = "Sixtrack exceeded the %s timeout after %.1f s!" % (
+                stats['timeout'], stats['wall_time'])
+            raise TimeoutError(content)
+        self._logger.info('Sixtrack is done in %.1f s (cpu %.1f s)!' % (
+            stats['wall_time'], stats['cpu_time']))
+
+        if os.path.getsize(stdout) and output_file is not None:
+            os.replace(stdout, output_file)
+            return
+        os.remove(stdout)
+        if output_file != 'fort.6':
             # For some sixtrack version, the stdout will be automatically
             # written to fort.6
             shutil.copy2('fort.6', output_file)
@@ -235,6 +264,10 @@ class PreprocessJob:
             dl_list.extend(['_condor_stdout', '_condor_stderr'])
 
         try:
+            utils.write_process_stats(self.job_stats, self._dest_path)
+            if self.madx_key is not None:
+                key_file = self._dest_path / utils.MADX_KEY_FILE
+                key_file.write_text(self.madx_key)
             utils.download_output(dl_list, self._dest_path)
             content = f"All requested results have been stored in {self._dest_path}"
             self._logger.info(content)
@@ -253,8 +286,10 @@ class PreprocessJob:
         for sec in self.cf:
             result_cf[sec] = dict(self.cf[sec])
         filelist = Table.result_table(self.madx_out.values())
+        arrays = self.cf.has_section('sixtrack') and\
+            self.cf['sixtrack'].getboolean('parse_arrays', fallback=False)
         parse_results('preprocess', self.task_id, self._dest_path, filelist,
-                      task_table, result_cf)
+                      task_table, result_cf, arrays)
 
         self.db.update(f'preprocess_task', task_table,
                        f'task_id={self.task_id}')
@@ -347,17 +382,23 @@ class PreprocessJob:
             mask (str): mask file on which to run madx.
 
         Raises:
+            TimeoutError: If madx exceeds the wall or the cpu timeout.
             Exception: If 'finished normally' is not in Madx output.
         """
         exe = self.madx_cfg['madx_exe']
         command = exe + " " + mask
         self._logger.info("Calling madx %s" % exe)
         self._logger.info("MADX job is running...")
-        output = os.popen(command)
-        output = output.readlines()
-        with open('madx_stdout', 'w') as mad_out:
-            mad_out.writelines(output)
-        if 'finished normally' not in output[-2]:
+        stats = utils.run_process(command, 'madx_stdout',
+                                  wall_timeout=self.madx_cfg.get('wall_timeout'),
+                                  cpu_timeout=self.madx_cfg.get('cpu_timeout'))
+        utils.add_process_stats(self.job_stats, stats)
+        if stats['timeout'] is not None:
+            content = "MADX exceeded the %s timeout after %.1f s!" % (
+                stats['timeout'], stats['wall_time'])
+            raise TimeoutError(content)
+        output = utils.tail_lines('madx_stdout', 2)
+        if len(output) < 2 or 'finished normally' not in output[-2]:
             content = "MADX has not completed properly!"
             raise Exception(content)
         else:
@@ -370,12 +411,68 @@ class PreprocessJob:
         # replace placeholders
         ready_mask = 'madx_in'
         self.madx_prep(output_file=ready_mask)
-        # run job
-        self.madx_run(ready_mask)
+        madx_key = self.madx_cache_key(ready_mask)
+        if not self.madx_cache_load(madx_key):
+            # run job
+            self.madx_run(ready_mask)
         # check the output
         if not utils.check(self.madx_out):
             content = 'MADX output files not found.'
             raise FileNotFoundError(content)
+        self.madx_key = madx_key
+
+    def madx_cache_key(self, mask):
+        """Computes the madx cache key of the rendered mask.
+
+        Args:
+            mask (str): the rendered mask file.
+
+        Returns:
+            str: the key, None if the cache isn't used.
+        """
+        if not self.madx_cache:
+            return None
+        with open(mask, 'r') as f_in:
+            text = f_in.read()
+        # the identity of the executable computed by the study, the keys
+        # don't depend on the host running the job
+        exe_id = self.madx_cfg.get('exe_id')
+        if exe_id is None:
+            exe_id = utils.madx_exe_id(self.madx_cfg['madx_exe'])
+        return utils.madx_cache_key(text, exe_id,
+                                    list(self.madx_out.values()))
+
+    def madx_cache_load(self, madx_key):
+        """Writes the madx outputs and stdout found in the madx cache.
+
+        Args:
+            madx_key (str): the madx cache key of the rendered mask.
+
+        Returns:
+            bool: True if the outputs were found, then madx doesn't need to
+            run.
+        """
+        if madx_key is None:
+            return False
+        names = ['madx_stdout'] + list(self.madx_out.values())
+        self.db.open()
+        try:
+            rows = self.db.selectm('madx_cache', names, 'cache_key',
+                                   [madx_key], limit=1)
+        except Exception:
+            self._logger.warning("Can't read the madx cache!", exc_info=True)
+            return False
+        finally:
+            self.db.close()
+        if not rows:
+            return False
+        # the files are named as madx names them, see utils.check
+        files = ['madx_stdout'] + list(self.madx_out.keys())
+        for name, buf in zip(files, rows[0]):
+            utils.decompress_buf(buf, name)
+        self._logger.info("The MADX outputs are found in the cache, MADX "
+                          "is skipped!")
+        return True
 
     def new_fort2(self):
         '''Generate new fort.2 with aperture markers and survey and fort3.limit.
@@ -412,7 +509,7 @@ class PreprocessJob:
             self._logger.info('Sixtrack job %s has completed normally!' % job_name)
 
     def _sixtrack_job(self, job_name, **kwargs):
-        '''One turn sixtrack job.
+        '''One turn sixtrack job, run in the temp folder temp_<job_name>.
 
         Args:
             job_name (str): name of the sixtrack job.
@@ -420,7 +517,8 @@ class PreprocessJob:
             in fort_cfg.
         '''
         fort_dic = self.sixtrack_prep_cfg(**kwargs)
-        with self.sixtrack_temp_folder(symlink_parent=True):
+        with self.sixtrack_temp_folder(folder=f'temp_{job_name}',
+                                       symlink_parent=True):
             self.sixtrack_prep_job(fort_dic,
                                    source_prefix=Path.cwd().parent,
                                    output_file='fort.3')
@@ -428,27 +526,52 @@ class PreprocessJob:
             # check and move fort.10 file
             self.sixtrack_check(job_name)
 
-    def sixtrack_job(self):
-        ''''Controls sixtrack job execution.
-        '''
-
-        try:
-            self._sixtrack_job('first_oneturn', dp1='.0', dp2='.0', ition='0')
-        except Exception as e:
-            self._logger.error('SixTrack first oneturn failed.')
-            raise e
+    def sixtrack_job(self, workers=None):
+        '''Controls sixtrack job execution. The one turn jobs are
+        independent, they run at the same time in forked processes.
 
-        try:
-            self._sixtrack_job('second_oneturn', ition='0')
-        except Exception as e:
-            self._logger.error('SixTrack second oneturn failed.')
-            raise e
+        Args:
+            workers (int, optional): The maximum number of one turn jobs
+            running at the same time, the cpus of the slot by default (see
+            utils.slot_cpus).
 
-        try:
-            self._sixtrack_job('beta_oneturn', dp1='.0', dp2='.0')
-        except Exception as e:
-            self._logger.error('SixTrack beta oneturn failed.')
-            raise e
+        Raises:
+            Exception: The failure of the first failed job, in parallel once
+            all of them are done.
+        '''
+        if workers is None:
+            workers = utils.slot_cpus()
+        workers = max(1, min(int(workers), len(ONETURN_JOBS)))
+        errors = {}
+        if workers == 1:
+            for job_name, kwargs in ONETURN_JOBS:
+                try:
+                    self._sixtrack_job(job_name, **kwargs)
+                except Exception as e:
+                    content = 'SixTrack %s failed.' % job_name.replace('_', ' ')
+                    self._logger.error(content)
+                    raise e
+        else:
+            self._logger.info(f"Running the one turn jobs with {workers} "
+                              "processes")
+            # the job is handed to the workers by the initializer, with fork
+            # it isn't pickled (it holds the database connection)
+            context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                     initializer=_init_oneturn,
+                                     initargs=(self,)) as executor:
+                futures = [executor.submit(_run_oneturn, job_name, kwargs)
+                           for job_name, kwargs in ONETURN_JOBS]
+            for (job_name, _), future in zip(ONETURN_JOBS, futures):
+                if future.exception():
+                    errors[job_name] = future.exception()
+                else:
+                    utils.add_process_stats(self.job_stats, future.result())
+        for job_name, _ in ONETURN_JOBS:
+            if job_name in errors:
+                content = 'SixTrack %s failed.' % job_name.replace('_', ' ')
+                self._logger.error(content)
+                raise errors[job_name]
 
     def write_oneturnresult(self):
         '''Writes the oneturnresult file.
@@ -478,6 +601,23 @@ class PreprocessJob:
             f_out.write('\n')
 
 
+# the job running the one turn jobs in a worker process, see _init_oneturn
+_oneturn_job = None
+
+
+def _init_oneturn(job):
+    '''Set the job of the one turn jobs in a worker process'''
+    global _oneturn_job
+    _oneturn_job = job
+
+
+def _run_oneturn(job_name, kwargs):
+    '''Run a one turn job in a worker process, return its resource usage'''
+    _oneturn_job.job_stats = {}
+    _oneturn_job._sixtrack_job(job_name, **kwargs)
+    return _oneturn_job.job_stats
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('task_id', type=int,
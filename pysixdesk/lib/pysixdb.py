@@ -1,20 +1,164 @@
 import os
+import queue
 import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
 from . import dbadaptor
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class ConnectionPool(object):
+    '''A bounded pool of database connections. The connections are checked
+    (and reconnected for MySQL) before being handed out, and the idle ones
+    can be kept alive by a background thread. Use ConnectionPool.instance to
+    share one pool per database within a process.'''
+
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __init__(self, adaptor, conn_info, size=4, keepalive=None,
+                 timeout=None):
+        '''Constructor.
+        adaptor(DatabaseAdaptor): the adaptor creating the connections
+        conn_info(dict): the arguments of adaptor.new_connection
+        size(int): the maximum number of connections
+        keepalive(float): if given, ping the idle connections every keepalive
+                          seconds, only for MySQL: the sqlite connections
+                          don't time out and can't be used from the
+                          keep-alive thread
+        timeout(float): the maximum waiting time for a free connection, wait
+                        forever if None
+        '''
+        self._logger = logging.getLogger(__name__)
+        self.adaptor = adaptor
+        self.conn_info = dict(conn_info)
+        self.size = size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self._stop = threading.Event()
+        self._keeper = None
+        if keepalive and isinstance(adaptor, dbadaptor.MySQLDatabaseAdaptor):
+            self._keeper = threading.Thread(target=self._keep_alive,
+                                            args=(keepalive,), daemon=True)
+            self._keeper.start()
+
+    @classmethod
+    def instance(cls, adaptor, conn_info, **kwargs):
+        '''Return the pool of the given database for the current process,
+        create it if it doesn't exist yet'''
+        key = (os.getpid(), type(adaptor).__name__,
+               tuple(sorted((k, str(v)) for k, v in conn_info.items())))
+        with cls._lock:
+            pool = cls._instances.get(key)
+            if pool is None:
+                pool = cls(adaptor, conn_info, **kwargs)
+                cls._instances[key] = pool
+        return pool
+
+    def acquire(self):
+        '''Get a live connection from the pool'''
+        if not self._slots.acquire(timeout=self.timeout):
+            content = "No free database connection in the pool!"
+            raise TimeoutError(content)
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self.adaptor.new_connection(**self.conn_info)
+                if self.adaptor.ping(conn):
+                    return conn
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        '''Give a connection back to the pool'''
+        try:
+            conn.rollback()  # drop what the user didn't commit
+            self._idle.put(conn)
+        except Exception:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        '''Close all the idle connections and stop the keep-alive thread'''
+        self._stop.set()
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _keep_alive(self, interval):
+        while not self._stop.wait(interval):
+            conns = []
+            while True:
+                try:
+                    conns.append(self._idle.get_nowait())
+                except queue.Empty:
+                    break
+            for conn in conns:
+                if self.adaptor.ping(conn):
+                    self._idle.put(conn)
+                else:
+                    self._discard(conn)
+                    self._logger.info("Dropped a dead pooled connection.")
+
+
+class DeferredCommit(object):
+    '''A connection proxy which ignores the commits, they are done once at
+    the end of a SixDB transaction'''
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def commit(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
 
 class SixDB(object):
 
-    def __init__(self, db_info, settings=None, create=False):
+    def __init__(self, db_info, settings=None, create=False, pool=None):
         '''Constructor.
         db_info(dict): contain the information of the database,
                        such as db_name, type, user, password, host and so on
         For sqlite db only db_name is needed which should be an absolute path,
         For MySQL db db_info should contain db_name(just name), user,
         password, host, port and other optional arguments.
+        pool(bool or dict): take the connection from the process-wide
+                            ConnectionPool of this database, a dict is
+                            forwarded to the pool as options (size,
+                            keepalive, timeout)
         '''
         self._logger = logging.getLogger(__name__)
         self.settings = settings
+        self.pool = None
+        # the process which took the pool, a forked process takes its own
+        self._pool_pid = None
+        self.conn = None
+        if pool is True:
+            pool = {}
+        elif not pool:
+            pool = None
+        self._pool_opts = pool
         info = {}
         info.update(db_info)
         self.info = info
@@ -48,14 +192,32 @@ class SixDB(object):
             if create:
                 self.adaptor.create_db(**self.info)
 
-        self.conn = self.adaptor.new_connection(**self.info)
+        if self._pool_opts is not None:
+            if self.pool is None or self._pool_pid != os.getpid():
+                # the connection inherited through a fork belongs to the
+                # parent, it's neither used nor closed here
+                if self._pool_pid != os.getpid():
+                    self.conn = None
+                self.pool = ConnectionPool.instance(self.adaptor, self.info,
+                                                    **self._pool_opts)
+                self._pool_pid = os.getpid()
+            # don't hold two pooled connections at the same time
+            self.close()
+            self.conn = self.pool.acquire()
+        else:
+            self.conn = self.adaptor.new_connection(**self.info)
         if self.settings is not None:
             self.setting(self.settings)
 
     def setting(self, settings):
-        '''Execute the settings of the database'''
+        '''Execute the settings (or a named profile) of the database'''
         self.adaptor.setting(self.conn, settings)
 
+    def migrate(self, settings):
+        '''Switch the existing database to the given settings or profile'''
+        self.adaptor.migrate(self.conn, settings)
+        self.settings = settings
+
     def info_check(self):
         '''Check if all the necessary information for database is there.
         And  check if the parameter's type is correct, if not, correct it'''
@@ -101,6 +263,23 @@ class SixDB(object):
                 key_info = tables_keys[key]
             self.create_table(key, value, key_info, recreate)
 
+    def create_indexes(self, table_name, indexes, columns=None):
+        '''Create the missing secondary indexes of a table'''
+        return self.adaptor.create_indexes(self.conn, table_name, indexes,
+                                           columns)
+
+    def fetch_indexes(self, table_name):
+        '''Fetch the index names of a table'''
+        return self.adaptor.fetch_indexes(self.conn, table_name)
+
+    def fetch_columns(self, table_name):
+        '''Fetch the column names of a table'''
+        return self.adaptor.fetch_columns(self.conn, table_name)
+
+    def add_columns(self, table_name, columns):
+        '''Add the missing columns of a table'''
+        return self.adaptor.add_columns(self.conn, table_name, columns)
+
     def drop_table(self, table_name):
         '''Drop a table'''
         self.adaptor.drop_table(self.conn, table_name)
@@ -119,20 +298,93 @@ class SixDB(object):
                                 **kwargs)
         return r
 
+    def selectm(self, table_name, columns, column, values, **kwargs):
+        '''Select the rows whose column has one of the given values, the
+        values are passed as query parameters'''
+        return self.adaptor.selectm(self.conn, table_name, columns, column,
+                                    values, **kwargs)
+
+    def select_batches(self, table_name, columns='*', where=None,
+                       orderby=None, batch_size=None, numpy=False, **kwargs):
+        '''Select values with specified conditions and generate them batch by
+        batch, the memory usage doesn't depend on the size of the result.
+        @batch_size(int) The number of rows per batch
+        @numpy(bool) Generate an ordered dict of column name -> numpy array
+        for each batch instead of a list of rows
+        '''
+        if numpy and np is None:
+            raise ImportError("numpy is needed for the column-oriented batches!")
+        names = []
+        batches = self.adaptor.select_batches(self.conn, table_name, columns,
+                                              where, orderby, batch_size,
+                                              names, **kwargs)
+        for batch in batches:
+            if numpy:
+                batch = OrderedDict((name, np.array(col)) for name, col in
+                                    zip(names, zip(*batch)))
+            yield batch
+
+    def iselect(self, table_name, columns='*', where=None, orderby=None,
+                batch_size=None, **kwargs):
+        '''Select values with specified conditions and generate the rows one
+        by one, they are fetched from the database batch by batch'''
+        for batch in self.select_batches(table_name, columns, where, orderby,
+                                         batch_size, **kwargs):
+            yield from batch
+
     def update(self, table_name, values, where=None):
         '''Update data in a table'''
         self.adaptor.update(self.conn, table_name, values, where)
 
-    def updatem(self, table_name, values, where):
-        '''Update data in a table'''
-        self.adaptor.updatem(self.conn, table_name, values, where)
+    def updatem(self, table_name, values, where, chunksize=None,
+                progress=None):
+        '''Update multiple rows in a table within one transaction'''
+        self.adaptor.updatem(self.conn, table_name, values, where, chunksize,
+                             progress)
 
     def remove(self, table_name, where):
         '''Reomve rows based on specified conditions'''
         self.adaptor.delete(self.conn, table_name, where)
 
+    def removem(self, table_name, where):
+        '''Remove multiple rows, where maps the column names to the values of
+        each removed row'''
+        self.adaptor.deletem(self.conn, table_name, where)
+
+    @contextmanager
+    def transaction(self):
+        '''Run the operations of the with-block in one transaction, they are
+        committed together at the end or rolled back on error'''
+        if isinstance(self.conn, DeferredCommit):
+            # already in a transaction
+            yield self
+            return
+        conn = self.conn
+        self.conn = DeferredCommit(conn)
+        try:
+            yield self
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            self.conn = conn
+
     def close(self):
-        '''Disconnect the database'''
+        '''Disconnect the database, or give the connection back to the pool
+        if it is pooled'''
+        if self.pool is not None:
+            if self._pool_pid != os.getpid():
+                # the pooled connection of the parent of a forked process
+                self.conn = None
+            if self.conn is not None:
+                conn, self.conn = self.conn, None
+                try:
+                    conn.commit()
+                finally:
+                    self.pool.release(conn)
+            return
         self.conn.commit()
         self.conn.close()
 
@@ -1,18 +1,29 @@
 import os
 import re
+import json
 import time
 import gzip
 import logging
 
-from pysixdesk.lib.utils import compress_buf
+from pysixdesk.lib.utils import compress_buf, STATS_FILE, MADX_KEY_FILE
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 '''Parse the results of preprocess jobs and sixtrack jobs'''
 
 logger = logging.getLogger(__name__)
 
+# The column types which can be parsed into a numpy array
+NUMERIC_TYPES = ['int', 'integer', 'bigint', 'float', 'double', 'real']
+
 
-def parse_results(jobtype, item, job_path, file_list, task_table, result_cf):
-    '''parse the results'''
+def parse_results(jobtype, item, job_path, file_list, task_table, result_cf,
+                  arrays=False):
+    '''parse the results, the numeric result files are parsed into typed
+    numpy columns if arrays is True (see parse_array)'''
     task_table['mtime'] = int(time.time() * 1E7)
     contents = []
     for a in os.walk(job_path):
@@ -29,6 +40,11 @@ def parse_results(jobtype, item, job_path, file_list, task_table, result_cf):
     if jobtype == 'preprocess':
         search_store('madx_in', 'madx_in')
         search_store('madx_stdout', 'madx_stdout')
+        # the key of the inputs of a successful madx run
+        madx_key = [s for s in contents if os.path.basename(s) == MADX_KEY_FILE]
+        if madx_key:
+            with open(madx_key[0], 'r') as f_in:
+                task_table['madx_key'] = f_in.read().strip()
 
     if jobtype == 'sixtrack':
         search_store('fort_3', 'fort.3')
@@ -59,6 +75,18 @@ def parse_results(jobtype, item, job_path, file_list, task_table, result_cf):
         job_stdlog = job_stdlog[0]
         task_table['job_stdlog'] = compress_buf(job_stdlog)
 
+    # the resource usage of madx and sixtrack, see utils.run_process
+    job_stats = [s for s in contents if os.path.basename(s) == STATS_FILE]
+    if job_stats:
+        try:
+            with open(job_stats[0], 'r') as f_in:
+                stats = json.load(f_in)
+            for key in ['wall_time', 'cpu_time', 'max_rss']:
+                if key in stats:
+                    task_table[key] = stats[key]
+        except ValueError:
+            logger.warning("The resource usage of task %s is invalid!" % item)
+
     valid_tname = []
     for out, tname in file_list.items():
         out_f = [s for s in contents if out in os.path.basename(s)]
@@ -66,7 +94,8 @@ def parse_results(jobtype, item, job_path, file_list, task_table, result_cf):
             out_f = out_f[0]
             if tname is not None:
                 try:
-                    parse_file(out_f, task_table, result_cf[tname], tname)
+                    parse_file(out_f, task_table, result_cf[tname], tname,
+                               arrays)
                     valid_tname.append(tname)
                 except Exception as e:
                     task_table['status'] = 'Failed'
@@ -87,30 +116,84 @@ def parse_results(jobtype, item, job_path, file_list, task_table, result_cf):
             result_cf.pop(tname)
 
 
-def parse_file(out_f, task_table, result_table, tname):
-    '''parse the files'''
-    countl = 0
+def parse_file(out_f, task_table, result_table, tname, arrays=False):
+    '''parse the files, into numpy columns with the types of the table if
+    arrays is True and the file is numeric, else into strings'''
     mtime = int(os.path.getmtime(out_f) * 1E7)
+    keys = list(result_table.keys())
+    if arrays and np is not None and is_numeric(result_table):
+        array = parse_array(out_f, keys[2:-1], result_table)
+        if array is not None:
+            rows = len(array)
+            data = [np.arange(1, rows + 1)]
+            data += [array[col] for col in keys[2:-1]]
+            data.append(np.full(rows, mtime, dtype=np.int64))
+            result_table.update(zip(keys[1:], data))
+            return
+    status, data = parse_lines(out_f, tname)
+    if not status:
+        task_table['status'] = 'Failed'
+        content = 'Error in %s' % out_f
+        logger.warning(content)
+    if not data:
+        data = [[] for i in keys[2:-1]]
+    rows = len(data[0])
+    data = [range(1, rows + 1)] + list(data) + [[mtime] * rows]
+    result_table.update(dict(zip(keys[1:], data)))
+
+
+def is_numeric(result_table):
+    '''Check if the data columns of a result table (all the columns except
+    task_id, row_num and mtime) are numbers'''
+    types = list(result_table.values())[2:-1]
+    return bool(types) and all(str(i).lower() in NUMERIC_TYPES for i in types)
+
+
+def column_dtype(col_type):
+    '''The numpy type of a numeric column type of the result tables'''
+    if 'int' in str(col_type).lower():
+        return np.int64
+    return np.float64
+
+
+def parse_array(out_f, columns, result_table):
+    '''Load the file into a structured array with the column types of the
+    table, the whole file is validated at once. The file is read as floats
+    first, sixtrack writes the integers in the exponent notation too.
+    Returns:
+        numpy.ndarray: The structured array, None if the file doesn't match
+        the table, then it should be parsed line by line.
+    '''
+    try:
+        with gzip.open(out_f, 'rt') as f_in:
+            values = np.loadtxt(f_in, dtype=np.float64, comments='#',
+                                ndmin=2)
+    except ValueError:
+        return None
+    if values.size and values.shape[1] != len(columns):
+        return None
+    dtype = [(col, column_dtype(result_table[col])) for col in columns]
+    array = np.empty(len(values), dtype=dtype)
+    for i, col in enumerate(columns):
+        if array.dtype[col] == np.int64 and\
+                not np.all(np.mod(values[:, i], 1) == 0):
+            return None
+        array[col] = values[:, i]
+    return array
+
+
+def parse_lines(out_f, tname):
+    '''Parse the file line by line with the method named after the table'''
     with gzip.open(out_f, 'rt') as f_in:
         raw_lines = f_in.readlines()
     lines = []
     postlines = []
     for lin in raw_lines:
-        if lin.lstrip()[0] == '#':
+        if not lin.strip() or lin.lstrip()[0] == '#':
             continue
         lines.append(lin)
     status = globals()[tname](lines, postlines)
-    if not status:
-        task_table['status'] = 'Failed'
-        content = 'Error in %s' % out_f
-        logger.warning(content)
-    post_data = []
-    for line in postlines:
-        countl += 1
-        line = [countl] + line + [mtime]
-        post_data.append(line)
-    keys = list(result_table.keys())
-    result_table.update(dict(zip(keys[1:], zip(*post_data))))
+    return status, list(zip(*postlines))
 
 
 # The following methods to parse specific files should have the same name with
@@ -7,18 +7,23 @@ import shutil
 import zipfile
 import argparse
 import configparser
+import multiprocessing
 
 from pathlib import Path
 from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
 from pysixdesk.lib.pysixdb import SixDB
 from pysixdesk.lib import utils
+from pysixdesk.lib import blobstore
+from pysixdesk.lib import inputcache
 from pysixdesk.lib.dbtable import Table
 from pysixdesk.lib.resultparser import parse_results
 
 
 class TrackingJob:
-    def __init__(self, task_id, input_info, group_name, logger):
+    def __init__(self, task_id, input_info, group_name, logger,
+                 work_dir=None, cache=None):
         '''Class to handle the execution of the tracking job.
 
         Args:
@@ -26,22 +31,51 @@ class TrackingJob:
             input_info (str/path): Path to the database configuration file.
             group_name (str): The group name when submitting multi-jobs to one node
             logger: The logger
+            work_dir (str/path, optional): if provided, the job prepares and
+            runs sixtrack in this folder instead of the current one, the
+            results are still stored in the current folder.
+            cache (InputCache, optional): the cache of the templates and of
+            the preprocess inputs, used if no cache is configured (see
+            inputcache.create_input_cache).
 
         Raises:
             FileNotFoundError: If required input file is not found in database.
             ValueError: If unalbe to find the preprocess task_id for this job.
         '''
         self._logger = logger
-        self._dest_path = Path('results', str(task_id))
+        self._dest_path = Path('results', str(task_id)).absolute()
         self._dest_path.mkdir(parents=True, exist_ok=True)
         self.group_name = group_name
+        self.work_dir = None
+        if work_dir is not None:
+            self.work_dir = Path(work_dir).absolute()
+            self.work_dir.mkdir(parents=True, exist_ok=True)
+            # the stdout of the job is downloaded with the mysql results
+            for name in ['_condor_stdout', '_condor_stderr']:
+                link = self.work_dir / name
+                if Path(name).is_file() and not link.exists():
+                    link.symlink_to(Path(name).absolute())
 
         self.task_id = task_id
+        # the resource usage of sixtrack, see utils.run_process
+        self.job_stats = {}
         # read database config
         cf = configparser.ConfigParser()
         cf.optionxform = str
         cf.read(input_info)
+        if cf['db_info']['db_type'].lower() == 'sql':
+            # the database is next to the config, wherever the job runs
+            db_name = Path(input_info).absolute().parent / cf['db_info']['db_name']
+            cf['db_info']['db_name'] = str(db_name)
         self.cf = cf
+        if cf.has_section('blob_store'):
+            blobstore.set_blob_store(dict(cf['blob_store']))
+        if cf.has_section('codec'):
+            utils.set_codec(dict(cf['codec']))
+        cache_cfg = None
+        if cf.has_section('input_cache'):
+            cache_cfg = dict(cf['input_cache'])
+        self.cache = inputcache.create_input_cache(cache_cfg) or cache
         self.db = SixDB(cf['db_info'].items())
         db_type = cf['db_info']['db_type']
         self.db_type = db_type.lower()
@@ -65,7 +99,14 @@ class TrackingJob:
                                        where=f"task_id={self.task_id}")
         self.fort_cfg = dict(zip(fort3_keys, fort3_outputs[0]))
         self.six_cfg = cf['sixtrack']
-        self._decomp_templates()
+        # the fort.3 rendered on the submit host
+        self.fort3_archive = self.six_cfg.get('fort3_archive')
+        if self.boinc:
+            self.fort3_archive = None
+        else:
+            self.fort3_archive = self._shared_path(self.fort3_archive)
+        with self.in_work_dir():
+            self._decomp_templates()
         self.boinc_cfg = cf['boinc']
 
         self.six_out = json.loads(self.six_cfg['output_files'])
@@ -80,7 +121,8 @@ class TrackingJob:
         self.cr_files = ['crpoint_sec.bin', 'crpoint_pri.bin',
                          'fort.6', 'singletrackfile.dat']
 
-        self.cr_inputs = self._decomp_files()
+        with self.in_work_dir():
+            self.cr_inputs = self._decomp_files()
 
         # get boinc settings
         boinc_infos = self.db.select('env',
@@ -100,6 +142,41 @@ class TrackingJob:
         # close db to avoid unexpected timeouts
         self.db.close()
 
+    @contextmanager
+    def in_work_dir(self):
+        """Helper context manager to enter the work folder of the job, if
+        there is one, and to come back on release.
+        """
+        if self.work_dir is None:
+            yield
+            return
+        cwd = Path.cwd()
+        os.chdir(self.work_dir)
+        try:
+            yield
+        finally:
+            os.chdir(cwd)
+
+    def _shared_path(self, name):
+        '''Absolute path of a file of the current folder, so it stays
+        reachable from the work folder.'''
+        if name is None or self.work_dir is None:
+            return name
+        return str(Path(name).absolute())
+
+    def _materialize(self, buf, name, link=True):
+        '''Decompresses the buffer into the file name of the current folder.
+        With a cache, the buffer is decompressed only once and the file is
+        a link to the cached file, or a copy if link is False.
+
+        Returns:
+            str: the cache key of the buffer, None without cache.
+        '''
+        if self.cache is None:
+            utils.decompress_buf(buf, name, des='file')
+            return None
+        return self.cache.fetch(buf, name, link=link)
+
     def _str_to_bool(self, string):
         '''Convenience function to convert string to bool.
 
@@ -128,7 +205,12 @@ class TrackingJob:
         Raises:
             FileNotFoundError: If buffer is not found in db.
         """
-        templates = self.cf['templates']
+        templates = dict(self.cf['templates'])
+        if self.fort3_archive:
+            # the fort.3 template isn't needed
+            templates.pop('fort_file', None)
+        if not templates:
+            return
         temp_buf = self.db.select('templates', templates.keys())[0]
         if not temp_buf:
             raise FileNotFoundError('Templates not found in DB.')
@@ -137,7 +219,8 @@ class TrackingJob:
                 if not temp:
                     raise FileNotFoundError(f'{temp_name} not found in DB.')
                 else:
-                    utils.decompress_buf(temp, temp_name)
+                    # the fort.3 template is replaced by the job's fort.3
+                    self._materialize(temp, temp_name, link=False)
 
     def _decomp_files(self):
         '''This decompresses the buffers in the database into files.
@@ -152,13 +235,36 @@ class TrackingJob:
         input_files = json.loads(inp)
         inputs = list(input_files.values())
 
-        input_buf = self.db.select('preprocess_task',
-                                   inputs,
-                                   f'task_id={self.pre_task_id}')
-        if not input_buf:
-            raise FileNotFoundError("The required files were not found!")
-
-        input_buf = list(input_buf[0])
+        # the outputs of a preprocess task don't change, the cached ones
+        # aren't fetched again
+        names = dict((i, f'preprocess_task/{self.pre_task_id}/{i}')
+                     for i in inputs)
+        cached = {}
+        if self.cache is not None:
+            for infile in inputs:
+                key = self.cache.lookup(names[infile])
+                if key is None:
+                    continue
+                try:
+                    self.cache.materialize(key, infile)
+                    cached[infile] = key
+                except FileNotFoundError:
+                    # evicted in the meantime by another job
+                    pass
+        missing = [i for i in inputs if i not in cached]
+        if missing:
+            input_buf = self.db.select('preprocess_task',
+                                       missing,
+                                       f'task_id={self.pre_task_id}')
+            if not input_buf:
+                raise FileNotFoundError("The required files were not found!")
+            for infile, buf in zip(missing, input_buf[0]):
+                key = self._materialize(buf, infile)
+                if key is not None:
+                    self.cache.record(names[infile], key)
+        if cached:
+            content = f"Reused {len(cached)} cached input files."
+            self._logger.info(content)
 
         cr_inputs = []
         if self.first_turn is not None:
@@ -172,14 +278,9 @@ class TrackingJob:
             if (not cr_input_buf) or (cr_input_buf[0][0] is None):
                 raise FileNotFoundError("checkpoint files were not found!")
 
-            inputs += cr_inputs
-            input_buf += cr_input_buf[0]
-
-        for infile in inputs:
-            i = inputs.index(infile)
-            buf = input_buf[i]
-
-            utils.decompress_buf(buf, infile, des='file')
+            # the checkpoint files belong to the task
+            for infile, buf in zip(cr_inputs, cr_input_buf[0]):
+                utils.decompress_buf(buf, infile, des='file')
 
         return cr_inputs
 
@@ -285,23 +386,60 @@ class TrackingJob:
         # concatenate
         utils.concatenate_files([dest, madx_fc3], output_file)
 
+    def sixtrack_extract_fort3(self, source_prefix=None,
+                               output_file='fort.3'):
+        """Extracts the fort.3 file rendered on the submit host.
+
+        Args:
+            source_prefix (str/path, optional): if provided, will use the
+            provided folder prefix when looking for the archive.
+            output_file (str, optional): name of the extracted fort.3 file.
+
+        Raises:
+            FileNotFoundError: If the fort.3 of the task isn't in the archive.
+        """
+        # touch fort.6
+        open('fort.6', 'a').close()
+
+        archive = Path(self.fort3_archive)
+        if source_prefix is not None:
+            archive = Path(source_prefix) / archive
+        name = f'{self.task_id}/fort.3'
+        with zipfile.ZipFile(archive, 'r') as ziph:
+            if name not in ziph.namelist():
+                content = f"The fort.3 of task {self.task_id} isn't in {archive}!"
+                raise FileNotFoundError(content)
+            with ziph.open(name) as f_in, open(output_file, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+
     def sixtrack_run(self, output_file):
         """Runs sixtrack.
 
         Args:
             output_file (str): file in which to write sixtrack's stdout.
+
+        Raises:
+            TimeoutError: If sixtrack exceeds the wall or the cpu timeout.
         """
-        # actually run
-        six_output = os.popen(self.six_cfg["sixtrack_exe"])
+        # actually run, the stdout is streamed to a file
+        stdout = output_file + '.stdout'
         self._logger.info('Sixtrack is running...')
-        # write stdout to file
-        outputlines = six_output.readlines()
-        self._logger.info('Sixtrack is done!')
-
-        if outputlines:
-            with open(output_file, 'w') as six_out:
-                six_out.writelines(outputlines)
-        elif output_file != 'fort.6':
+        stats = utils.run_process(self.six_cfg["sixtrack_exe"], stdout,
+                                  wall_timeout=self.six_cfg.get('wall_timeout'),
+                                  cpu_timeout=self.six_cfg.get('cpu_timeout'))
+        utils.add_process_stats(self.job_stats, stats)
+        if stats['timeout'] is not None:
+            content = "Sixtrack exceeded the %s timeout after %.1f s!" % (
+                stats['timeout'], stats['wall_time'])
+            raise TimeoutError(content)
+        self._logger.info('Sixtrack is done in %.1f s (cpu %.1f s)!' % (
+            stats['wall_time'], stats['cpu_time']))
+
+        if os.path.getsize(stdout):
+            os.replace(stdout, output_file)
+            return
+        os.remove(stdout)
+        if output_file != 'fort.6':
             # For some sixtrack version, the stdout will be automatically
             # written to fort.6
             shutil.copy2('fort.6', output_file)
@@ -323,6 +461,7 @@ class TrackingJob:
             down_list.extend(['_condor_stdout', '_condor_stderr'])
 
         try:
+            utils.write_process_stats(self.job_stats, self._dest_path)
             utils.download_output(down_list, self._dest_path)
             content = f"All requested results have been stored in {self._dest_path}"
             self._logger.info(content)
@@ -341,8 +480,10 @@ class TrackingJob:
         for sec in self.cf:
             result_cf[sec] = dict(self.cf[sec])
         filelist = Table.result_table(self.six_out)
+        arrays = self.cf.has_section('sixtrack') and\
+            self.cf['sixtrack'].getboolean('parse_arrays', fallback=False)
         parse_results('sixtrack', self.task_id, self._dest_path, filelist,
-                      task_table, result_cf)
+                      task_table, result_cf, arrays)
 
         self.db.update('sixtrack_task', task_table,
                        f'task_id={self.task_id}')
@@ -368,12 +509,13 @@ class TrackingJob:
     def run(self):
         '''Main execution logic
         '''
-        try:
-            self.sixtrack_job()
-        except Exception:
-            self._logger.error('Sixtrack task failed!', exc_info=True)
+        with self.in_work_dir():
+            try:
+                self.sixtrack_job()
+            except Exception:
+                self._logger.error('Sixtrack task failed!', exc_info=True)
 
-        self.dl_output()
+            self.dl_output()
 
         if self.db_type == 'mysql':
             self.push_to_db()
@@ -464,7 +606,9 @@ class TrackingJob:
         else:
             add_inputs = []
 
-        if self.boinc:
+        if self.fort3_archive:
+            fort_dic = None
+        elif self.boinc:
             # run sixtrack with a few turns
             fort_dic = self.sixtrack_prep_cfg(turnss=self.six_cfg['test_turn'])
         else:
@@ -475,10 +619,14 @@ class TrackingJob:
         with self.sixtrack_temp_folder(symlink_parent=True,
                                        extra=add_inputs + self.cr_inputs):
             self._logger.info("Preparing the sixtrack input files!")
-            # replace placeholders and concatenate
-            self.sixtrack_prep_job(fort_dic,
-                                   source_prefix=Path.cwd().parent,
-                                   output_file='fort.3')
+            if fort_dic is None:
+                self.sixtrack_extract_fort3(source_prefix=Path.cwd().parent,
+                                            output_file='fort.3')
+            else:
+                # replace placeholders and concatenate
+                self.sixtrack_prep_job(fort_dic,
+                                       source_prefix=Path.cwd().parent,
+                                       output_file='fort.3')
             # run sixtrack
             self.sixtrack_run('fort.6')
             # self.six_out.append('fort.6')
@@ -513,30 +661,92 @@ class TrackingJob:
             self.boinc_submit(job_name)
 
 
+def run_task(job):
+    '''Runs a tracking job, with mysql the work unit is set back to
+    incomplete if the job fails.
+    '''
+    try:
+        job.run()
+    except Exception as e:
+        if job.db_type == 'mysql':
+            job.db.open()
+            job_table = {}
+            job_table['status'] = 'incomplete'
+            job_table['mtime'] = int(time.time() * 1E7)
+            job.db.update('sixtrack_wu', job_table,
+                          where=f'task_id={job.task_id}')
+        raise e
+    finally:
+        if job.db_type == 'mysql':
+            job.db.remove('sixtrack_wu_tmp', where=f'task_id={job.task_id}')
+        if job.work_dir is not None:
+            shutil.rmtree(job.work_dir, ignore_errors=True)
+
+
+def _run_group_task(task_id, input_info, group_name, logger, cache):
+    '''Builds and runs a task of a group, in a worker process in the
+    parallel mode, so its inputs are only prepared when it starts'''
+    run_task(TrackingJob(task_id, input_info, group_name, logger,
+                         work_dir=f'task_{task_id}', cache=cache))
+
+
+def run_group(task_ids, input_info, group_name, logger, workers=None):
+    '''Runs the tasks of a group, each one in its own folder and up to
+    workers of them at the same time. The templates and the preprocess
+    inputs are decompressed in the configured input cache, or else in a
+    cache of the group, and shared between the tasks.
+
+    Args:
+        task_ids (list): The task ids of the group.
+        input_info (str/path): Path to the database configuration file.
+        group_name (str): The group name.
+        logger: The logger
+        workers (int, optional): The maximum number of tasks running at the
+        same time, the cpus of the slot by default (see utils.slot_cpus).
+
+    Raises:
+        Exception: The failure of the first failed task, in parallel once
+        all of them are done.
+    '''
+    if len(task_ids) == 1:
+        run_task(TrackingJob(task_ids[0], input_info, group_name, logger))
+        return
+    if workers is None:
+        workers = utils.slot_cpus()
+    workers = max(1, min(int(workers), len(task_ids)))
+    shared_dir = Path('shared').absolute()
+    # the database of the group doesn't change, it scopes the index
+    cache = inputcache.InputCache(shared_dir, namespace=group_name)
+    args = (input_info, group_name, logger, cache)
+    try:
+        if workers == 1:
+            for task_id in task_ids:
+                _run_group_task(task_id, *args)
+            return
+        content = f"Running {len(task_ids)} tasks with {workers} processes"
+        logger.info(content)
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=context) as executor:
+            futures = [executor.submit(_run_group_task, task_id, *args)
+                       for task_id in task_ids]
+        errors = [f.exception() for f in futures if f.exception()]
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+    if errors:
+        raise errors[0]
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('task_id', type=str,
                         help='Current work unit ID')
     parser.add_argument('input_info', type=str,
                         help='Path to the db config file.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Maximum number of tasks of the group running '
+                        'at the same time, the cpus of the slot by default.')
     args = parser.parse_args()
     group_name = args.task_id
     task_ids = group_name.split('-')
     LOGGER = utils.condor_logger('sixtrack')
-    for task_id in task_ids:
-        job = TrackingJob(task_id, args.input_info, group_name, LOGGER)
-        try:
-            job.run()
-        except Exception as e:
-            if job.db_type == 'mysql':
-                job.db.open()
-                job_table = {}
-                where = "task_id"
-                job_table['status'] = 'incomplete'
-                job_table['mtime'] = int(time.time() * 1E7)
-                job.db.update('sixtrack_wu', job_table,
-                              where=f'task_id={job.task_id}')
-            raise e
-        finally:
-            if job.db_type == 'mysql':
-                job.db.remove('sixtrack_wu_tmp', where=f'task_id={job.task_id}')
+    run_group(task_ids, args.input_info, group_name, LOGGER, args.workers)
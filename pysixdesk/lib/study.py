@@ -2,8 +2,10 @@ import os
 import ast
 import time
 import json
+import math
 import shutil
 import logging
+import zipfile
 import getpass
 import itertools
 import configparser
@@ -11,8 +13,10 @@ from collections import OrderedDict
 from collections.abc import Iterable
 
 from . import utils
+from . import blobstore
 from . import gather
 from . import constants
+from . import paramspace
 from . import submission
 from .pysixdb import SixDB
 from .dbtable import Table
@@ -77,6 +81,8 @@ class Study(object):
         self.last_turn = 100  # last turn
         self.cluster_class = submission.HTCondor
         self.max_jobsubmit = 15000
+        # the maximum number of rows inserted into database per transaction
+        self.db_chunksize = 50000
 
         self.madx_output = {
             'fc.2': 'fort.2',
@@ -128,6 +134,49 @@ class Study(object):
         self.sixtrack_output = ['fort.10']
 
         self.db_info['db_type'] = 'sql'
+        # share the connections of the study and the collection through a
+        # process-wide pool, True or the pool options, e.g. {'size': 4,
+        # 'keepalive': 600} (keepalive is only used with MySQL). The jobs
+        # don't use it, they close their connection during the run
+        self.db_pool = None
+        # the number of processes parsing the results in collect_result
+        self.gather_workers = 1
+        # keep the large files in a content-addressed store instead of the
+        # database, e.g. {'type': 'local', 'root': '/path/to/blobs'}, the
+        # root has to be reachable from the worker nodes
+        self.blob_store = None
+        # the codec of the stored files, None for gzip or the codec options,
+        # e.g. {'name': 'zstd', 'level': 3, 'dictionary': '/path/to/dict'}
+        # (see utils.codecs), zstd and lz4 need the zstandard and lz4 packages
+        self.codec = None
+        # the node-local cache of the decompressed inputs of the tracking
+        # jobs, e.g. {'path': '/tmp/pysixdesk_cache', 'max_size': 2E9}, the
+        # path can also be set on the nodes with PYSIXDESK_CACHE_DIR
+        self.input_cache = None
+        # render the fort.3 of the tracking jobs when they are prepared and
+        # send them in one archive, so the jobs don't need the fort.3
+        # template (not used with boinc)
+        self.prerender_fort3 = False
+        # kill madx and sixtrack after this wall time or cpu time (s) in
+        # the jobs, no limit if None
+        self.wall_timeout = None
+        self.cpu_timeout = None
+        # reuse the madx outputs of an earlier preprocess task with the same
+        # rendered mask, madx executable and output files (see
+        # utils.madx_cache_key). The files called by the mask aren't part of
+        # the key, so it's off by default: enable it only if they don't
+        # change between the studies sharing the cache
+        self.madx_cache = False
+        # parse the numeric result files (fort.10, oneturnresult) into numpy
+        # columns with the types of the tables instead of strings, they are
+        # inserted as numbers (needs numpy)
+        self.parse_arrays = False
+        # only look into the result directories modified since the last
+        # collection
+        self.gather_incremental = True
+        # the pragma settings of sqlite, or the name of a profile defined in
+        # SQLDatabaseAdaptor.profiles: 'safe', 'bulk-load', 'concurrent-read',
+        # a profile stored by switch_db_profile() takes precedence
         self.db_settings = {
             # 'synchronous': 'off',
             'foreign_keys': 'on',
@@ -247,20 +296,33 @@ class Study(object):
             table.customize_tables('templates', inp, 'BLOB')
         table.customize_tables('env', self.env)
         table.customize_tables('env', list(self.paths.keys()), 'text')
+        table.customize_tables('env', ['db_profile'], 'text')
         table.customize_tables('preprocess_wu', self.madx_params)
         table.customize_tables('preprocess_task',
                                list(self.preprocess_output.values()),
                                'MEDIUMBLOB')
+        table.customize_tables('madx_cache', list(self.madx_output.values()),
+                               'MEDIUMBLOB')
         table.customize_tables('sixtrack_wu', self.sixtrack_params)
         table.customize_tables('sixtrack_task', list(self.sixtrack_output),
                                'MEDIUMBLOB')
         table.customize_tables('boinc_vars', self.boinc_vars)
 
-        # Initialize the database
-        self.db = SixDB(self.db_info, settings=self.db_settings, create=True)
+        blobstore.set_blob_store(self.blob_store or None)
+        utils.set_codec(self.codec or None)
+
+        # Initialize the database, the settings are applied once the stored
+        # profile is known
+        self.db = SixDB(self.db_info, create=True, pool=self.db_pool)
+        exist_tables = [i[0] for i in self.db.fetch_tables()]
+        self._upgrade_columns(exist_tables)
+        self._load_db_profile(exist_tables)
         # create the database tables if not exist
-        if not self.db.fetch_tables():
-            self.db.create_tables(self.tables, self.table_keys)
+        new_tables = OrderedDict([(k, v) for k, v in self.tables.items() if
+                                  k not in exist_tables])
+        if new_tables:
+            self.db.create_tables(new_tables, self.table_keys)
+        self._upgrade_indexes(exist_tables)
 
         # Initialize the submission object
         try:
@@ -281,6 +343,7 @@ class Study(object):
         madx_sec['oneturn'] = json.dumps(self.oneturn)
         madx_sec['collimation'] = json.dumps(self.collimation)
         madx_sec['output_files'] = json.dumps(self.madx_output)
+        madx_sec['cache'] = json.dumps(self._use_madx_cache())
         templates['mask_file'] = self.madx_input["mask_file"]
         if self.oneturn:
             six_sec = {}
@@ -323,6 +386,26 @@ class Study(object):
         six_sec['output_files'] = json.dumps(inp)
         six_sec['test_turn'] = str(self.env['test_turn'])
         self.sixtrack_config['six_results'] = self.tables['six_results']
+        timeouts = {'wall_timeout': self.wall_timeout,
+                    'cpu_timeout': self.cpu_timeout}
+        for sec in [madx_sec, six_sec,
+                    self.preprocess_config.get('sixtrack', {})]:
+            sec.update((k, str(v)) for k, v in timeouts.items() if v)
+        for sec in [six_sec, self.preprocess_config.get('sixtrack', {})]:
+            sec['parse_arrays'] = str(self.parse_arrays)
+        if self.blob_store:
+            blob_sec = dict((k, str(v)) for k, v in self.blob_store.items())
+            self.preprocess_config['blob_store'] = blob_sec
+            self.sixtrack_config['blob_store'] = blob_sec
+        if self.codec:
+            codec_sec = dict((k, str(v)) for k, v in self.codec.items())
+            self.preprocess_config['codec'] = codec_sec
+            self.sixtrack_config['codec'] = codec_sec
+        # the cached inputs are indexed by study
+        cache_sec = dict((k, str(v)) for k, v in
+                         (self.input_cache or {}).items())
+        cache_sec['namespace'] = self.study_path
+        self.sixtrack_config['input_cache'] = cache_sec
         if self.collimation:
             self.sixtrack_config['aperture_losses'] = self.tables['aperture_losses']
             self.sixtrack_config['collimation_losses'] = self.tables['collimation_losses']
@@ -330,38 +413,53 @@ class Study(object):
             self.sixtrack_config['final_state'] = self.tables['final_state']
 
     def _check_parameter_changes(self):
-        '''Check if the parameters are changed, return the records
-        and new lists'''
+        '''Read the parameter values which are already materialised in the
+        work unit tables from the parameter index (one query), return the
+        records of each table'''
         types = {'preprocess_wu': self.madx_params,
-                'sixtrack_wu': self.sixtrack_params}
+                 'sixtrack_wu': self.sixtrack_params}
         records = {}
-        news = {}
-        for typ, params in types.items():
+        for typ in types.keys():
             records[typ] = {}
-            news[typ] = {}
-            self._logger.info(f'checking {typ} paramter changes....')
-            bar = utils.ProgressBar(len(params))
+        self._logger.info('checking paramter changes....')
+        index = self.db.select('param_index', ['table_name', 'param', 'value'])
+        for typ, key, value in index:
+            if typ in records:
+                records[typ].setdefault(key, []).append(
+                    paramspace.load_value(value))
+        for typ, params in types.items():
+            if records[typ] or not self.db.select(typ, ['wu_id'], limit=1):
+                continue
+            # the study was created before the parameter index, build it once
+            self._logger.info(f'building the parameter index of {typ}....')
             for key in params.keys():
-                bar.update()
                 values = self.db.select(typ, key, DISTINCT=True)
-                if not values:
-                    value = []
-                else:
-                    value = list(zip(*values))[0]
-                    records[typ][key] = value
-                news[typ][key] = []
-                val = params[key]
-                if not isinstance(val, Iterable) or isinstance(val, str):
-                    val = [val]
-                for i in val:
-                    if isinstance(i, Iterable):
-                        i = str(i)
-                    if i not in value:
-                        news[typ][key].append(i)
-            [news[typ][key].extend(value) for key, value in records[typ].items()]
-            # remove the empty records
-            [news[typ].pop(key) for key in params.keys() if not news[typ][key]]
-        return records, news
+                records[typ][key] = [i[0] for i in values]
+            self._update_param_index(typ, records[typ])
+        return records
+
+    def _update_param_index(self, typ, news):
+        '''Record the new parameter values of a work unit table'''
+        index = OrderedDict()
+        index['table_name'] = []
+        index['param'] = []
+        index['value'] = []
+        for key, values in news.items():
+            for value in values:
+                index['table_name'].append(typ)
+                index['param'].append(key)
+                index['value'].append(paramspace.dump_value(value))
+        index['mtime'] = [int(time.time() * 1E7)] * len(index['value'])
+        self.db.insertm('param_index', index)
+
+    def _custom_product(self, typ):
+        '''Return the overridden custom product for the given table, None if
+        the default cartesian product is used'''
+        name = f'custom_product_{typ}'
+        method = getattr(self, name)
+        if getattr(type(self), name) is getattr(Study, name):
+            return None
+        return method
 
     def update_db(self, db_check=False):
         '''Update the database whith the user-defined parameters'''
@@ -393,7 +491,11 @@ class Study(object):
         if not outputs:
             self.db.insert('templates', tab)
         else:
-            self.db.update('templates', tab)
+            # only rewrite the templates which have changed
+            olds = dict(zip(self.tables['templates'].keys(), outputs[0]))
+            tab = {k: v for k, v in tab.items() if olds.get(k) != v}
+            if tab:
+                self.db.update('templates', tab)
 
         outputs = self.db.select('boinc_vars', self.boinc_vars.keys())
         if not outputs:
@@ -411,172 +513,228 @@ class Study(object):
         else:
             self.db.update('env', envs)
 
-        records, news = self._check_parameter_changes()
+        records = self._check_parameter_changes()
         # Fill the preprocess_wu table
-        pre_records = records['preprocess_wu']
-        pre_news = news['preprocess_wu']
-
         keys = list(self.madx_params.keys())
+        pre_space = paramspace.ParameterSpace(self.madx_params,
+                                              records['preprocess_wu'])
 
-        check_params = self.db.select('preprocess_wu', keys)
-        check_jobs = self.db.select(
-            'preprocess_wu', ['wu_id', 'job_name'])
+        check_jobs = self.db.select('preprocess_wu', ['wu_id'])
         if check_jobs:
-            pre_wu_ids = list(zip(*check_jobs))[0]
+            pre_wu_ids = [i[0] for i in check_jobs]
             wu_id = max(pre_wu_ids)
         else:
             pre_wu_ids = []
             wu_id = 0
+        check_params = {}
+        if db_check:
+            check_jobs = self.db.select('preprocess_wu', keys + ['job_name'])
+            check_params = dict((i[:-1], i[-1]) for i in check_jobs)
 
         wu_id_start = wu_id
-        madx_table = OrderedDict()
-        for ky in keys:
-            madx_table[ky] = []
-        madx_table['wu_id'] = []
-        madx_table['status'] = []
-        madx_table['job_name'] = []
-        madx_table['mtime'] = []
-
-        #if not force_update:
-        #    if (wu_id != 0) and (not db_check):
-        #        self._logger.warning('''You are going to update the database
-        #        which is not empty, you must assign 'db_check' to True to
-        #        avoid duplicate rows (It would be a little slow)! If you are
-        #        pretty sure there aren't duplicate rows, you can skip db check
-        #        with 'force_update'. But you should be responsible for this!''')
-        #        return
-        #else:
-        #    db_check = False
-        #    if wu_id != 0:
-        #        self._logger.warning('Attention! Force update(skip db '
-        #                'check) is selected, make sure no duplications!')
-        new_elements = set(self.custom_product_preprocess(pre_news))-\
-                set(self.custom_product_preprocess(pre_records))
+        prefix = self.madx_input['mask_file'].split('.')[0]
+        new_madx_ids = []
+
+        def madx_rows():
+            wu_id = wu_id_start
+            for element in pre_space.new_cells(
+                    self._custom_product('preprocess')):
+                # avoid empty element
+                if not element:
+                    continue
+                if db_check and (element in check_params):
+                    name = check_params[element]
+                    content = "The job %s is already in the database!" % name
+                    self._logger.warning(content)
+                    continue
+                job_name = self.name_conven(prefix, keys, element, '')
+                wu_id += 1
+                new_madx_ids.append(wu_id)
+                yield tuple(element) + (wu_id, 'incomplete', job_name,
+                                        int(time.time() * 1E7))
 
         self._logger.info("updating preprocess_wu table.....")
-        bar = utils.ProgressBar(len(new_elements))
-        for element in new_elements:
-            bar.update()
-            # avoid empty element
-            if not element:
-                continue
-            if db_check and (element in check_params):
-                i = check_params.index(element)
-                name = check_jobs[i][1]
-                content = "The job %s is already in the database!" % name
-                self._logger.warning(content)
-                continue
-            for i in range(len(element)):
-                ky = keys[i]
-                vl = element[i]
-                madx_table[ky].append(vl)
-            prefix = self.madx_input['mask_file'].split('.')[0]
-            job_name = self.name_conven(prefix, keys, element, '')
-            wu_id += 1
-            madx_table['wu_id'].append(wu_id)
-            madx_table['status'].append('incomplete')
-            madx_table['job_name'].append(job_name)
-            madx_table['mtime'].append(int(time.time() * 1E7))
-        self.db.insertm('preprocess_wu', madx_table)
-        self._logger.info(f'Add {wu_id-wu_id_start} new preprocess '
-                f'jobs into database! A total of {wu_id}!')
+        columns = keys + ['wu_id', 'status', 'job_name', 'mtime']
+        num = self._insertm_chunks('preprocess_wu', columns, madx_rows())
+        self._update_param_index('preprocess_wu', pre_space.new_values())
+        self._logger.info(f'Add {num} new preprocess jobs into database! '
+                          f'A total of {wu_id_start + num}!')
 
         # prepare sixtrack parameters in database
         six_records = records['sixtrack_wu']
-        six_news = news['sixtrack_wu']
-        new_madx_ids = madx_table['wu_id']
-        if pre_wu_ids and six_records:
+        six_params = OrderedDict(self.sixtrack_params)
+        six_params['preprocess_id'] = pre_wu_ids + new_madx_ids
+        if six_records:
             six_records['preprocess_id'] = pre_wu_ids
-        six_news['preprocess_id'] = list(pre_wu_ids) + new_madx_ids
-        keys = list(self.sixtrack_params.keys())
-        keys.append('preprocess_id')
-
-        outputs = self.db.select('sixtrack_wu', keys, where='first_turn is null')
-        namevsid = self.db.select('sixtrack_wu', ['wu_id', 'job_name'],
-                                  DISTINCT=True)
-        if namevsid:
-            records = list(zip(*namevsid))
-            wu_ids = records[0]
-            wu_id = max(wu_ids) # get the last wu_id
-        else:
-            wu_id = 0
+        six_space = paramspace.ParameterSpace(six_params, six_records)
+        keys = list(six_params.keys())
+
+        last_wu = self.db.select('sixtrack_wu', ['max(wu_id)'])
+        wu_id = last_wu[0][0] or 0  # get the last wu_id
+        outputs = {}
+        if db_check:
+            outputs = self.db.select('sixtrack_wu', keys + ['job_name'],
+                                     where='first_turn is null')
+            outputs = dict((i[:-1], i[-1]) for i in outputs)
         wu_id_start = wu_id
-        six_table = OrderedDict()
-        for ky in keys:
-            six_table[ky] = []
-        six_table['wu_id']=[]
-        six_table['last_turn']=[]
-        six_table['job_name']=[]
-        six_table['status']=[]
-        six_table['mtime']=[]
-        six_table['preprocess_id'] = []
-
-        new_elements = set(self.custom_product_sixtrack(six_news))-\
-                set(self.custom_product_sixtrack(six_records))
+        last_turn = self.sixtrack_params['turnss']
+        pre_index = keys.index('preprocess_id')
+
+        def six_rows():
+            wu_id = wu_id_start
+            for element in six_space.new_cells(
+                    self._custom_product('sixtrack')):
+                # avoid empty element
+                if not element:
+                    continue
+                if db_check and (element in outputs):
+                    nm = outputs[element]
+                    content = f"The sixtrack job {nm} is already in the database!"
+                    self._logger.warning(content)
+                    continue
+                pre_id = element[pre_index]  # madx_id(wu_id)
+                wu_id += 1
+                job_name = f'sixtrack_job_preprocess_id_{pre_id}_wu_id_{wu_id}'
+                yield tuple(element) + (wu_id, last_turn, job_name,
+                                        'incomplete', int(time.time() * 1E7))
+
         self._logger.info("updating sixtrack_wu table.....")
-        bar = utils.ProgressBar(len(new_elements))
-        for element in new_elements:
-            bar.update()
-            # avoid empty element
-            if not element:
-                continue
-            if db_check and (element in outputs):
-                i = outputs.index(element)
-                nm = namevsid[i][1]
-                content = f"The sixtrack job {nm} is already in the database!"
-                self._logger.warning(content)
-                continue
-            for i in range(len(element)):
-                ky = keys[i]
-                vl = element[i]
-                if isinstance(vl, Iterable):
-                    vl = str(vl)
-                six_table[ky].append(vl)
-            pre_id = six_table['preprocess_id'][-1]  # madx_id(wu_id)
-            wu_id += 1
-            six_table['wu_id'].append(wu_id)
-            last_turn = self.sixtrack_params['turnss']
-            six_table['last_turn'].append(last_turn)
-            job_name = f'sixtrack_job_preprocess_id_{pre_id}_wu_id_{wu_id}'
-            six_table['job_name'].append(job_name)
-            six_table['status'].append('incomplete')
-            six_table['mtime'].append(int(time.time() * 1E7))
-        self.db.insertm('sixtrack_wu', six_table)
-        self._logger.info(f'Add {wu_id-wu_id_start} new sixtrack jobs into '
-                f'database! A total of {wu_id}!')
-
-    def info(self, job=2, verbose=False, where=None):
+        columns = keys + ['wu_id', 'last_turn', 'job_name', 'status', 'mtime']
+        num = self._insertm_chunks('sixtrack_wu', columns, six_rows())
+        six_news = six_space.new_values()
+        six_news.pop('preprocess_id')
+        self._update_param_index('sixtrack_wu', six_news)
+        self._logger.info(f'Add {num} new sixtrack jobs into database! '
+                          f'A total of {wu_id_start + num}!')
+
+    def _insertm_chunks(self, table_name, columns, rows):
+        '''Insert the rows of an iterable in chunks of db_chunksize rows, so
+        that the memory stays bounded whatever the number of rows.
+        @table_name The table name
+        @columns(list) The column names, ordered as the values of each row
+        @rows(iterable) The rows to insert, tuples of values
+        @return(int) The number of inserted rows
+        '''
+        total = 0
+        rows = iter(rows)
+        chunk = list(itertools.islice(rows, self.db_chunksize))
+        while chunk:
+            self.db.insertm(table_name, OrderedDict(zip(columns, zip(*chunk))))
+            total += len(chunk)
+            self._logger.info(f'{total} rows inserted into {table_name}....')
+            chunk = list(itertools.islice(rows, self.db_chunksize))
+        return total
+
+    def dedup_report(self, tables=None):
+        '''Report the deduplication of the blob columns: the number of
+        stored values, of unique payloads, the logical size and the size
+        actually stored (unique payloads in the blob store, every inline
+        value in the database).
+        @tables(list) The tables to check, by default templates,
+        preprocess_task and sixtrack_task
+        @return(dict) The statistics of each table
+        '''
+        if tables is None:
+            tables = ['templates', 'preprocess_task', 'sixtrack_task']
+        store = blobstore.get_blob_store()
+        report = OrderedDict()
+        for table in tables:
+            cols = [k for k, v in self.tables[table].items() if 'blob' in
+                    v.lower()]
+            stat = dict.fromkeys(['values', 'unique', 'logical', 'stored'], 0)
+            sizes = {}
+            for col in cols:
+                where = '%s is not null' % col.replace('.', '_')
+                for row in self.db.iselect(table, [col], where):
+                    buf = row[0]
+                    stat['values'] += 1
+                    if blobstore.is_ref(buf):
+                        key = blobstore.ref_key(buf)
+                        if key not in sizes:
+                            sizes[key] = store.size(key) if store else 0
+                            stat['stored'] += sizes[key]
+                    else:
+                        key = blobstore.BlobStore.key(buf)
+                        sizes[key] = len(buf)
+                        stat['stored'] += len(buf)
+                    stat['logical'] += sizes[key]
+            stat['unique'] = len(sizes)
+            stat['saved'] = stat['logical'] - stat['stored']
+            stat['ratio'] = stat['logical'] / stat['stored'] if\
+                stat['stored'] else 1.0
+            report[table] = stat
+            content = f"{table}: {stat['values']} blobs, {stat['unique']} "\
+                f"unique, {stat['logical']} bytes referenced, "\
+                f"{stat['stored']} bytes stored, dedup ratio "\
+                f"{stat['ratio']:.2f}, {stat['saved']} bytes saved"
+            self._logger.info(content)
+        return report
+
+    def switch_db_profile(self, profile):
+        '''Switch the existing database to the given pragma profile (or dict
+        of settings), e.g. 'concurrent-read', and use it from now on. The
+        profile is stored in the env table and applied when the study is
+        loaded again'''
+        self.db.migrate(profile)
+        self.db_settings = profile
+        values = {'db_profile': json.dumps(profile)}
+        if self.db.select('env', ['db_profile']):
+            self.db.update('env', values)
+        else:
+            self.db.insert('env', values)
+        content = "The database now uses the settings %s." % str(profile)
+        self._logger.info(content)
+
+    def info(self, job=2, verbose=False, where=None, breakdown=None,
+             batch_size=1000):
         '''Print the status information of this study.
         job=
         0: print madx, oneturn sixtrack job
         1: print sixtrack job
         2: print madx, oneturn sixtrack and sixtrack jobs
-        where: the filter condition for database query, e.g. "status='complete'"'''
+        where: the filter condition for database query, e.g. "status='complete'"
+        breakdown: the column(s) to break down the status counts by, e.g.
+        'batch_name' or 'preprocess_id' (the latter for sixtrack jobs only)
+        verbose: print the selected work units, streamed from the database
+        batch_size: the number of work units fetched at once in verbose mode'''
         query_list = ['wu_id', 'job_name', 'status', 'unique_id']
         typ = ['preprocess_wu', 'sixtrack_wu']
         titles = ['madx and one turn sixtrack jobs:', 'Sixtrack jobs:']
+        status_list = ['complete', 'submitted', 'incomplete']
+        if isinstance(breakdown, str):
+            breakdown = [breakdown]
+
+        def format_counts(counts):
+            return ', '.join([f'{i}: {counts.get(i, 0)}' for i in status_list])
+
         def query(index):
-            wus = self.db.select(typ[int(index)], query_list, where)
+            table_name = typ[int(index)]
+            counts = self.db.select(table_name, ['status', 'count(*)'], where,
+                                    groupby=['status'])
+            counts = dict(counts)
             content = '\n'+titles[int(index)] + '\n'
-            comp = []
-            subm = []
-            incm = []
-            if wus:
-                results = dict(zip(query_list, zip(*wus)))
-                for ele in results['status']:
-                    if ele == 'complete':
-                        comp.append(ele)
-                    if ele == 'submitted':
-                        subm.append(ele)
-                    if ele == 'incomplete':
-                        incm.append(ele)
-            content += f'complete: {len(comp)} \n'
-            content += f'submitted: {len(subm)} \n'
-            content += f'incomplete: {len(incm)}\n'
+            content += f'complete: {counts.get("complete", 0)} \n'
+            content += f'submitted: {counts.get("submitted", 0)} \n'
+            content += f'incomplete: {counts.get("incomplete", 0)}\n'
+            cols = [i for i in breakdown or [] if i in
+                    self.tables[table_name]]
+            if cols:
+                groups = OrderedDict()
+                outs = self.db.select(table_name, cols + ['status', 'count(*)'],
+                                      where, orderby=cols,
+                                      groupby=cols + ['status'])
+                for out in outs:
+                    group = groups.setdefault(out[:len(cols)], {})
+                    group[out[-2]] = out[-1]
+                for group, group_counts in groups.items():
+                    name = ', '.join(['%s=%s' % i for i in zip(cols, group)])
+                    content += f'{name}: {format_counts(group_counts)}\n'
             self._logger.info(content)
             if verbose:
                 print(query_list)
-                for i in wus:
+                orderby = self.table_keys.get(table_name, {}).get('primary')
+                for i in self.db.iselect(table_name, query_list, where,
+                                         orderby, batch_size):
                     print(i)
         if job == 0 or job == 2:
             query(0)
@@ -616,22 +774,39 @@ class Study(object):
         if status:
             content = "Submit %s job successfully!" % jobname
             self._logger.info(content)
-            table = {}
-            table['status'] = 'submitted'
-            self._logger.info(f"Updating the {table_name} table for job status.....")
-            bar = utils.ProgressBar(len(out))
-            for ky, vl in out.items():
-                bar.update()
-                keys = ky.split('-')
-                for k in keys:
-                    where = 'task_id=%s' % k
-                    table['unique_id'] = vl
-                    table['batch_name'] = batch_name
-                    self.db.update(table_name, table, where)
+            self.mark_submitted(table_name, out, batch_name)
         else:
             content = "Failed to submit %s job!" % jobname
             self._logger.error(content)
 
+    def mark_submitted(self, table_name, out, batch_name):
+        '''Set the status, unique_id and batch_name of the submitted tasks
+        in one transaction.
+        @table_name The name of the work unit table
+        @out(dict) The unique ids of the submitted jobs, keyed by task ids
+        (or grouped task ids joined with '-')
+        @batch_name The batch name of the submission
+        '''
+        task_ids = []
+        unique_ids = []
+        for ky, vl in out.items():
+            for k in ky.split('-'):
+                task_ids.append(int(k))
+                unique_ids.append(vl)
+        if not task_ids:
+            return
+        num = len(task_ids)
+        table = {}
+        table['status'] = ['submitted'] * num
+        table['unique_id'] = unique_ids
+        table['batch_name'] = [batch_name] * num
+        where = {'task_id': task_ids}
+        chunksize = self.db.adaptor.chunksize
+        self._logger.info(f"Updating the {table_name} table for job status.....")
+        bar = utils.ProgressBar(math.ceil(num / chunksize))
+        self.db.updatem(table_name, table, where, chunksize,
+                        progress=lambda rows: bar.update())
+
     def collect_result(self, typ, boinc=False):
         '''Collect the results of preprocess or sixtrack jobs'''
         config = {}
@@ -639,6 +814,15 @@ class Study(object):
         config['info'] = info_sec
         config['db_setting'] = self.db_settings
         config['db_info'] = self.db_info
+        info_sec['db_pool'] = self.db_pool
+        info_sec['workers'] = self.gather_workers
+        info_sec['incremental'] = self.gather_incremental
+        info_sec['parse_arrays'] = self.parse_arrays
+        # the worker processes of the collection set them again
+        if self.blob_store:
+            config['blob_store'] = dict(self.blob_store)
+        if self.codec:
+            config['codec'] = dict(self.codec)
 
         if typ == 0:
             if self.oneturn:
@@ -718,43 +902,18 @@ class Study(object):
         if boinc:
             outputs['boinc'] = ['true'] * len(wu_ids)
         pre_ids = outputs['preprocess_id']
-        task_table = {}
-        wu_table = {}
-        task_ids = OrderedDict()
-        mtime = int(time.time() * 1E7)
-        task_table['wu_id'] = []
-        task_table['last_turn'] = []
-        task_table['mtime'] = []
         self._logger.info("creating new lines in sixtrack_task table.....")
-        bar = utils.ProgressBar(len(last_turns))
-        for wu_id, last_turn in zip(wu_ids, last_turns):
-            bar.update()
-            where = f'wu_id={wu_id} and last_turn={last_turn} and status is null'
-            chck = self.db.select('sixtrack_task', ['task_id'], where)
-            if chck:
-                task_id = chck[0][0]
-                task_ids[task_id] = (wu_id, last_turn)
-            else:
-                task_table['wu_id'].append(wu_id)
-                task_table['last_turn'].append(last_turn)
-                task_table['mtime'].append(mtime)
-        if task_table['wu_id']:
-            self.db.insertm('sixtrack_task', task_table)
-            where = f"mtime={mtime}"
-            reviews = self.db.select('sixtrack_task', ['task_id', 'wu_id', 'last_turn'], where)
-            for ti, wi, lt in reviews:
-                task_ids[ti] = (wi, lt)
-        wu_table['task_id'] = list(task_ids.keys())
-        wu_table['mtime'] = [int(time.time() * 1E7), ]*len(task_ids)
+        mtime = int(time.time() * 1E7)
+        task_ids = self._allocate_tasks('sixtrack_task', ['wu_id', 'last_turn'],
+                                        list(zip(wu_ids, last_turns)), mtime)
+        wu_table = {}
+        wu_table['task_id'] = task_ids
+        wu_table['mtime'] = [int(time.time() * 1E7), ] * len(task_ids)
         where = {}
-        where['wu_id'] = []
-        where['last_turn'] = []
-        for i in task_ids.values():
-            where['wu_id'].append(i[0])
-            where['last_turn'].append(i[1])# wu_id is not unique now
+        where['wu_id'] = list(wu_ids)
+        where['last_turn'] = list(last_turns)  # wu_id is not unique now
         self.db.updatem('sixtrack_wu', wu_table, where)
 
-        task_ids = list(task_ids.keys())
         outputs['task_id'] = task_ids
         group_results['task_id'] = task_ids
         db_info = {}
@@ -842,6 +1001,13 @@ class Study(object):
                 self.db.insertm('sixtrack_wu_tmp', outputs)
         if boinc:
             self.init_boinc_dir()
+        six_sec = self.sixtrack_config['sixtrack']
+        six_sec.pop('fort3_archive', None)
+        if self.prerender_fort3 and not boinc:
+            archive = os.path.join(self.paths['sixtrack_in'], 'fort3.zip')
+            self._prerender_fort3(outputs, archive)
+            six_sec['fort3_archive'] = os.path.basename(archive)
+            tran_input.append(archive)
         input_info = os.path.join(self.paths['sixtrack_in'], 'input.ini')
         self.config.clear()
         self.config.read_dict(self.sixtrack_config)
@@ -875,39 +1041,37 @@ class Study(object):
         names = list(self.tables['preprocess_wu'].keys())
         outputs = dict(zip(names, zip(*results)))
         wu_ids = outputs['wu_id']
-        task_table = {}
-        wu_table = {}
         self._logger.info("creating new lines in preprocess_task table.....")
-        bar = utils.ProgressBar(len(wu_ids))
         mtime = int(time.time() * 1E7)
-        task_table['wu_id'] = []
-        task_table['mtime'] = []
-        task_ids = OrderedDict()
-        for wu_id in wu_ids:
-            bar.update()
-            where = f'wu_id={wu_id} and status is null'
-            chck = self.db.select('preprocess_task', ['task_id'], where)
-            if chck:
-                task_ids[chck[0][0]] = wu_id
-            else:
-                task_table['wu_id'].append(wu_id)
-                task_table['mtime'].append(mtime)
-                #self.db.insert('preprocess_task', task_table)
-                #where = "mtime=%s and wu_id=%s" % (task_table['mtime'], wu_id)
-                #task_id = self.db.select('preprocess_task', ['task_id'], where)
-                #task_id = task_id[0][0]
-        if task_table['wu_id']:
-            self.db.insertm('preprocess_task', task_table)
-            where = f"mtime={mtime}"
-            task_ids_new = self.db.select('preprocess_task', ['wu_id', 'task_id'], where)
-            for i in task_ids_new:
-                task_ids[i[1]]=i[0]
-        wu_table['task_id'] = list(task_ids.keys())
-        wu_table['mtime'] = [int(time.time() * 1E7),] * len(task_ids)
-        where = dict([('wu_id', wu_ids)])
+        task_ids = self._allocate_tasks('preprocess_task', ['wu_id'],
+                                        [(i,) for i in wu_ids], mtime)
+        wu_table = {}
+        wu_table['task_id'] = task_ids
+        wu_table['mtime'] = [int(time.time() * 1E7), ] * len(task_ids)
+        where = dict([('wu_id', list(wu_ids))])
         self.db.updatem('preprocess_wu', wu_table, where)
 
-        task_ids = list(task_ids.keys())
+        hits = {}
+        if self._use_madx_cache():
+            # the executable is identified once here, the jobs compute the
+            # cache keys with the same identity (see PreprocessJob)
+            exe_id = utils.madx_exe_id(self.paths['madx_exe'])
+            self.preprocess_config['madx']['exe_id'] = exe_id
+            self._update_madx_cache()
+            hits = self._lookup_madx_cache(outputs, exe_id)
+        if hits and not (self.oneturn or self.collimation):
+            # nothing else to run for these tasks
+            self._complete_from_madx_cache(task_ids, hits)
+            rest = [i for i in range(len(task_ids)) if i not in hits]
+            outputs = dict((k, [v[i] for i in rest]) for k, v in
+                           outputs.items())
+            task_ids = [task_ids[i] for i in rest]
+            hits = {}
+            if not task_ids:
+                self._logger.info("All the preprocess jobs are done by the "
+                                  "madx cache!")
+                return
+
         db_info = {}
         db_info.update(self.db_info)
         if db_info['db_type'].lower() == 'sql':
@@ -924,6 +1088,16 @@ class Study(object):
             sub_db.insertm('templates', temp_ins)
             outputs['task_id'] = task_ids
             sub_db.insertm('preprocess_wu', outputs)
+            if self._use_madx_cache():
+                # the jobs look for their madx outputs in the sub database
+                sub_db.create_table('madx_cache', self.tables['madx_cache'],
+                                    self.table_keys['madx_cache'])
+                rows = dict((hit[1]['cache_key'], hit[1]) for hit in
+                            hits.values())
+                if rows:
+                    names = list(self.tables['madx_cache'].keys())
+                    sub_db.insertm('madx_cache', dict(
+                        (k, [row[k] for row in rows.values()]) for k in names))
             sub_db.close()
             db_info['db_name'] = 'sub.db'
             content = "The submitted database %s is ready!" % db_info['db_name']
@@ -943,6 +1117,202 @@ class Study(object):
         self.submission.prepare(task_ids, trans, exe, 'input.ini', in_path,
                                 out_path, flavour='espresso', *args, **kwargs)
 
+    def _use_madx_cache(self):
+        '''The madx cache is used if the outputs of madx are stored in the
+        preprocess tasks'''
+        return bool(self.madx_cache) and set(self.madx_output.values()) <=\
+            set(self.preprocess_output.values())
+
+    def _update_madx_cache(self):
+        '''Store the madx outputs of the successful preprocess tasks which
+        aren't in the madx cache yet'''
+        names = [i for i in self.tables['madx_cache'].keys() if i != 'mtime']
+        cols = ['madx_key' if i == 'cache_key' else i for i in names]
+        where = "status='Success' and madx_key is not null and madx_key "\
+            "not in (select cache_key from madx_cache)"
+        rows = self.db.select('preprocess_task', cols, where)
+        if not rows:
+            return
+        # the tasks with the same inputs have the same outputs
+        rows = list(dict((row[0], row) for row in rows).values())
+        values = OrderedDict(zip(names, zip(*rows)))
+        values['mtime'] = [int(time.time() * 1E7)] * len(rows)
+        self.db.insertm('madx_cache', values)
+        content = f"Stored the madx outputs of {len(rows)} tasks in the cache."
+        self._logger.info(content)
+
+    def _lookup_madx_cache(self, outputs, exe_id):
+        '''Look for the madx outputs of the preprocess work units in the
+        madx cache, the masks are rendered as the jobs would do it (see
+        PreprocessJob.madx_prep)
+        @outputs(dict) The preprocess_wu columns of the work units
+        @exe_id(str) The identity of the madx executable, see
+        utils.madx_exe_id
+        @return(dict) The rendered mask and the madx_cache row (dict) of the
+        work units found in the cache, by index
+        '''
+        temp_buf = self.db.select('templates', ['mask_file'])[0][0]
+        keys = list(self.madx_params.keys())
+        template = utils.Template(utils.decompress_buf(temp_buf, None, 'buf'),
+                                  ['%' + key for key in keys])
+        outs = list(self.madx_output.values())
+        masks = []
+        cache_keys = []
+        for i in range(len(outputs['wu_id'])):
+            mask = template.render([outputs[key][i] for key in keys])
+            masks.append(mask)
+            cache_keys.append(utils.madx_cache_key(mask, exe_id, outs))
+        names = list(self.tables['madx_cache'].keys())
+        rows = self.db.selectm('madx_cache', names, 'cache_key',
+                               sorted(set(cache_keys)))
+        cache = dict((row[0], dict(zip(names, row))) for row in rows)
+        hits = {}
+        for i, key in enumerate(cache_keys):
+            if key in cache:
+                hits[i] = (masks[i], cache[key])
+        if hits:
+            content = f"Found the madx outputs of {len(hits)} preprocess "\
+                "jobs in the cache."
+            self._logger.info(content)
+        return hits
+
+    def _complete_from_madx_cache(self, task_ids, hits):
+        '''Complete the preprocess tasks with the outputs of the madx cache
+        @task_ids(list) The task ids of the work units
+        @hits(dict) See _lookup_madx_cache
+        '''
+        outs = list(self.madx_output.values())
+        mtime = int(time.time() * 1E7)
+        ids = [task_ids[i] for i in hits.keys()]
+        task_table = OrderedDict()
+        task_table['madx_in'] = [utils.compress_buf(mask, 'str') for mask, _
+                                 in hits.values()]
+        for name in ['madx_stdout'] + outs:
+            task_table[name] = [row[name] for _, row in hits.values()]
+        task_table['madx_key'] = [row['cache_key'] for _, row in hits.values()]
+        task_table['status'] = ['Success'] * len(ids)
+        task_table['mtime'] = [mtime] * len(ids)
+        with self.db.transaction():
+            self.db.updatem('preprocess_task', task_table, {'task_id': ids})
+            self.db.updatem('preprocess_wu',
+                            {'status': ['complete'] * len(ids),
+                             'mtime': [mtime] * len(ids)},
+                            {'task_id': ids})
+        content = f"{len(ids)} preprocess tasks are completed by the madx "\
+            "cache."
+        self._logger.info(content)
+
+    def _prerender_fort3(self, outputs, archive):
+        '''Render the fort.3 of the tracking tasks as the jobs would do it
+        (see TrackingJob.sixtrack_prep_job), the fort.3 of a task is named
+        <task_id>/fort.3 in the zip archive
+        @outputs(dict) The sixtrack_wu columns of the tasks
+        @archive The path of the zip archive
+        '''
+        self._logger.info("Rendering the fort.3 of the sixtrack jobs.....")
+        input_files = json.loads(self.sixtrack_config['sixtrack']['input_files'])
+        fc3, fc3_aux = input_files['fc.3'], input_files['fc.3.aux']
+        keys = list(self.sixtrack_config['fort3'].keys())
+        if 'length' not in keys:
+            keys.append('length')
+        temp_buf = self.db.select('templates', ['fort_file'])[0][0]
+        template = utils.Template(utils.decompress_buf(temp_buf, None, 'buf'),
+                                  ['%' + key for key in keys])
+
+        pre_ids = sorted(set(outputs['preprocess_id']))
+        constr = "wu_id in (%s)" % (','.join(map(str, pre_ids)))
+        pre_tasks = dict(self.db.select('preprocess_wu', ['wu_id', 'task_id'],
+                                        where=constr))
+        tasks = {}
+        for i, pre_id in enumerate(outputs['preprocess_id']):
+            tasks.setdefault(pre_id, []).append(i)
+        bar = utils.ProgressBar(len(outputs['task_id']))
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as ziph:
+            for pre_id in pre_ids:
+                bufs = self.db.select('preprocess_task', [fc3, fc3_aux],
+                                      where=f'task_id={pre_tasks[pre_id]}')
+                fc3_text = utils.decompress_buf(bufs[0][0], None, des='buf')
+                aux_text = utils.decompress_buf(bufs[0][1], None, des='buf')
+                length = aux_text.splitlines()[1].split()[4]
+                for i in tasks[pre_id]:
+                    bar.update()
+                    values = [length if key == 'length' else outputs[key][i]
+                              for key in keys]
+                    fort3 = utils.concatenate_texts([template.render(values),
+                                                     fc3_text])
+                    ziph.writestr(f"{outputs['task_id'][i]}/fort.3", fort3)
+
+    def _load_db_profile(self, table_names):
+        '''Apply the profile stored by switch_db_profile() instead of the
+        default db_settings, else the next load would switch the database
+        back'''
+        if 'env' in table_names:
+            outputs = self.db.select('env', ['db_profile'])
+            if outputs and outputs[0][0]:
+                self.db_settings = json.loads(outputs[0][0])
+        self.db.settings = self.db_settings
+        self.db.setting(self.db_settings)
+
+    def _upgrade_columns(self, table_names):
+        '''Add the columns missing in the existing tables, e.g. in a database
+        created by an older version'''
+        for name in table_names:
+            if name not in self.tables:
+                continue
+            news = self.db.add_columns(name, self.tables[name])
+            if news:
+                content = "Added the columns %s to the existing table %s." % (
+                    ', '.join(news), name)
+                self._logger.info(content)
+
+    def _upgrade_indexes(self, table_names):
+        '''Create the secondary indexes missing in the existing tables, e.g.
+        in a database created by an older version'''
+        for name in table_names:
+            if name not in self.tables or name not in self.table_keys:
+                continue
+            indexes = self.table_keys[name].get('index', [])
+            if not indexes:
+                continue
+            news = self.db.create_indexes(name, indexes, self.tables[name])
+            if news:
+                content = "Created the indexes %s on the existing table %s." % (
+                    ', '.join(news), name)
+                self._logger.info(content)
+
+    def _allocate_tasks(self, table_name, keys, wus, mtime):
+        '''Allocate the task rows for the given work units with a fixed
+        number of queries. A pending task (status is null) of a work unit is
+        reused, the missing ones are inserted with consecutive task ids.
+        @table_name The task table, e.g. 'sixtrack_task'
+        @keys(list) The columns identifying a work unit, e.g. ['wu_id']
+        @wus(list) The identifiers (tuples ordered as keys) of the work units
+        @mtime The modification time of the new rows
+        @return(list) The task ids in the same order as wus
+        '''
+        pending = self.db.select(table_name, ['task_id'] + keys,
+                                 'status is null', orderby=['task_id'])
+        reusable = {}
+        for row in pending:
+            reusable.setdefault(tuple(row[1:]), row[0])
+        task_ids = [reusable.pop(tuple(wu), None) for wu in wus]
+        missing = [i for i, task_id in enumerate(task_ids) if task_id is None]
+        if missing:
+            last_id = self.db.select(table_name, ['max(task_id)'])[0][0]
+            first_id = (last_id or 0) + 1
+            new_ids = list(range(first_id, first_id + len(missing)))
+            task_table = OrderedDict()
+            task_table['task_id'] = new_ids
+            for key, vals in zip(keys, zip(*[wus[i] for i in missing])):
+                task_table[key] = vals
+            task_table['mtime'] = [mtime] * len(missing)
+            self.db.insertm(table_name, task_table)
+            for i, task_id in zip(missing, new_ids):
+                task_ids[i] = task_id
+        self._logger.info(f"{len(wus) - len(missing)} tasks reused and "
+                          f"{len(missing)} tasks created in {table_name}.")
+        return task_ids
+
     def _group_records(self, outputs, groupby):
         '''Group the records from db by given rules'''
         task_ids = []
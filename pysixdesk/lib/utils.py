@@ -3,14 +3,43 @@ import io
 import re
 import sys
 import math
+import time
 import gzip
+import json
 import shutil
+import signal
+import hashlib
 import logging
 import difflib
+import subprocess
+from collections import OrderedDict
+
+from . import blobstore
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # Gobal variables
 PYSIXDESK_ABSPATH = os.path.dirname(os.path.dirname(os.path.dirname(
     os.path.abspath(__file__))))
+# the size (bytes) of the chunks streamed by compress_buf and decompress_buf
+CHUNK_SIZE = 1 << 20
+# the file of the resource usage of a job, stored with its results
+STATS_FILE = 'job_stats.json'
+# the file of the madx cache key of a preprocess job, stored with its results
+MADX_KEY_FILE = 'madx_key'
 
 
 def check(files):
@@ -70,22 +99,82 @@ def check_fort3_block(fort3, block):
     return False
 
 
-def replace(patterns, replacements, source, dest):
-    '''Reads a source file and writes the destination file.
-    In each line, replaces patterns with replacements.
-    '''
+class Template(object):
+    '''A text with placeholders, parsed once into a list of tokens: the
+    literal text and the indexes of the placeholders. At each position the
+    longest placeholder matches, e.g. %tunex1 isn't read as %tunex followed
+    by 1.'''
+
+    def __init__(self, text, patterns):
+        '''Constructor
+        Args:
+            text (str): The content of the template
+            patterns (list): The placeholders
+        '''
+        self.patterns = list(patterns)
+        self.tokens = []
+        if not self.patterns:
+            self.tokens.append(text)
+            return
+        index = dict((pat, i) for i, pat in enumerate(self.patterns))
+        alternation = '|'.join(re.escape(pat) for pat in
+                               sorted(index.keys(), key=len, reverse=True))
+        pos = 0
+        for match in re.finditer(alternation, text):
+            if match.start() > pos:
+                self.tokens.append(text[pos:match.start()])
+            self.tokens.append(index[match.group()])
+            pos = match.end()
+        if pos < len(text):
+            self.tokens.append(text[pos:])
+
+    def render(self, replacements):
+        '''Return the text with the placeholders replaced
+        Args:
+            replacements (list or dict): The values in the order of the
+            patterns, or a dict of the values by pattern
+        Returns:
+            str: The rendered text
+        '''
+        if isinstance(replacements, dict):
+            values = [str(replacements[pat]) for pat in self.patterns]
+        else:
+            values = [str(val) for val in replacements]
+        return ''.join(values[tok] if isinstance(tok, int) else tok
+                       for tok in self.tokens)
+
+
+# the compiled templates, by content and placeholders, the least recently
+# used ones are dropped beyond TEMPLATE_CACHE_SIZE
+_templates = OrderedDict()
+TEMPLATE_CACHE_SIZE = 32
+
+
+def compile_template(source, patterns):
+    '''Return the compiled Template of a file. A content is parsed only
+    once, also from another file, e.g. the copies of a template in the
+    folders of the tasks.'''
     if not os.path.isfile(source):
         raise FileNotFoundError("The file %s doesn't exist!" % source)
+    with open(source, 'r') as fin:
+        text = fin.read()
+    key = (hashlib.sha256(text.encode()).hexdigest(), tuple(patterns))
+    template = _templates.pop(key, None)
+    if template is None:
+        template = Template(text, patterns)
+    _templates[key] = template
+    while len(_templates) > TEMPLATE_CACHE_SIZE:
+        _templates.popitem(last=False)
+    return template
+
 
-    fin = open(source, 'r')
-    fout = open(dest, 'w')
-    num = len(patterns)
-    for line in fin:
-        for i in range(num):
-            line = re.sub(patterns[i], str(replacements[i]), line)
-        fout.write(line)
-    fin.close()
-    fout.close()
+def replace(patterns, replacements, source, dest):
+    '''Reads a source file and writes the destination file.
+    Replaces the patterns with the replacements, see Template.
+    '''
+    template = compile_template(source, patterns)
+    with open(dest, 'w') as fout:
+        fout.write(template.render(replacements))
 
 
 def diff(file1, file2, logger=None, **kwargs):
@@ -122,64 +211,513 @@ def diff(file1, file2, logger=None, **kwargs):
         display(f'▲▲▲▲▲▲▲▲▲▲▲▲▲ {file1} --> {file2} diff ▲▲▲▲▲▲▲▲▲▲▲▲▲')
 
 
+class Codec(object):
+    '''The compression of the buffers stored in the database. The compressed
+    data starts with the magic number of its format, so a buffer is decoded
+    with the right codec whatever the codec of the study is.'''
+
+    name = None
+    magic = b''
+
+    def __init__(self, level=None):
+        self.level = None if level is None else int(level)
+
+    def writer(self, fileobj):
+        '''Return a file object compressing the data written in fileobj,
+        fileobj isn't closed with it'''
+        raise NotImplementedError
+
+    def reader(self, fileobj):
+        '''Return a file object decompressing the data read from fileobj,
+        fileobj isn't closed with it'''
+        raise NotImplementedError
+
+    def compress(self, data):
+        zbuf = io.BytesIO()
+        with self.writer(zbuf) as f_out:
+            f_out.write(data)
+        return zbuf.getvalue()
+
+    def decompress(self, data):
+        with self.reader(BufferReader(data)) as f_in:
+            return f_in.read()
+
+
+class GzipCodec(Codec):
+
+    name = 'gzip'
+    magic = b'\x1f\x8b'
+
+    def writer(self, fileobj):
+        level = 9 if self.level is None else self.level
+        # no timestamp in the header, so the output is deterministic
+        return gzip.GzipFile(mode='wb', fileobj=fileobj, mtime=0,
+                             compresslevel=level)
+
+    def reader(self, fileobj):
+        return gzip.GzipFile(mode='rb', fileobj=fileobj)
+
+
+class ZstdCodec(Codec):
+    '''Zstandard, optionally with a dictionary trained on small similar
+    files (see train_zstd_dictionary), which needs the same dictionary to be
+    decompressed'''
+
+    name = 'zstd'
+    magic = b'\x28\xb5\x2f\xfd'
+    # the loaded dictionaries, by dictionary id
+    dictionaries = {}
+
+    def __init__(self, level=None, dictionary=None):
+        if zstandard is None:
+            raise ImportError("The zstd codec needs the zstandard package!")
+        super().__init__(3 if level is None else level)
+        self.dictionary = None
+        if dictionary:
+            self.dictionary = self.load_dictionary(dictionary)
+
+    @classmethod
+    def load_dictionary(cls, path):
+        with open(path, 'rb') as f_in:
+            dict_data = zstandard.ZstdCompressionDict(f_in.read())
+        cls.dictionaries[dict_data.dict_id()] = dict_data
+        return dict_data
+
+    def frame_dictionary(self, header):
+        '''Return the dictionary needed by the frame starting with header'''
+        dict_id = zstandard.get_frame_parameters(header).dict_id
+        if not dict_id:
+            return None
+        if dict_id not in self.dictionaries:
+            content = "The zstd dictionary %s isn't loaded!" % dict_id
+            raise ValueError(content)
+        return self.dictionaries[dict_id]
+
+    def writer(self, fileobj):
+        cctx = zstandard.ZstdCompressor(level=self.level,
+                                        dict_data=self.dictionary)
+        return cctx.stream_writer(fileobj, closefd=False)
+
+    def reader(self, fileobj):
+        # the frame header is 18 bytes at most
+        start = fileobj.tell()
+        dict_data = self.frame_dictionary(fileobj.read(18))
+        fileobj.seek(start)
+        dctx = zstandard.ZstdDecompressor(dict_data=dict_data)
+        return dctx.stream_reader(fileobj, closefd=False)
+
+    def compress(self, data):
+        cctx = zstandard.ZstdCompressor(level=self.level,
+                                        dict_data=self.dictionary)
+        return cctx.compress(data)
+
+    def decompress(self, data):
+        dict_data = self.frame_dictionary(data)
+        dctx = zstandard.ZstdDecompressor(dict_data=dict_data)
+        # the decompressed size is unknown in the streamed frames
+        return dctx.decompressobj().decompress(data)
+
+
+class LZ4Codec(Codec):
+
+    name = 'lz4'
+    magic = b'\x04\x22\x4d\x18'
+
+    def __init__(self, level=None):
+        if lz4frame is None:
+            raise ImportError("The lz4 codec needs the lz4 package!")
+        super().__init__(0 if level is None else level)
+
+    def writer(self, fileobj):
+        return lz4frame.LZ4FrameFile(fileobj, mode='wb',
+                                     compression_level=self.level)
+
+    def reader(self, fileobj):
+        return lz4frame.LZ4FrameFile(fileobj, mode='rb')
+
+    def compress(self, data):
+        return lz4frame.compress(data, compression_level=self.level)
+
+    def decompress(self, data):
+        return lz4frame.decompress(data)
+
+
+class BufferReader(io.RawIOBase):
+    '''A read-only file object on a bytes-like object (bytes, bytearray,
+    memoryview), which reads the data without copying the whole buffer'''
+
+    def __init__(self, buf):
+        self._view = memoryview(buf).cast('B')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        size = max(0, min(len(b), len(self._view) - self._pos))
+        b[:size] = self._view[self._pos:self._pos + size]
+        self._pos += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError('Invalid whence %s!' % whence)
+        self._pos = max(0, pos)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+# the available codecs, selected by the 'name' option of the configuration
+codecs = {'gzip': GzipCodec, 'zstd': ZstdCodec, 'lz4': LZ4Codec}
+
+# the codec used by compress_buf
+_active_codec = GzipCodec()
+# the codecs used by decompress_buf, created on first use
+_decoders = {}
+
+
+def set_codec(codec):
+    '''Set the codec used by compress_buf, a Codec, a configuration dict,
+    e.g. {'name': 'zstd', 'level': 3, 'dictionary': '/path/to/dict'}, or
+    None for gzip'''
+    global _active_codec
+    if codec is None:
+        codec = GzipCodec()
+    elif not isinstance(codec, Codec):
+        config = dict(codec)
+        name = config.pop('name', 'gzip')
+        if name not in codecs:
+            content = "Unknown codec %s! Must be one of %s." % (
+                name, ', '.join(codecs.keys()))
+            raise ValueError(content)
+        codec = codecs[name](**config)
+    _active_codec = codec
+    _decoders[codec.name] = codec
+
+
+def get_codec(buf=None):
+    '''Return the codec of compress_buf, or the codec which can decompress
+    the given buffer'''
+    if buf is None:
+        return _active_codec
+    for name, cls in codecs.items():
+        if bytes(buf[:len(cls.magic)]) == cls.magic:
+            if name not in _decoders:
+                _decoders[name] = cls()
+            return _decoders[name]
+    raise ValueError("Unknown compression format!")
+
+
+def train_zstd_dictionary(files, dict_size=112640, out=None):
+    '''Train a zstd dictionary on sample files (e.g. fort.10 and fort.6 of
+    a few jobs)
+    Args:
+        files (list): The sample files
+        dict_size (int): The maximum size (bytes) of the dictionary
+        out (str): The file to write the dictionary in
+    Returns:
+        bytes: The dictionary
+    '''
+    if zstandard is None:
+        raise ImportError("The zstd codec needs the zstandard package!")
+    samples = []
+    for name in files:
+        with open(name, 'rb') as f_in:
+            samples.append(f_in.read())
+    dict_data = zstandard.train_dictionary(dict_size, samples).as_bytes()
+    if out is not None:
+        with open(out, 'wb') as f_out:
+            f_out.write(dict_data)
+    return dict_data
+
+
 def compress_buf(data, source='file'):
     '''Data compression for storing in database
-    The data source can be file,gzip,str'''
+    The data source can be file,gzip,str
+    The file and str sources are compressed with the codec set by set_codec,
+    the gzip files are stored as they are.
+    The output is deterministic (no timestamp nor file name in the gzip
+    header), so identical contents give identical buffers.
+    If a blob store is set, the reference to the stored data is returned'''
+    # the files are streamed by chunks, only the compressed data is held
     zbuf = io.BytesIO()
     if source == 'file' and os.path.isfile(data):
-        with gzip.GzipFile(mode='wb', fileobj=zbuf) as zfile:
-            with open(data, 'rb') as f_in:
-                buf = f_in.read()
-                zfile.write(buf)
+        with open(data, 'rb') as f_in:
+            with _active_codec.writer(zbuf) as f_out:
+                shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
     elif source == 'gzip' and os.path.isfile(data):
         with open(data, 'rb') as f_in:
-            shutil.copyfileobj(f_in, zbuf)
+            zbuf.write(normalize_gzip_header(read_gzip_header(f_in)))
+            shutil.copyfileobj(f_in, zbuf, CHUNK_SIZE)
     elif source == 'str' and isinstance(data, str):
-        buf = data.encode()
-        with gzip.GzipFile(mode='wb', fileobj=zbuf) as zfile:
-            zfile.write(buf)
+        zbuf.write(_active_codec.compress(data.encode()))
     else:
         raise ValueError("Invalid data source!")
-    return zbuf.getvalue()
+    return blobstore.put(zbuf.getvalue())
+
+
+def read_gzip_header(f_in):
+    '''Read the fixed part of a gzip header and the file name if there is
+    one'''
+    head = f_in.read(10)
+    if len(head) == 10 and head[:3] == b'\x1f\x8b\x08' and head[3] & 0x08:
+        while not head.endswith(b'\x00'):
+            char = f_in.read(1)
+            if not char:
+                break
+            head += char
+    return head
+
+
+def normalize_gzip_header(buf):
+    '''Clear the timestamp and drop the file name of a gzip header, the
+    buffer is returned as it is if the header has other optional fields'''
+    # magic number, deflate method, flags (FNAME only), mtime, xfl, os
+    if len(buf) < 10 or buf[:3] != b'\x1f\x8b\x08' or buf[3] & ~0x08:
+        return buf
+    start = 10
+    if buf[3] & 0x08:
+        end = buf.find(b'\x00', start)
+        if end < 0:
+            return buf
+        start = end + 1
+    return b'\x1f\x8b\x08\x00\x00\x00\x00\x00' + buf[8:10] + buf[start:]
 
 
 def decompress_buf(buf, out, des='file'):
-    '''Data decompression to retrieve from database'''
-    if not isinstance(buf, bytes):
+    '''Data decompression to retrieve from database, the codec is detected
+    from the header of the data. The buffer can be any bytes-like object, it
+    isn't copied and is decompressed to the file by chunks'''
+    if not isinstance(buf, (bytes, bytearray, memoryview)):
         raise TypeError('"buf" must be bytes.')
     if des not in ['file', 'buf']:
         raise ValueError('"des" must be "file" or "buf".')
 
-    zbuf = io.BytesIO(buf)
-    if des == 'file':
-        with gzip.GzipFile(fileobj=zbuf) as f_in:
-            with open(out, 'wb') as f_out:
-                f_out.write(f_in.read())
-    elif des == 'buf':
-        with gzip.GzipFile(fileobj=zbuf) as f_in:
-            out = f_in.read()
-            out = out.decode()
+    if blobstore.is_ref(buf):
+        zbuf = blobstore.open_ref(buf)
+    else:
+        zbuf = BufferReader(buf)
+    with zbuf:
+        magic_len = max(len(i.magic) for i in codecs.values())
+        codec = get_codec(zbuf.read(magic_len))
+        zbuf.seek(0)
+        with codec.reader(zbuf) as f_in:
+            if des == 'file':
+                with open(out, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+            elif des == 'buf':
+                out = f_in.read().decode()
     return out
 
 
 def concatenate_files(source, dest, ignore='ENDE'):
     '''Concatenate the given files'''
-    f_out = open(dest, 'w')
-    endline = ignore + '\n'
     if not isinstance(source, list):
         source = [source]
+    texts = []
     for s_in in source:
         with open(s_in, 'r') as f_in:
-            lines = f_in.readlines()
-            valid_lines = []
-            for line in lines:
-                if line.lower().startswith(ignore.lower()):
-                    endline = line
-                    break
-                valid_lines.append(line)
-            f_out.writelines(valid_lines)
-    f_out.writelines(endline)
-    f_out.close()
+            texts.append(f_in.read())
+    with open(dest, 'w') as f_out:
+        f_out.write(concatenate_texts(texts, ignore))
+
+
+def concatenate_texts(texts, ignore='ENDE'):
+    '''Concatenate the given texts, each one is cut before its first line
+    starting with ignore, and the last of these lines ends the result'''
+    endline = ignore + '\n'
+    lines = []
+    for text in texts:
+        for line in io.StringIO(text):
+            if line.lower().startswith(ignore.lower()):
+                endline = line
+                break
+            lines.append(line)
+    lines.append(endline)
+    return ''.join(lines)
+
+
+def run_process(command, stdout, stderr=None, wall_timeout=None,
+                cpu_timeout=None, poll=0.5):
+    '''Run a shell command with its output streamed to files, and measure its
+    resource usage
+    Args:
+        command (str): The shell command
+        stdout (str): The file receiving the standard output
+        stderr (str): The file receiving the standard error, it's inherited
+        if None
+        wall_timeout (float): The command is killed after this time (s)
+        cpu_timeout (float): The command is killed after using this cpu time
+        (s), by the RLIMIT_CPU of each of its processes
+        poll (float): The maximum interval (s) between the checks of the
+        wall time
+    Returns:
+        dict: returncode, wall_time (s), cpu_time (s, user and system time of
+        the command and its waited children), max_rss (bytes) and timeout
+        (None, 'wall' or 'cpu')
+    '''
+    preexec_fn = None
+    if cpu_timeout and resource is not None:
+        limit = int(math.ceil(float(cpu_timeout)))
+
+        def preexec_fn():
+            # SIGXCPU at the soft limit, SIGKILL at the hard one
+            resource.setrlimit(resource.RLIMIT_CPU, (limit, limit + 5))
+
+    start = time.monotonic()
+    f_err = open(stderr, 'wb') if stderr is not None else None
+    try:
+        with open(stdout, 'wb') as f_out:
+            # a new session, so the whole process group can be killed
+            proc = subprocess.Popen(command, shell=True, stdout=f_out,
+                                    stderr=f_err, preexec_fn=preexec_fn,
+                                    start_new_session=True)
+    finally:
+        if f_err is not None:
+            f_err.close()
+    timeout = None
+    delay = 0.01
+    while True:
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            break
+        if wall_timeout and time.monotonic() - start > float(wall_timeout):
+            timeout = 'wall'
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            pid, status, usage = os.wait4(proc.pid, 0)
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, poll)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    cpu_time = usage.ru_utime + usage.ru_stime
+    # the shell reports a child killed by a signal as 128 + signal
+    signum = -proc.returncode if proc.returncode < 0 else\
+        proc.returncode - 128
+    if timeout is None and cpu_timeout and\
+            signum in (signal.SIGXCPU, signal.SIGKILL) and\
+            cpu_time >= float(cpu_timeout) - 1:
+        timeout = 'cpu'
+    # kilobytes on linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {'returncode': proc.returncode,
+            'wall_time': time.monotonic() - start,
+            'cpu_time': cpu_time,
+            'max_rss': usage.ru_maxrss * scale,
+            'timeout': timeout}
+
+
+def add_process_stats(total, stats):
+    '''Accumulate the resource usage of run_process in total, the times are
+    summed and the largest memory is kept'''
+    total['wall_time'] = total.get('wall_time', 0) + stats['wall_time']
+    total['cpu_time'] = total.get('cpu_time', 0) + stats['cpu_time']
+    total['max_rss'] = max(total.get('max_rss', 0), stats['max_rss'])
+    return total
+
+
+def write_process_stats(stats, dest):
+    '''Write the accumulated resource usage into the STATS_FILE of the
+    folder dest'''
+    if not os.path.isdir(dest):
+        os.makedirs(dest, 0o755)
+    keys = ['wall_time', 'cpu_time', 'max_rss']
+    with open(os.path.join(dest, STATS_FILE), 'w') as f_out:
+        json.dump(dict((k, stats[k]) for k in keys if k in stats), f_out)
+
+
+def tail_lines(filename, num=2, size=4096):
+    '''The last lines of a file, read from its last bytes only'''
+    with open(filename, 'rb') as f_in:
+        f_in.seek(0, os.SEEK_END)
+        f_in.seek(max(0, f_in.tell() - size))
+        lines = f_in.read().decode(errors='replace').splitlines(True)
+    return lines[-num:]
+
+
+def slot_cpus():
+    '''The number of cpus of the slot, the RequestCpus of the HTCondor job
+    or else the number of cpus available to the process.
+    '''
+    job_ad = os.environ.get('_CONDOR_JOB_AD')
+    if job_ad and os.path.isfile(job_ad):
+        with open(job_ad, 'r') as f_in:
+            for line in f_in:
+                key, _, value = line.partition('=')
+                if key.strip().lower() == 'requestcpus':
+                    try:
+                        return max(int(value.strip()), 1)
+                    except ValueError:
+                        break
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# the digests of the executables, by path, modification time and size
+_digests = {}
+
+
+def file_digest(path):
+    '''The SHA-256 hex digest of a file, computed once as long as it isn't
+    modified'''
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in _digests:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f_in:
+            for chunk in iter(lambda: f_in.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        _digests[key] = digest.hexdigest()
+    return _digests[key]
+
+
+def madx_exe_id(madx_exe):
+    '''The identity of the madx executable in the madx cache keys: the digest
+    of its content if it's found, else its name'''
+    exe = shutil.which(madx_exe) or madx_exe
+    if os.path.isfile(exe):
+        return file_digest(exe)
+    return madx_exe
+
+
+def madx_cache_key(mask, exe_id, output_files):
+    '''The key of the madx outputs of a rendered mask in the madx cache
+    Args:
+        mask (str): The rendered mask
+        exe_id (str): The identity of the madx executable, see madx_exe_id
+        output_files (list): The names of the madx output files
+    Returns:
+        str: The SHA-256 hex digest of the inputs
+    '''
+    # the same key for the text read from a file or from the database
+    mask = mask.replace('\r\n', '\n').replace('\r', '\n')
+    digest = hashlib.sha256()
+    for part in [mask, exe_id] + sorted(output_files):
+        part = part.encode()
+        digest.update(b'%d:' % len(part) + part)
+    return digest.hexdigest()
 
 
 def exc_catch(fun, exc_action=None, *args, **kwargs):
@@ -0,0 +1,51 @@
+import unittest
+import shutil
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import utils
+from pysixdesk.lib import blobstore
+
+
+class BlobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_folder = Path('unit_test/blobstore/')
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+        self.root = self.test_folder / 'blobs'
+
+    def test_local_store(self):
+        store = blobstore.LocalBlobStore(self.root, fanout=2)
+        key = store.put(b'data')
+        self.assertEqual(key, store.key(b'data'))
+        self.assertEqual(store.get(key), b'data')
+        self.assertEqual(Path(store.path(key)).relative_to(store.root).parts,
+                         (key[:2], key[2:4], key))
+        # identical data is stored once
+        self.assertEqual(store.put(b'data'), key)
+        self.assertEqual(len(list(self.root.glob('**/*'))), 3)
+        with self.assertRaises(FileNotFoundError):
+            store.get(store.key(b'other'))
+
+    def test_compress_buf(self):
+        blobstore.set_blob_store({'type': 'local', 'root': str(self.root)})
+        buf = utils.compress_buf('content', 'str')
+        self.assertTrue(blobstore.is_ref(buf))
+        # the compression is deterministic, so the payload is deduplicated
+        self.assertEqual(utils.compress_buf('content', 'str'), buf)
+        self.assertEqual(utils.decompress_buf(buf, None, 'buf'), 'content')
+        # small data is kept inline
+        blobstore.get_blob_store().min_size = 1000
+        buf = utils.compress_buf('content', 'str')
+        self.assertFalse(blobstore.is_ref(buf))
+        self.assertEqual(utils.decompress_buf(buf, None, 'buf'), 'content')
+
+    def tearDown(self):
+        blobstore.set_blob_store(None)
+        shutil.rmtree(self.test_folder.parent, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -64,6 +64,64 @@ class SQLDatabaseAdaptorTest(unittest.TestCase):
         out_select = self.db.select(self.conn, self.name)
         self.assertEqual(out_select, out)
 
+    def test_sqldb_updatem(self):
+        columns = {'a': 'INT', 'b': 'DOUBLE', 'd': 'TEXT'}
+        keys = {'primary': ['a', 'b']}
+        self.db.create_table(self.conn, self.name, columns, keys, recreate=True)
+        data_m = {'a': [1, 1, 2, 3, 4],
+                  'b': [1.5, 2.5, 1.5, 1.5, 1.5],
+                  'd': ['old'] * 5}
+        self.db.insertm(self.conn, self.name, data_m)
+        values = {'d': ['new_1', 'new_2', 'new_3']}
+        where = {'a': [1, 2, 4], 'b': [2.5, 1.5, 1.5]}
+        # use a tiny chunk size to go through several executemany calls
+        self.db.updatem(self.conn, self.name, values, where, chunksize=2)
+        out = self.db.select(self.conn, self.name, ['a', 'b', 'd'],
+                             orderby=['a', 'b'])
+        self.assertEqual(out, [(1, 1.5, 'old'), (1, 2.5, 'new_1'),
+                               (2, 1.5, 'new_2'), (3, 1.5, 'old'),
+                               (4, 1.5, 'new_3')])
+        # the values of the removed rows are bound, not formatted
+        self.db.deletem(self.conn, self.name, {'a': [1, 3],
+                                               'd': ['new_1', "'old' or 1"]})
+        out = self.db.select(self.conn, self.name, ['a', 'd'], orderby=['a'])
+        self.assertEqual(out, [(1, 'old'), (2, 'new_2'), (3, 'old'),
+                               (4, 'new_3')])
+        # the selected values are bound too, in chunks
+        self.db.paramsize = 2
+        out = self.db.selectm(self.conn, self.name, ['a'], 'd',
+                              ['old', 'new_3', "x' or 'a'='a"])
+        self.assertEqual(sorted(out), [(1,), (3,), (4,)])
+
+    def test_sqldb_indexes(self):
+        columns = {'a': 'INT', 'b': 'DOUBLE', 'd': 'TEXT'}
+        keys = {'primary': ['a'], 'index': [['d'], ['a', 'b']]}
+        self.db.create_table(self.conn, self.name, columns, keys, recreate=True)
+        indexes = self.db.fetch_indexes(self.conn, self.name)
+        self.assertIn('idx_%s_d' % self.name, indexes)
+        self.assertIn('idx_%s_a_b' % self.name, indexes)
+        # only the missing indexes are created
+        news = self.db.create_indexes(self.conn, self.name,
+                                      [['d'], ['b']], columns)
+        self.assertEqual(news, ['idx_%s_b' % self.name])
+
+    def test_sqldb_migrate(self):
+        self.db.create_table(self.conn, self.name, {'a': 'INT'}, {},
+                             recreate=True)
+        self.db.insertm(self.conn, self.name, {'a': list(range(10))})
+        self.db.migrate(self.conn, 'concurrent-read')
+        self.assertEqual(self.conn.execute('PRAGMA journal_mode').fetchone(),
+                         ('wal',))
+        # auto_vacuum=incremental
+        self.assertEqual(self.conn.execute('PRAGMA auto_vacuum').fetchone(),
+                         (2,))
+        self.db.migrate(self.conn, 'safe')
+        self.assertEqual(self.conn.execute('PRAGMA journal_mode').fetchone(),
+                         ('delete',))
+        self.assertEqual(len(self.db.select(self.conn, self.name)), 10)
+        with self.assertRaises(ValueError):
+            self.db.setting(self.conn, 'unknown')
+
     def tearDown(self):
         self.conn.close()
         shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
@@ -0,0 +1,129 @@
+import unittest
+import shutil
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import gather
+from pysixdesk.lib import blobstore
+from pysixdesk.lib.pysixdb import SixDB
+from pysixdesk.lib.dbtable import Table
+
+
+class GatherStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_folder = Path('unit_test/gather/')
+        self.out_path = self.test_folder / 'sixtrack_output'
+        self.out_path.mkdir(parents=True, exist_ok=True)
+        tables = {}
+        table_keys = {}
+        Table(tables, table_keys, 'sql')
+        db_info = {'db_type': 'sql',
+                   'db_name': str(self.test_folder.absolute() / 'test.db')}
+        self.db = SixDB(db_info, create=True)
+        self.db.create_table('gather_state', tables['gather_state'],
+                             table_keys['gather_state'])
+
+    def test_scan_new_dirs(self):
+        for name in ['1', '2', '3-4']:
+            (self.out_path / name).mkdir()
+        news, marks = gather.scan_new_dirs(self.db, 'sixtrack',
+                                           str(self.out_path))
+        self.assertEqual(sorted(news), ['1', '2', '3-4'])
+        gather.save_scan_marks(self.db, 'sixtrack', str(self.out_path), marks)
+        news, marks = gather.scan_new_dirs(self.db, 'sixtrack',
+                                           str(self.out_path))
+        self.assertEqual(news, [])
+        # new results and removed directories
+        time.sleep(0.01)
+        (self.out_path / '1' / 'results').mkdir()
+        shutil.rmtree(self.out_path / '2')
+        news, marks = gather.scan_new_dirs(self.db, 'sixtrack',
+                                           str(self.out_path))
+        self.assertEqual(news, ['1'])
+        gather.save_scan_marks(self.db, 'sixtrack', str(self.out_path), marks)
+        names = self.db.select('gather_state', ['name'], orderby=['name'])
+        self.assertEqual(names, [('1',), ('3-4',)])
+        # a late output in the directory of a task
+        (self.out_path / '3-4' / 'results' / '4').mkdir(parents=True)
+        news, marks = gather.scan_new_dirs(self.db, 'sixtrack',
+                                           str(self.out_path))
+        gather.save_scan_marks(self.db, 'sixtrack', str(self.out_path), marks)
+        time.sleep(0.01)
+        (self.out_path / '3-4' / 'results' / '4' / 'fort.10.gz').touch()
+        news, marks = gather.scan_new_dirs(self.db, 'sixtrack',
+                                           str(self.out_path))
+        self.assertEqual(news, ['3-4'])
+        gather.save_scan_marks(self.db, 'sixtrack', str(self.out_path), marks)
+        rows = self.db.select('gather_state', ['name', 'mtime'],
+                              orderby=['name'])
+        self.assertEqual(rows, [('1', marks['1']), ('3-4', marks['3-4'])])
+        # the job types are separated
+        news, marks = gather.scan_new_dirs(self.db, 'preprocess',
+                                           str(self.out_path))
+        self.assertEqual(len(news), 2)
+
+    def test_save_scan_marks(self):
+        for name in ['1', '2']:
+            (self.out_path / name).mkdir()
+        news, marks = gather.scan_new_dirs(self.db, 'sixtrack',
+                                           str(self.out_path))
+        # results written during the collection
+        time.sleep(0.01)
+        (self.out_path / '1' / 'results').mkdir()
+        gather.save_scan_marks(self.db, 'sixtrack', str(self.out_path), marks)
+        news, marks = gather.scan_new_dirs(self.db, 'sixtrack',
+                                           str(self.out_path))
+        self.assertEqual(news, ['1'])
+        # the directories with skipped tasks are scanned again
+        gather.save_scan_marks(self.db, 'sixtrack', str(self.out_path), marks,
+                               skipped={'2'})
+        news, marks = gather.scan_new_dirs(self.db, 'sixtrack',
+                                           str(self.out_path))
+        self.assertEqual(news, ['2'])
+
+    @unittest.skipIf(gather.np is None, 'numpy is needed')
+    def test_column_buffer(self):
+        np = gather.np
+        buf = gather.ColumnBuffer(tasks=3)
+        buf.extend(np.array([1, 2]))
+        array = buf.array
+        self.assertEqual(len(array), 6)
+        buf.extend(np.array([3, 4]))
+        buf.extend(np.array([5, 6]))
+        # the preallocated array is filled in place
+        self.assertIs(buf.array, array)
+        self.assertEqual(buf.column().dtype, np.int64)
+        self.assertEqual(buf.column().tolist(), [1, 2, 3, 4, 5, 6])
+        buf.extend(np.array([7]))
+        self.assertEqual(len(buf), 7)
+        # the strings of the line by line parser
+        buf.extend(['8'])
+        self.assertEqual(buf.column(), [1, 2, 3, 4, 5, 6, 7, '8'])
+        buf.clear()
+        self.assertEqual(len(buf), 0)
+        buf.extend(np.array([9]))
+        self.assertEqual(buf.column().tolist(), [9])
+
+    def test_init_worker(self):
+        store = {'type': 'local', 'min_size': '1',
+                 'root': str(self.test_folder.absolute() / 'blobs')}
+        # the spawned workers don't inherit the blob store
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(1, context, initializer=gather.init_worker,
+                                 initargs=(store, None)) as executor:
+            ref = executor.submit(blobstore.put, b'content').result()
+        self.assertTrue(blobstore.is_ref(ref))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.test_folder.parent, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import unittest
+import shutil
+from unittest import mock
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import utils
+from pysixdesk.lib import inputcache
+
+
+class InputCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_folder = Path('unit_test/inputcache/')
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+        self.cache = inputcache.InputCache(self.test_folder / 'cache',
+                                           namespace='study')
+
+    def test_put_materialize(self):
+        buf = utils.compress_buf('content', 'str')
+        key = self.cache.put(buf)
+        self.assertEqual(self.cache.put(buf), key)
+        self.assertIsNone(self.cache.lookup('preprocess_task/1/fort.2'))
+        self.cache.record('preprocess_task/1/fort.2', key)
+        self.assertEqual(self.cache.lookup('preprocess_task/1/fort.2'), key)
+        dest = self.test_folder / 'fort.2'
+        self.cache.materialize(key, dest)
+        self.assertEqual(dest.read_text(), 'content')
+        self.assertEqual(os.stat(dest).st_nlink, 2)
+        # the index is scoped by the namespace
+        other = inputcache.InputCache(self.cache.root, namespace='other')
+        self.assertIsNone(other.lookup('preprocess_task/1/fort.2'))
+
+    def test_evict(self):
+        keys = []
+        for i in range(3):
+            keys.append(self.cache.put(utils.compress_buf('%08d' % i, 'str')))
+            # the modification time orders the eviction
+            os.utime(self.cache.path(keys[-1]), (i, i))
+        self.assertEqual(self.cache.size(), 24)
+        self.cache.max_size = 16
+        # a file linked by a job is kept
+        self.cache.materialize(keys[0], self.test_folder / 'linked')
+        os.utime(self.cache.path(keys[0]), (0, 0))
+        self.cache.evict()
+        self.assertTrue(os.path.isfile(self.cache.path(keys[0])))
+        self.assertTrue(os.path.isfile(self.cache.path(keys[2])))
+        self.assertFalse(os.path.isfile(self.cache.path(keys[1])))
+
+    def test_fetch(self):
+        buf = utils.compress_buf('content', 'str')
+        dest = self.test_folder / 'fort.2'
+        put = self.cache.put
+
+        def evicted_put(buf):
+            # another job evicts the file before it's linked
+            key = put(buf)
+            self.cache.put = put
+            os.remove(self.cache.path(key))
+            return key
+
+        self.cache.put = evicted_put
+        with self.assertRaises(FileNotFoundError):
+            self.cache.materialize(self.cache.put(buf), dest)
+        self.assertFalse(os.path.lexists(dest))
+        self.cache.put = evicted_put
+        self.cache.fetch(buf, dest)
+        self.assertEqual(dest.read_text(), 'content')
+
+    def test_size_counter(self):
+        self.cache.max_size = 100
+        for i in range(3):
+            self.cache.put(utils.compress_buf('%08d' % i, 'str'))
+        self.assertEqual(self.cache._total, 24)
+        # the cache isn't walked again until it's full
+        with mock.patch.object(self.cache, '_entries') as entries:
+            self.cache.put(utils.compress_buf('%08d' % 3, 'str'))
+            entries.assert_not_called()
+        self.assertEqual(self.cache._total, 32)
+
+    def test_symlinks(self):
+        keys = [self.cache.put(utils.compress_buf('%08d' % i, 'str'))
+                for i in range(2)]
+        # the cache is on another file system than the job
+        with mock.patch('os.link', side_effect=OSError):
+            self.cache.materialize(keys[0], self.test_folder / 'linked')
+        self.assertTrue(os.path.islink(self.test_folder / 'linked'))
+        self.cache.max_size = 0
+        self.cache.evict()
+        for key in keys:
+            self.assertTrue(os.path.isfile(self.cache.path(key)))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_folder.parent, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import itertools
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib.paramspace import ParameterSpace
+
+
+class ParameterSpaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.requested = {'a': [1, 2, 3], 'b': [(8, 10), (10, 12)], 'c': 0.5}
+        self.recorded = {'a': [1, 2], 'b': ['(8, 10)'], 'c': [0.5]}
+
+    def full_product(self, params):
+        return set(itertools.product(*params.values()))
+
+    def test_new_cells(self):
+        space = ParameterSpace(self.requested, self.recorded)
+        new = list(space.new_cells())
+        expected = self.full_product(space.values) -\
+            self.full_product(self.recorded)
+        self.assertEqual(len(new), len(set(new)))
+        self.assertEqual(set(new), expected)
+        self.assertEqual(space.count_new(), len(expected))
+
+    def test_empty_records(self):
+        space = ParameterSpace(self.requested)
+        new = list(space.new_cells())
+        self.assertEqual(set(new), self.full_product(space.values))
+        self.assertEqual(len(new), 6)
+
+    def test_no_changes(self):
+        space = ParameterSpace({'a': [1, 2]}, {'a': [2, 1]})
+        self.assertFalse(space.has_changes())
+        self.assertEqual(list(space.new_cells()), [])
+
+    def test_custom_product(self):
+        def product(params):
+            return zip(*params.values())
+        space = ParameterSpace({'a': [1, 2, 3], 'b': [4, 5, 6]},
+                               {'a': [1], 'b': [4]})
+        self.assertEqual(list(space.new_cells(product)), [(2, 5), (3, 6)])
+
+    def test_custom_product_stream(self):
+        calls = []
+
+        def product(params):
+            calls.append(params)
+            return itertools.product(*params.values())
+        space = ParameterSpace(self.requested, self.recorded)
+        new = space.new_cells(product)
+        # the recorded cells aren't generated, the cells are streamed
+        self.assertEqual(calls, [])
+        self.assertEqual(set(new), self.full_product(space.values) -
+                         self.full_product(self.recorded))
+        self.assertEqual(calls, [space.values])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+import shutil
+import multiprocessing
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib.pysixdb import SixDB, np
+
+
+# the database inherited by the forked process
+_forked_db = None
+
+
+def _forked_open(conn_id):
+    db = _forked_db
+    db.open()
+    reused = id(db.conn) == conn_id
+    db.insert('unit_test', {'a': 1})
+    values = db.select('unit_test')
+    db.close()
+    return reused, values
+
+
+class SixDBTest(unittest.TestCase):
+
+    def setUp(self):
+        # prepare a testing folder
+        self.test_folder = Path('unit_test/pysixdb/')
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+        self.db_info = {'db_type': 'sql',
+                        'db_name': str(self.test_folder.absolute() / 'test.db')}
+
+    def test_pool_reuse(self):
+        db_1 = SixDB(self.db_info, create=True,
+                     pool={'size': 2, 'keepalive': 0.01})
+        # the sqlite connections aren't pinged from another thread
+        self.assertIsNone(db_1.pool._keeper)
+        db_1.create_table('unit_test', {'a': 'INT'})
+        conn = db_1.conn
+        db_1.close()
+        # the connection is given back to the pool and reused
+        db_2 = SixDB(self.db_info, pool=True)
+        self.assertIs(db_2.conn, conn)
+        self.assertIs(db_2.pool, db_1.pool)
+        db_2.insert('unit_test', {'a': 1})
+        # a second connection is opened while the first one is in use
+        db_3 = SixDB(self.db_info, pool=True)
+        self.assertIsNot(db_3.conn, conn)
+        self.assertEqual(db_3.select('unit_test'), [(1,)])
+        db_2.close()
+        db_3.close()
+        # closing twice doesn't give the connection back twice
+        db_3.close()
+        db_2.open()
+        db_3.open()
+        with self.assertRaises(TimeoutError):
+            db_1.pool.timeout = 0.01
+            db_1.open()
+        db_2.close()
+        db_3.close()
+        db_1.pool.close()
+
+    def test_pool_fork(self):
+        global _forked_db
+        # a pool of its own, the pools are shared by database
+        db_info = {'db_type': 'sql',
+                   'db_name': str(self.test_folder.absolute() / 'fork.db')}
+        db = SixDB(db_info, create=True, pool=True)
+        db.create_table('unit_test', {'a': 'INT'})
+        conn = db.conn
+        db.close()
+        _forked_db = db
+        context = multiprocessing.get_context('fork')
+        try:
+            with context.Pool(1) as pool:
+                # the child doesn't take the idle connection of the parent
+                reused, values = pool.apply(_forked_open, (id(conn),))
+        finally:
+            _forked_db = None
+        self.assertFalse(reused)
+        self.assertEqual(values, [(1,)])
+        db.open()
+        self.assertIs(db.conn, conn)
+        db.close()
+        db.pool.close()
+
+    def test_select_batches(self):
+        db = SixDB(self.db_info, create=True)
+        db.create_table('unit_test', {'a': 'INT', 'b': 'DOUBLE'})
+        db.insertm('unit_test', {'a': list(range(10)), 'b': [0.5] * 10})
+        batches = list(db.select_batches('unit_test', orderby=['a'],
+                                         batch_size=4))
+        self.assertEqual([len(i) for i in batches], [4, 4, 2])
+        self.assertEqual(list(db.iselect('unit_test', ['a'], 'a>6',
+                                         batch_size=2)), [(7,), (8,), (9,)])
+        if np is not None:
+            batch = next(db.select_batches('unit_test', numpy=True))
+            self.assertEqual(list(batch.keys()), ['a', 'b'])
+            self.assertEqual(batch['a'].sum(), 45)
+        db.close()
+
+    def test_transaction(self):
+        db = SixDB(self.db_info, create=True)
+        db.create_table('unit_test', {'a': 'INT'})
+        with self.assertRaises(ValueError):
+            with db.transaction():
+                db.insertm('unit_test', {'a': [1, 2]})
+                raise ValueError()
+        self.assertEqual(db.select('unit_test'), [])
+        with db.transaction():
+            db.insertm('unit_test', {'a': [1, 2]})
+            db.updatem('unit_test', {'a': [3]}, {'a': [2]})
+        self.assertEqual(db.select('unit_test', orderby=['a']), [(1,), (3,)])
+        db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_folder.parent, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import unittest
+import shutil
+import gzip
+import os
+import random
+from collections import OrderedDict
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import resultparser
+from pysixdesk.lib.pysixdb import SixDB
+from pysixdesk.lib.dbtable import Table
+from pysixdesk.lib.preprocess import PreprocessJob
+
+
+class ResultParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_folder = Path('unit_test/resultparser/')
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+        self.tables = {}
+        self.table_keys = {}
+        Table(self.tables, self.table_keys, 'sql').init_oneturn_tables()
+        self.columns = self.tables['six_results']
+        self.out_f = str(self.test_folder / 'fort.10.gz')
+        # the lines of fort.10 as sixtrack writes them, the integer columns
+        # in the exponent notation too
+        rand = random.Random(1)
+        self.lines = []
+        for i in range(3):
+            line = []
+            for typ in list(self.columns.values())[2:-1]:
+                if 'int' in typ:
+                    value = rand.randint(0, 100000)
+                else:
+                    value = rand.uniform(-1, 1) * 10**rand.randint(-12, 5)
+                line.append('%.15E' % value)
+            self.lines.append(' '.join(line) + '\n')
+        with gzip.open(self.out_f, 'wt') as f_out:
+            f_out.write('# comment\n')
+            f_out.writelines(self.lines)
+
+    def parse(self, out_f=None, tname='six_results', arrays=False):
+        task_table = {'status': 'Success'}
+        result_table = OrderedDict(self.tables[tname])
+        resultparser.parse_file(out_f or self.out_f, task_table, result_table,
+                                tname, arrays)
+        return task_table, result_table
+
+    def assert_same(self, tname, lines, arrays):
+        '''The typed columns hold the values of the strings'''
+        self.assertEqual(list(arrays['row_num']), list(lines['row_num']))
+        self.assertEqual(list(arrays['mtime']), list(lines['mtime']))
+        for col, typ in list(self.tables[tname].items())[2:-1]:
+            convert = int if 'int' in typ else float
+            values = [convert(float(i)) for i in lines[col]]
+            self.assertEqual(arrays[col].tolist(), values)
+
+    def test_parse_file(self):
+        task_table, result_table = self.parse()
+        self.assertEqual(task_table['status'], 'Success')
+        self.assertEqual(list(result_table['row_num']), [1, 2, 3])
+        self.assertEqual(list(result_table['turn_max']),
+                         [i.split()[0] for i in self.lines])
+        self.assertEqual(len(result_table['mtime']), 3)
+
+    @unittest.skipIf(resultparser.np is None, 'numpy is needed')
+    def test_parse_array(self):
+        task_table, arrays = self.parse(arrays=True)
+        self.assertEqual(task_table['status'], 'Success')
+        self.assertEqual(arrays['turn_max'].dtype, resultparser.np.int64)
+        self.assertEqual(arrays['betx'].dtype, resultparser.np.float64)
+        _, lines = self.parse()
+        self.assert_same('six_results', lines, arrays)
+
+    @unittest.skipIf(resultparser.np is None, 'numpy is needed')
+    def test_parse_oneturn(self):
+        # the oneturnresult written by the preprocess job
+        job = PreprocessJob.__new__(PreprocessJob)
+        job.fort_cfg = {'chrom_eps': '0.000001', 'CHROM': '0'}
+        cwd = os.getcwd()
+        os.chdir(self.test_folder)
+        try:
+            for name, line in zip(['first', 'second', 'beta'], self.lines):
+                with open(f'fort.10_{name}_oneturn', 'w') as f_out:
+                    f_out.write(line)
+            job.write_oneturnresult()
+            with open('oneturnresult', 'rb') as f_in:
+                with gzip.open('oneturnresult.gz', 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+        finally:
+            os.chdir(cwd)
+        out_f = str(self.test_folder / 'oneturnresult.gz')
+        tname = 'oneturn_sixtrack_results'
+        _, lines = self.parse(out_f, tname)
+        task_table, arrays = self.parse(out_f, tname, arrays=True)
+        self.assertEqual(task_table['status'], 'Success')
+        self.assert_same(tname, lines, arrays)
+
+    @unittest.skipIf(resultparser.np is None, 'numpy is needed')
+    def test_insert_array(self):
+        db_info = {'db_type': 'sql',
+                   'db_name': str(self.test_folder.absolute() / 'test.db')}
+        db = SixDB(db_info, create=True)
+        db.create_table('six_results', self.columns,
+                        self.table_keys['six_results'])
+        _, arrays = self.parse(arrays=True)
+        arrays['task_id'] = [1] * 3
+        db.insertm('six_results', arrays)
+        # the numbers are stored with their types
+        rows = db.select('six_results', ['turn_max', 'typeof(turn_max)',
+                                         'betx'])
+        db.close()
+        self.assertEqual([i[0] for i in rows], arrays['turn_max'].tolist())
+        self.assertEqual(rows[0][1], 'integer')
+        self.assertEqual([i[2] for i in rows], arrays['betx'].tolist())
+
+    def test_invalid_line(self):
+        with gzip.open(self.out_f, 'at') as f_out:
+            f_out.write('1.0 2.0\n')
+        for arrays in [False, True]:
+            task_table, result_table = self.parse(arrays=arrays)
+            self.assertEqual(task_table['status'], 'Failed')
+            self.assertEqual(len(result_table['mtime']), 4)
+            self.assertEqual(result_table['qx'][3], 'None')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_folder.parent, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
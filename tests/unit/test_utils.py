@@ -46,16 +46,68 @@ class UtilsTest(unittest.TestCase):
         out = [l.rstrip() for l in out]
         self.assertEqual(out, ['1', 'var = 2.5;', 'var=100000000000.0, var;'])
 
+    def test_template(self):
+        template = utils.Template('%tunex %tunex1 %tunex, 100%',
+                                  ['%tunex', '%tunex1'])
+        self.assertEqual(template.render([0.31, 0.32]), '0.31 0.32 0.31, 100%')
+        self.assertEqual(template.render({'%tunex': 1, '%tunex1': 2}),
+                         '1 2 1, 100%')
+        # the parsed file is reused until it's modified
+        patterns = self.patterns
+        first = utils.compile_template(self.replace_file_in, patterns)
+        self.assertIs(utils.compile_template(self.replace_file_in, patterns),
+                      first)
+        # and so is a copy in another folder
+        copy = self.test_folder / 'task_1' / 'replace_test.in'
+        copy.parent.mkdir()
+        shutil.copy(self.replace_file_in, copy)
+        self.assertIs(utils.compile_template(copy, patterns), first)
+        # the cache is bounded
+        for i in range(utils.TEMPLATE_CACHE_SIZE + 1):
+            utils.compile_template(self.replace_file_in, patterns[:1] * i)
+        self.assertEqual(len(utils._templates), utils.TEMPLATE_CACHE_SIZE)
+        self.assertIsNot(utils.compile_template(copy, patterns), first)
+
     def test_compress_buf(self):
         # with strings
         in_str = 'qwertyuiopasdfghjklzxcvbnm_-./'
         in_str_comp = utils.compress_buf(in_str, source='str')
         in_str_decomp = utils.decompress_buf(in_str_comp, None, des='buf')
         self.assertEqual(in_str, in_str_decomp)
-        # with file ...
+        # with file, larger than the streamed chunks
+        in_file = self.test_folder / 'compress_test.in'
+        out_file = self.test_folder / 'compress_test.out'
+        content = b'0123456789' * (utils.CHUNK_SIZE // 4)
+        with open(in_file, 'wb') as f_in:
+            f_in.write(content)
+        in_file_comp = utils.compress_buf(str(in_file))
+        # any bytes-like buffer is accepted
+        utils.decompress_buf(memoryview(in_file_comp), out_file)
+        with open(out_file, 'rb') as f_out:
+            self.assertEqual(f_out.read(), content)
 
         # with gzip ...
 
+    def test_codecs(self):
+        gz_buf = utils.compress_buf('content', source='str')
+        self.assertIsInstance(utils.get_codec(gz_buf), utils.GzipCodec)
+        for name in ['zstd', 'lz4']:
+            try:
+                utils.set_codec({'name': name, 'level': '1'})
+            except ImportError:
+                continue
+            buf = utils.compress_buf('content', source='str')
+            self.assertEqual(utils.get_codec(buf).name, name)
+            self.assertEqual(utils.decompress_buf(buf, None, des='buf'),
+                             'content')
+            # the gzip buffers are still readable
+            self.assertEqual(utils.decompress_buf(gz_buf, None, des='buf'),
+                             'content')
+        with self.assertRaises(ValueError):
+            utils.set_codec({'name': 'bz2'})
+        with self.assertRaises(ValueError):
+            utils.decompress_buf(b'content', None, des='buf')
+
     def test_concatenate_files(self):
         utils.concatenate_files([self.concat_file_in_1, self.concat_file_in_2],
                                 self.concat_file_out)
@@ -65,7 +117,38 @@ class UtilsTest(unittest.TestCase):
         out = self.concat_contents_1[:end_i] + self.concat_contents_2 + ['ENDE\n']
         self.assertSequenceEqual(content, out)
 
+    def test_run_process(self):
+        stdout = self.test_folder / 'stdout'
+        stats = utils.run_process('echo done; exit 3', stdout)
+        self.assertEqual(stats['returncode'], 3)
+        self.assertIsNone(stats['timeout'])
+        self.assertGreater(stats['max_rss'], 0)
+        self.assertEqual(stdout.read_text(), 'done\n')
+        stats = utils.run_process('sleep 10', stdout, wall_timeout=0.2)
+        self.assertEqual(stats['timeout'], 'wall')
+        self.assertLess(stats['wall_time'], 5)
+        total = utils.add_process_stats({}, stats)
+        total = utils.add_process_stats(total, stats)
+        self.assertEqual(total['wall_time'], 2 * stats['wall_time'])
+        self.assertEqual(total['max_rss'], stats['max_rss'])
+
+    def test_madx_cache_key(self):
+        exe = self.test_folder / 'madx'
+        exe.write_text('version 1')
+        outs = ['fort.2', 'fort.3.mad']
+        exe_id = utils.madx_exe_id(str(exe))
+        key = utils.madx_cache_key('a=1;\n', exe_id, outs)
+        self.assertEqual(utils.madx_cache_key('a=1;\r\n', exe_id, outs[::-1]),
+                         key)
+        self.assertNotEqual(utils.madx_cache_key('a=2;\n', exe_id, outs), key)
+        self.assertNotEqual(utils.madx_cache_key('a=1;\n', exe_id, outs[:1]),
+                            key)
+        exe.write_text('version 2')
+        self.assertNotEqual(utils.madx_exe_id(str(exe)), exe_id)
+        self.assertEqual(utils.madx_exe_id('no_madx'), 'no_madx')
+
     def tearDown(self):
+        utils.set_codec(None)
         # remove testing folder
         shutil.rmtree(self.test_folder.parent, ignore_errors=True)
 
@@ -40,6 +40,9 @@ class WorkSpaceTest(unittest.TestCase):
                            ('env',),
                            ('oneturn_sixtrack_results',),
                            ('oneturn_sixtrack_wu',),
+                           ('gather_state',),
+                           ('madx_cache',),
+                           ('param_index',),
                            ('preprocess_task',),
                            ('preprocess_wu',),
                            ('six_results',),
@@ -50,6 +53,21 @@ class WorkSpaceTest(unittest.TestCase):
         # is there a better way to test this ?
         self.assertIsNotNone(self.st)
 
+    def test_db_profile(self):
+        self.ws.init_study('unit_test_st')
+        self.st = self.ws.load_study('unit_test_st')
+        if self.st.db_info['db_type'] != 'sql':
+            return
+        self.st.switch_db_profile('concurrent-read')
+        self.st.db.close()
+        # the profile is kept by the next load
+        self.st = self.ws.load_study('unit_test_st')
+        self.assertEqual(self.st.db_settings, 'concurrent-read')
+        self.assertEqual(self.st.db.select('env', ['db_profile']),
+                         [('"concurrent-read"',)])
+        mode = self.st.db.conn.execute('PRAGMA journal_mode').fetchone()
+        self.assertEqual(mode[0], 'wal')
+
     def tearDown(self):
         if self.st is not None and self.st.db_info['db_type'] == 'mysql':
             conn = self.st.db.conn